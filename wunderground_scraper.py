@@ -5,7 +5,11 @@ The purpose of this module is to:
 2) Provide methods for scraping requested values off of the wunderground
 results page
 3) Print the requested data back to the user in JSON format
-4) Provide an entry point to the program to execute all this functionality
+4) Provide a batch mode which scrapes a range of dates for many locations
+concurrently
+5) Provide a service mode answering lookups over HTTP from a long-running
+process
+6) Provide an entry point to the program to execute all this functionality
 
 This module can be run by navigating to the root project directory and running
 the following command:
@@ -13,18 +17,148 @@ the following command:
 'python wunderground_scraper.py'
 
 This will execute all of the code enclosed in the if __name__ == '__main__'
-block.
+block.  Running it without any arguments prompts for a single location and
+date.  Passing arguments runs the non-interactive batch mode instead, e.g.:
+
+'python wunderground_scraper.py --location "Atlanta, GA" --start 2017-10-01
+--end 2017-10-31 --concurrency 8'
+
+'python wunderground_scraper.py --serve 8080' runs the service mode, and
+'python wunderground_scraper.py --jobs-file jobs.txt --queue queue.sqlite
+--work 4' shares the jobs out between worker processes through a queue.
 NOTE: This assumes you are running within an activated virtual environment
 and have the project's requirements already installed.  See the project README
 for instructions on setting that up.
 """
-import calendar
+# Only cheap modules are imported here.  requests, bs4 and the other heavy
+# modules are imported inside the functions which need them, so that
+# starting the script (or importing it) doesn't pay for code paths which
+# aren't used.
+import array
+import collections
 import datetime
+import itertools
 import json
+import os
 import re
-import requests
 import sys
-from bs4 import BeautifulSoup
+import threading
+import time
+
+# Root of every url we build.  Tests point this at a local stand-in server.
+WUNDERGROUND_URL = 'https://www.wunderground.com'
+# Validation patterns, compiled once rather than on every call
+CITY_STATE_REGEX = re.compile(r'^[a-zA-Z]+\s?[a-zA-Z]*,\s[a-zA-Z]+$')
+ZIPCODE_REGEX = re.compile(r'^\d\d\d\d\d$')
+AIRPORT_REGEX = re.compile(r'^[A-Z][A-Z][A-Z][A-Z]$')
+MONTH_REGEX = re.compile(r'^[1-9][0-2]{,1}$')
+DAY_REGEX = re.compile(r'^\d{1,2}$')
+YEAR_REGEX = re.compile(r'^\d\d\d\d$')
+# Finds the opening tag of the weather history table in a raw page
+HISTORY_TABLE_REGEX = re.compile(rb'<table[^>]*\sid=["\']?historyTable\b')
+# Finds the opening tag of the table of daily summaries on the Monthly
+# and Custom history views, which show many days on one page
+RANGE_TABLE_REGEX = re.compile(rb'<table[^>]*\sid=["\']?obsTable\b')
+# Finds the temperature unit in the range table's header, e.g. 'Temp. (°F)'
+RANGE_UNIT_REGEX = re.compile(r'Temp\.\s*\(\s*°?\s*([A-Z])\s*\)')
+# (column index, output key) for each value read from a day's row of the
+# range table.  Columns are 1: high, 2: avg, 3: low.  The range views
+# don't carry the Average and Record columns of the daily view.
+RANGE_FIELD_SPEC = ((1, 'Actual Max Temperature'),
+                    (2, 'Actual Mean Temperature'),
+                    (3, 'Actual Min Temperature'))
+RANGE_KEYS = frozenset(key for _, key in RANGE_FIELD_SPEC)
+# Shortest run of days in a month worth fetching through a range view
+# rather than one daily page at a time
+RANGE_MIN_DAYS = 7
+# Number of most recent days a sync refetches even when they are stored,
+# since wunderground may still be revising them
+SYNC_REVISE_DAYS = 3
+# Seconds a worker holds the jobs it leases from a WorkQueue between
+# heartbeats, and how many times a job is tried before it is given up on
+QUEUE_LEASE_SECONDS = 60
+QUEUE_MAX_ATTEMPTS = 3
+# Month names used in the range table's headers
+MONTH_NUMBERS = dict((name, number) for number, name in enumerate(
+    ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct',
+     'Nov', 'Dec'), 1))
+# Row label -> (column index, output key) for each value read from the
+# weather history table.  Columns are 1: Actual, 2: Average, 3: Record
+TEMPERATURE_FIELD_SPEC = {
+    'Mean Temperature': ((1, 'Actual Mean Temperature'),
+                         (2, 'Average Mean Temperature')),
+    'Max Temperature': ((1, 'Actual Max Temperature'),
+                        (2, 'Average Max Temperature'),
+                        (3, 'Record Max Temperature')),
+    'Min Temperature': ((1, 'Actual Min Temperature'),
+                        (2, 'Average Min Temperature'),
+                        (3, 'Record Min Temperature')),
+}
+# Rows which aren't scraped by default
+EXTRA_FIELD_SPEC = {
+    'Dew Point': ((1, 'Actual Dew Point'),),
+    'Average Humidity': ((1, 'Actual Average Humidity'),),
+    'Precipitation': ((1, 'Actual Precipitation'),
+                      (2, 'Average Precipitation'),
+                      (3, 'Record Precipitation')),
+    'Sea Level Pressure': ((1, 'Actual Sea Level Pressure'),),
+    'Wind Speed': ((1, 'Actual Wind Speed'),),
+    'Max Wind Speed': ((1, 'Actual Max Wind Speed'),),
+}
+# Splits a job's 'YYYY-MM-DD' date into year, month and day
+JOB_DATE_REGEX = re.compile(r'^(\d{4})-(\d{1,2})-(\d{1,2})$')
+# Splits formatted cell text like '104F (1999)' into value, unit and year
+READING_REGEX = re.compile(r'^(-?\d+(?:\.\d+)?)\s*([^\s(]*)\s*(?:\((\d{4})\))?$')
+# Most bytes of a streamed page left unread after its table which are
+# still read and thrown away, so the kept-alive connection can be reused.
+# Past this closing the connection and opening a new one is cheaper.
+DRAIN_LIMIT = 64 * 1024
+# Size of the chunks streamed pages are read in
+CHUNK_SIZE = 16 * 1024
+# Bucket upper bounds of the Metrics histograms, in seconds and bytes
+SECONDS_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+                   2.5, 5.0, 10.0)
+BYTES_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+# Most jobs a single batch request to the service may ask for
+SERVICE_MAX_JOBS = 1000
+# Largest request body the service reads, a batch of SERVICE_MAX_JOBS
+# lookups is well under this
+SERVICE_MAX_BODY = 1024 * 1024
+# Status codes which are worth retrying, wunderground sends these when it
+# is overloaded or throttling us
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+class ScraperError(Exception):
+    """ Base class of the errors raised while scraping a results page.
+    The message is what gets reported to the user in the error json.
+    """
+
+
+class RequestError(ScraperError):
+    """ The request for the results page failed, timed out, or was
+    redirected too many times.
+    """
+
+
+class StatusCodeError(ScraperError):
+    """ The results page answered with a status code other than 200.
+    """
+
+
+class ParseError(ScraperError):
+    """ The results page doesn't have a complete weather history table.
+    """
+
+
+# The temperatures read off a results page.  Values are ints, or floats if
+# the page shows decimals, and None when the page leaves a cell blank.
+# 'unit' is the temperature unit the page is in, usually 'F'.
+WeatherRecord = collections.namedtuple('WeatherRecord', [
+    'actual_mean', 'average_mean',
+    'actual_max', 'average_max', 'record_max', 'record_max_year',
+    'actual_min', 'average_min', 'record_min', 'record_min_year',
+    'unit'])
 
 
 def validate_location(location_string):
@@ -40,18 +174,14 @@ def validate_location(location_string):
     :return valid: True if location_string is valid, False if invalid
     """
     valid = False
-    # Setup regular expressions for each case
-    city_state_regex = r'^[a-zA-Z]+\s?[a-zA-Z]*,\s[a-zA-Z]+$'
-    zipcode_regex = r'^\d\d\d\d\d$'
-    airport_regex = r'^[A-Z][A-Z][A-Z][A-Z]$'
     # Check if 'city, state'
-    if re.search(city_state_regex, location_string):
+    if CITY_STATE_REGEX.search(location_string):
         valid = True
     # Check if zipcode
-    elif re.search(zipcode_regex, location_string):
+    elif ZIPCODE_REGEX.search(location_string):
         valid = True
     # Check if airport code
-    elif re.search(airport_regex, location_string):
+    elif AIRPORT_REGEX.search(location_string):
         valid = True
     return valid
 
@@ -64,8 +194,7 @@ def validate_month(month_string):
     :param month_string:
     :return boolean: True if is valid month, False otherwise
     """
-    regex = r'^[1-9][0-2]{,1}$'
-    return re.search(regex, month_string) is not None
+    return MONTH_REGEX.search(month_string) is not None
 
 
 def validate_day(day_string, month_string):
@@ -78,9 +207,8 @@ def validate_day(day_string, month_string):
     :param month_string: A validated month string
     :return: True if valid, False if invalid
     """
-    regex = r'^\d{1,2}$'
     # Make sure it's a valid number of digits (one or two)
-    if re.search(regex, day_string):
+    if DAY_REGEX.search(day_string):
         day_num = int(day_string)
         # Make sure it's at least the first of a month
         if day_num < 1:
@@ -112,9 +240,9 @@ def validate_year(year_string, month_string, day_string):
     :param day_string: Validated numeric day as a string
     :return: True if year is valid, False if year is not valid
     """
+    import calendar
     # Make sure year has 4 digits
-    regex = r'^\d\d\d\d$'
-    if re.search(regex, year_string):
+    if YEAR_REGEX.search(year_string):
         # Make sure feb 29 isn't valid unless leap year
         year_num = int(year_string)
         day_num = int(day_string)
@@ -124,9 +252,9 @@ def validate_year(year_string, month_string, day_string):
                     return False
 
         # Make sure it doesn't occur in the future
-        now = datetime.datetime.now()
-        users_date = datetime.datetime(year=year_num, month=int(month_string), day=day_num)
-        if now < users_date:
+        today = datetime.date.today()
+        users_date = datetime.date(year_num, int(month_string), day_num)
+        if today < users_date:
             return False
         # Passed tests and is valid
         return True
@@ -179,7 +307,8 @@ def get_inputs():
     return location_string, month_string, day_string, year_string
 
 
-def get_url(search_location, search_day, search_month, search_year):
+def get_url(search_location, search_day, search_month, search_year,
+            base_url=WUNDERGROUND_URL):
     """ Takes in variables to create a valid url which, when a get request
     is sent to that url, redirects us to the results page the user is
     looking for.
@@ -189,6 +318,7 @@ def get_url(search_location, search_day, search_month, search_year):
     :param search_day: validated string for day that exists
     :param search_month: validated string for month which exists
     :param search_year: validated string for year which exists
+    :param base_url: Scheme and host the url should point at
     :return formatted_url:  A url to be used in a get request which will
     point us to the results page for the data provided
     """
@@ -196,14 +326,386 @@ def get_url(search_location, search_day, search_month, search_year):
     # space characters with '+' character
     search_location = search_location.replace(' ', '+')
     # Inject data into the pre-made url
-    formatted_url = 'https://www.wunderground.com/cgi-bin/findweather/' \
+    formatted_url = '%s/cgi-bin/findweather/' \
                     'getForecast?airportorwmo=query&historytype=DailyHistory&backurl=/history/index.html&' \
                     'code=%s&month=%s&day=%s&year=%s' \
-                    % (search_location, search_month, search_day, search_year)
+                    % (base_url, search_location, search_month, search_day, search_year)
+    return formatted_url
+
+
+def get_range_view(start_date, end_date):
+    """ Picks the history view which shows a range of days within one
+    month on a single page.  MonthlyHistory is used for a whole month,
+    CustomHistory for anything shorter.
+
+    :param start_date: First datetime.date of the range
+    :param end_date: Last datetime.date of the range, in the same month
+    :return history_type: Name of the view
+    :return query: Extra query parameters the view needs, may be empty
+    """
+    last_day = (end_date + datetime.timedelta(days=1)).month != end_date.month
+    if start_date.day == 1 and last_day:
+        return 'MonthlyHistory', ''
+    return 'CustomHistory', 'dayend=%s&monthend=%s&yearend=%s' \
+                            % (end_date.day, end_date.month, end_date.year)
+
+
+def get_range_url(search_location, start_date, end_date,
+                  base_url=WUNDERGROUND_URL):
+    """ Creates a url which redirects to the Monthly or Custom history page
+    showing every day from start_date to end_date.  See get_url.
+
+    :param search_location: formatted string containing the location
+    :param start_date: First datetime.date of the range
+    :param end_date: Last datetime.date of the range, in the same month
+    :param base_url: Scheme and host the url should point at
+    :return formatted_url: A url which redirects to the range's page
+    """
+    history_type, query = get_range_view(start_date, end_date)
+    search_location = search_location.replace(' ', '+')
+    formatted_url = '%s/cgi-bin/findweather/' \
+                    'getForecast?airportorwmo=query&historytype=%s&backurl=/history/index.html&' \
+                    'code=%s&month=%s&day=%s&year=%s' \
+                    % (base_url, history_type, search_location, start_date.month,
+                       start_date.day, start_date.year)
+    if query:
+        formatted_url += '&' + query
     return formatted_url
 
 
-def scrape_weather_data(results_url):
+class Fetcher(object):
+    """ Owns a requests.Session so that connections to wunderground are
+    kept alive and reused between lookups instead of paying for a new
+    TCP and TLS handshake on every request.  The session's HTTPAdapter is
+    sized for the number of threads sharing it and retries throttled or
+    failed requests with an exponential backoff.
+    Can be used as a context manager to close the pooled connections.
+    """
+
+    def __init__(self, pool_size=10, retries=3, backoff_factor=0.5, timeout=3):
+        """ :param pool_size: Number of connections kept open per host,
+        should be at least the number of threads sharing the fetcher
+        :param retries: How many times a request is retried on connection
+        errors or on one of the RETRY_STATUS_CODES
+        :param backoff_factor: Base of the exponential sleep between retries
+        :param timeout: Seconds to wait on the server before giving up
+        """
+        import requests
+        from requests.adapters import HTTPAdapter
+        self.timeout = timeout
+        self.session = requests.Session()
+        # requests decompresses gzip transparently, make sure we ask for it
+        self.session.headers['Accept-Encoding'] = 'gzip, deflate'
+        retry = jittered_retry(total=retries, backoff_factor=backoff_factor,
+                               status_forcelist=RETRY_STATUS_CODES,
+                               raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def get(self, url, stream=False):
+        """ Performs a get request over the pooled session, following
+        redirects.
+
+        :param url: Url to request
+        :param stream: If True only the headers are read, the body is left
+        to be read with iter_content
+        :return: requests.Response for the final page
+        """
+        return self.session.get(url, timeout=self.timeout, stream=stream)
+
+    def close(self):
+        """ Closes every pooled connection.
+        """
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def jittered_retry(**kwargs):
+    """ Builds a urllib3 Retry whose exponential backoff is jittered: each
+    sleep is drawn uniformly between zero and the plain backoff, so threads
+    throttled together don't all come back at the same moment.  A
+    Retry-After header sent with a 429 or 503 is still honoured as is.
+
+    :param kwargs: Arguments for urllib3's Retry
+    :return: Retry instance
+    """
+    import random
+    from urllib3.util.retry import Retry
+
+    class JitteredRetry(Retry):
+        def get_backoff_time(self):
+            return random.uniform(0, Retry.get_backoff_time(self))
+
+    return JitteredRetry(**kwargs)
+
+
+class Metrics(object):
+    """ Collects counters and histograms about a run: how long each stage
+    of scraping a page takes (redirect, request, download, parse, extract,
+    and whole tasks), how many bytes of each page are read, status codes,
+    retries, cache hits and errors.  Exported in the Prometheus text format
+    or as a json summary.  Every metric name is prefixed 'wunderground_'.
+    Safe to share between threads.
+    Instrumented code reports to the module's METRICS, which is a
+    NullMetrics that ignores everything until enable_metrics is called.
+    """
+    enabled = True
+    # Buckets of each histogram by metric name
+    buckets = {'stage_seconds': SECONDS_BUCKETS, 'page_bytes': BYTES_BUCKETS}
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (name, sorted label pairs) -> count
+        self._counters = dict()
+        # (name, sorted label pairs) -> [bucket counts..., sum, count]
+        self._histograms = dict()
+
+    def count(self, name, value=1, **labels):
+        """ Adds to a counter.
+
+        :param name: Name of the counter, e.g. 'requests_total'
+        :param value: Amount to add
+        :param labels: Label values telling series of the counter apart
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """ Records a value in a histogram.
+
+        :param name: Name of the histogram, a key of 'buckets'
+        :param value: The value to record
+        :param labels: Label values telling series of the histogram apart
+        """
+        key = (name, tuple(sorted(labels.items())))
+        buckets = self.buckets[name]
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * (len(buckets) + 2)
+            for index, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram[index] += 1
+                    break
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    def timer(self, stage):
+        """ :param stage: Name of the stage being timed
+        :return: Context manager recording how long its block takes in
+        the 'stage_seconds' histogram
+        """
+        return StageTimer(self, stage)
+
+    def to_prometheus(self):
+        """ :return: Every metric in the Prometheus text exposition format
+        """
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, list(value))
+                                for key, value in self._histograms.items())
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                lines.append('# TYPE wunderground_%s counter' % name)
+                typed.add(name)
+            lines.append('wunderground_%s%s %s' % (name, format_labels(labels), value))
+        for (name, labels), histogram in histograms:
+            if name not in typed:
+                lines.append('# TYPE wunderground_%s histogram' % name)
+                typed.add(name)
+            # Prometheus buckets are cumulative
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets[name], histogram):
+                cumulative += bucket_count
+                lines.append('wunderground_%s_bucket%s %s' % (
+                    name, format_labels(labels + (('le', bound),)), cumulative))
+            lines.append('wunderground_%s_bucket%s %s' % (
+                name, format_labels(labels + (('le', '+Inf'),)), histogram[-1]))
+            lines.append('wunderground_%s_sum%s %s' % (name, format_labels(labels),
+                                                       histogram[-2]))
+            lines.append('wunderground_%s_count%s %s' % (name, format_labels(labels),
+                                                         histogram[-1]))
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """ :return: Dictionary of every metric, ready to be dumped as json.
+        Series are keyed by their labels formatted like 'stage=parse'.
+        Histograms give their count, sum, mean, and bucket counts.
+        """
+        summary = {'counters': dict(), 'histograms': dict()}
+        with self._lock:
+            for (name, labels), value in sorted(self._counters.items()):
+                series = ','.join('%s=%s' % label for label in labels)
+                summary['counters'].setdefault(name, dict())[series] = value
+            for (name, labels), histogram in sorted(self._histograms.items()):
+                series = ','.join('%s=%s' % label for label in labels)
+                summary['histograms'].setdefault(name, dict())[series] = {
+                    'count': histogram[-1],
+                    'sum': histogram[-2],
+                    'mean': histogram[-2] / histogram[-1],
+                    'buckets': dict(('%s' % bound, bucket_count) for bound, bucket_count
+                                    in zip(self.buckets[name], histogram[:-2]))}
+        return summary
+
+
+class StageTimer(object):
+    """ Context manager returned by Metrics.timer.
+    """
+
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.observe('stage_seconds', time.perf_counter() - self.started,
+                             stage=self.stage)
+
+
+class NullMetrics(object):
+    """ Stands in for Metrics while metrics are disabled.  Every method
+    does nothing, so instrumented code costs no more than a method call.
+    """
+    enabled = False
+
+    def count(self, name, value=1, **labels):
+        pass
+
+    def observe(self, name, value, **labels):
+        pass
+
+    def timer(self, stage):
+        return NULL_TIMER
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+# The timer handed out by NullMetrics, which is also its own no-op
+# context manager
+NULL_TIMER = NullMetrics()
+# What instrumented code reports to, see enable_metrics
+METRICS = NullMetrics()
+
+
+def enable_metrics():
+    """ Starts collecting metrics from all instrumented code.
+
+    :return: The new Metrics, which can be exported at the end of a run
+    """
+    global METRICS
+    METRICS = Metrics()
+    return METRICS
+
+
+def disable_metrics():
+    """ Stops collecting metrics.
+    """
+    global METRICS
+    METRICS = NullMetrics()
+
+
+def format_labels(labels):
+    """ Formats a metric's labels the way Prometheus expects them.
+
+    :param labels: Tuple of (name, value) pairs
+    :return: String like '{stage="parse"}', empty if there are no labels
+    """
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\')
+                                          .replace('"', '\\"'))
+                             for name, value in labels)
+
+
+def record_response_metrics(response):
+    """ Reports the redirects, status codes, and retries behind a response
+    to METRICS.
+
+    :param response: requests.Response, whose history holds the redirects
+    which led to it
+    """
+    for hop in response.history + [response]:
+        METRICS.count('requests_total', status=hop.status_code)
+        retries = getattr(hop.raw, 'retries', None)
+        if retries is not None and retries.history:
+            METRICS.count('retries_total', len(retries.history))
+    if response.history:
+        METRICS.observe('stage_seconds', sum(hop.elapsed.total_seconds()
+                                             for hop in response.history),
+                        stage='redirect')
+    METRICS.observe('stage_seconds', response.elapsed.total_seconds(),
+                    stage='request')
+
+
+class Profiler(object):
+    """ Collects cProfile stats from every thread that runs work through
+    call(), for the --profile flag.  cProfile only sees the thread it was
+    enabled in, so each thread gets its own profile and they are merged
+    when dumped.  On Pythons where one profile already sees every thread,
+    enabling a second one fails and the call simply runs under the first.
+    """
+
+    def __init__(self):
+        import cProfile
+        self._new_profile = cProfile.Profile
+        self._profiles = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def call(self, function, *args):
+        """ Calls a function with the calling thread's profile enabled.
+
+        :param function: Function to call
+        :param args: Arguments to call it with
+        :return: Whatever the function returns
+        """
+        profile = getattr(self._local, 'profile', None)
+        if profile is None:
+            profile = self._local.profile = self._new_profile()
+            with self._lock:
+                self._profiles.append(profile)
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profile is already active and covers this thread
+            return function(*args)
+        try:
+            return function(*args)
+        finally:
+            profile.disable()
+
+    def dump(self, path):
+        """ Writes the merged stats, to be read with 'python -m pstats'.
+
+        :param path: File to write the stats to
+        """
+        import pstats
+        with self._lock:
+            profiles = [profile for profile in self._profiles
+                        if profile.getstats()]
+        stats = pstats.Stats(*profiles)
+        stats.dump_stats(path)
+
+
+def scrape_weather_data(results_url, fetcher=None, fields=None):
     """ Takes in a 'results_url' which, when a get request is performed on
     that url, redirects to the results page.  Navigates the HTML on that page
     searching for the weather history table.  Parses the following from the
@@ -215,62 +717,677 @@ def scrape_weather_data(results_url):
 
     :param results_url: A url which will redirect to the results page
     for the data the user provided
+    :param fetcher: Optional Fetcher to reuse pooled connections,
+    a one-off request is made if not provided
+    :param fields: Compiled field spec of the rows to parse, defaults to
+    TEMPERATURE_FIELDS, ALL_FIELDS adds moisture, wind and pressure
     :return: A string containing the temperature data of interest
-    formatted as a json
+    formatted as a json, or the error formatted as a json
     """
-    # Follow the results_url to the results page
-    response = None
     try:
-        response = requests.get(results_url, timeout=3)
-    except requests.Timeout as te:
-        print('{"error": "Request timed out"}')
-        sys.exit()
-    except requests.TooManyRedirects as tre:
-        print('{"error": "Request raised too many redirects"}')
-        sys.exit()
-    except requests.RequestException as ree:
-        print('{"error": "Request raised an exception"}')
-        sys.exit()
+        return format_fields(scrape_weather_fields(results_url, fetcher, fields))
+    except ScraperError as error:
+        return format_error(error)
+
+
+def scrape_weather_fields(results_url, fetcher=None, fields=None):
+    """ Follows the results_url to the results page and parses the fields
+    out of the weather history table, keeping the text of each cell.
+
+    :param results_url: A url which will redirect to the results page
+    :param fetcher: Optional Fetcher to reuse pooled connections
+    :param fields: Compiled field spec, TEMPERATURE_FIELDS if not provided
+    :return: Dictionary of output key -> formatted cell text
+    :raises ScraperError: If the page couldn't be fetched or parsed
+    """
+    response = fetch_page(results_url, fetcher)
+    return parse_weather_response(response, results_url, fields)
+
+
+def scrape_weather_record(results_url, fetcher=None):
+    """ Follows the results_url to the results page and parses the
+    temperatures out of the weather history table as numbers.
+
+    :param results_url: A url which will redirect to the results page
+    :param fetcher: Optional Fetcher to reuse pooled connections
+    :return: WeatherRecord of the page's temperatures
+    :raises ScraperError: If the page couldn't be fetched or parsed
+    """
+    return build_weather_record(scrape_weather_fields(results_url, fetcher))
+
+
+def format_fields(field_dict):
+    """ Formats parsed fields as a string in json format, keys sorted.
+
+    :param field_dict: Dictionary of output key -> formatted cell text
+    :return: A string containing the fields formatted as a json
+    """
+    return json.dumps(field_dict, sort_keys=True)
+
+
+def format_error(error):
+    """ Formats a ScraperError the way errors are reported to the user.
+
+    :param error: The ScraperError to format
+    :return: A string containing the error formatted as a json
+    """
+    return json.dumps({'error': str(error)})
+
+
+def fetch_page(results_url, fetcher=None):
+    """ Helper function for scrape_weather_data.
+    Follows the results_url to the results page.  The response is
+    streamed, only its headers have been read when it is returned, so that
+    read_table can stop reading the body once it has the table it needs.
+
+    :param results_url: A url which will redirect to the results page
+    :param fetcher: Optional Fetcher to reuse pooled connections,
+    a one-off request is made if not provided
+    :return: requests.Response for the results page
+    :raises RequestError: If the request failed
+    """
+    import requests
+    try:
+        if fetcher is None:
+            response = requests.get(results_url, timeout=3, stream=True)
+        else:
+            response = fetcher.get(results_url, stream=True)
+        if METRICS.enabled:
+            record_response_metrics(response)
+        return response
+    except requests.Timeout:
+        raise RequestError('Request timed out')
+    except requests.TooManyRedirects:
+        raise RequestError('Request raised too many redirects')
+    except requests.RequestException:
+        raise RequestError('Request raised an exception')
+
+
+def fetch_limited(results_url, fetcher=None, rate_limiter=None):
+    """ fetch_page behind a RateLimiter: waits for the host's turn, then
+    reports how the request went back to the limiter.
+
+    :param results_url: A url which will redirect to the results page
+    :param fetcher: Optional Fetcher to reuse pooled connections
+    :param rate_limiter: Optional RateLimiter shared between workers
+    :return: requests.Response for the results page
+    :raises RequestError: If the request failed
+    """
+    if rate_limiter is None:
+        return fetch_page(results_url, fetcher)
+    rate_limiter.wait(results_url)
+    try:
+        response = fetch_page(results_url, fetcher)
+    except RequestError:
+        rate_limiter.record_failure(results_url)
+        raise
+    rate_limiter.record(results_url, response)
+    return response
+
+
+def parse_weather_response(response, results_url, fields=None):
+    """ Helper function for scrape_weather_data.
+    Checks the response's status code and parses the fields out of the
+    weather history table on the page.  Only the page up to the end of the
+    table is read.
+
+    :param response: requests.Response for the results page
+    :param results_url: The url which was requested, used in error messages
+    :param fields: Compiled field spec, TEMPERATURE_FIELDS if not provided
+    :return: Dictionary of output key -> formatted cell text
+    :raises StatusCodeError: If the response wasn't a 200
+    :raises ParseError: If the page doesn't have a complete table
+    :raises RequestError: If the connection failed while reading the page
+    """
+    fragment = read_response_table(response, results_url, HISTORY_TABLE_REGEX)
+    return parse_history_table(fragment, encoding=response.encoding,
+                               fields=fields)
+
+
+def read_response_table(response, results_url, table_regex):
+    """ Checks the response's status code and reads a table out of it.
+
+    :param response: Streamed requests.Response for the page
+    :param results_url: The url which was requested, used in error messages
+    :param table_regex: Compiled bytes pattern matching the table's opening tag
+    :return: Bytes of the table
+    :raises StatusCodeError: If the response wasn't a 200
+    :raises ParseError: If the page doesn't have the table
+    :raises RequestError: If the connection failed while reading the page
+    """
     if response.status_code != 200:
-        return '{"error": "Received %s status code for url: ' \
-               '%s"}' % (response.status_code, results_url)
+        release_response(response)
+        raise StatusCodeError('Received %s status code for url: %s'
+                              % (response.status_code, results_url))
+    fragment, _ = read_table(response, table_regex)
+    if fragment is None:
+        raise missing_table_error(results_url)
+    return fragment
+
+
+def read_table(response, table_regex, chunk_size=CHUNK_SIZE):
+    """ Reads a streamed response only as far as the end of a table and
+    slices the table out, the way slice_table does for a whole page.
+    Bytes before the table are thrown away as they arrive, and once the
+    table's closing tag has arrived the rest of the page is never read
+    (see release_response).
+
+    :param response: Streamed requests.Response for the page
+    :param table_regex: Compiled bytes pattern matching the table's opening tag
+    :param chunk_size: Number of bytes to read at a time
+    :return fragment: Bytes from the table's opening tag through its
+    closing tag, or None if the page doesn't have the table
+    :return bytes_read: Number of bytes of the page which were read
+    :raises RequestError: If the connection failed while reading the page
+    """
+    import requests
+    buffer = bytearray()
+    bytes_read = 0
+    table_start = None
+    fragment = None
+    with METRICS.timer('download'):
+        try:
+            chunks = response.iter_content(chunk_size)
+            for chunk in chunks:
+                bytes_read += len(chunk)
+                searched = len(buffer)
+                buffer += chunk
+                if table_start is None:
+                    # The opening tag may have been cut off at the end of the
+                    # last chunk, search again from the last tag it had
+                    tag_start = max(buffer.rfind(b'<', 0, searched), 0)
+                    match = table_regex.search(buffer, tag_start)
+                    if match is None:
+                        # Keep only what could be the start of the opening tag
+                        last_tag = buffer.rfind(b'<')
+                        del buffer[:last_tag if last_tag != -1 else len(buffer)]
+                        continue
+                    del buffer[:match.start()]
+                    table_start = match.end() - match.start()
+                    searched = table_start
+                table_end = buffer.find(b'</table>', max(searched - len(b'</table>'),
+                                                         table_start))
+                if table_end != -1:
+                    fragment = bytes(buffer[:table_end + len(b'</table>')])
+                    break
+            else:
+                # A truncated page is handed over as is, the parser copes with it
+                if table_start is not None:
+                    fragment = bytes(buffer)
+            release_response(response, chunks)
+        except requests.RequestException:
+            response.close()
+            raise RequestError('Request raised an exception while reading the page')
+    METRICS.observe('page_bytes', bytes_read)
+    return fragment, bytes_read
+
+
+def release_response(response, chunks=None):
+    """ Finishes with a streamed response.  If no more than DRAIN_LIMIT
+    bytes of it are still unread they are read and thrown away, so that a
+    kept-alive connection goes back to its pool.  Otherwise the connection
+    is closed, since reading on would cost more than opening a new one.
+    Without a Content-Length (e.g. a chunked page) how much is left can't
+    be known up front, so up to DRAIN_LIMIT more bytes are read and the
+    connection is only closed if the page still hasn't ended.
+
+    :param response: Streamed requests.Response
+    :param chunks: The response's iter_content generator, if it has
+    already been partly read
+    """
+    import requests
+    try:
+        length = int(response.headers.get('Content-Length', ''))
+    except ValueError:
+        length = None
+    # raw.tell() counts the bytes read off the wire, which is what
+    # Content-Length is measured in even for compressed pages
+    if length is None or length - response.raw.tell() <= DRAIN_LIMIT:
+        drained = 0
+        try:
+            for chunk in chunks or response.iter_content(CHUNK_SIZE):
+                # raw.tell() doesn't count chunked pages, count what they give
+                drained += len(chunk)
+                if length is None and drained > DRAIN_LIMIT:
+                    # Leaves the page unfinished, so close() drops the connection
+                    break
+        except requests.RequestException:
+            # Whatever was needed has been read, a broken tail doesn't matter
+            pass
+    response.close()
+
 
-    # Use beautiful soup to navigate the html
-    # to the rows in the history table
-    page = BeautifulSoup(response.text, "html.parser")
-    history_table = page.find('table', id='historyTable')
+def missing_table_error(results_url):
+    """ :param results_url: The url which was requested
+    :return: ParseError for a page without the table we want
+    """
     # Handle the case of if we weren't sent to a web page
     # with the table/id we want
-    if history_table is None:
-        return '{"error": "Received a link which does not contain ' \
-               'the data we want.  Link received %s"}' % results_url
-    history_table_rows = history_table.findAll('tr')
+    return ParseError('Received a link which does not contain '
+                      'the data we want.  Link received %s' % results_url)
+
+
+def parse_weather_page(page, results_url, parser=None, encoding=None,
+                       fields=None):
+    """ Parses the temperature data out of the raw bytes of a results page.
+    Only the weather history table is sliced out of the page and handed
+    to the parser, the rest of the page is never decoded or parsed.
+
+    :param page: Raw bytes of the results page
+    :param results_url: The url which was requested, used in error messages
+    :param parser: Name of the parser backend in PARSERS to use,
+    the fastest one installed is used if not provided
+    :param encoding: Encoding of the page, utf-8 if not provided
+    :param fields: Compiled field spec, TEMPERATURE_FIELDS if not provided
+    :return: Dictionary of output key -> formatted cell text
+    :raises ParseError: If the page doesn't have a complete table
+    """
+    fragment = slice_history_table(page)
+    if fragment is None:
+        raise missing_table_error(results_url)
+    return parse_history_table(fragment, parser, encoding, fields)
+
+
+def parse_history_table(fragment, parser=None, encoding=None, fields=None):
+    """ Parses the fields out of the weather history table's bytes.
+
+    :param fragment: Bytes of the weather history table
+    :param parser: Name of the parser backend in PARSERS to use,
+    the fastest one installed is used if not provided
+    :param encoding: Encoding of the page, utf-8 if not provided
+    :param fields: Compiled field spec, TEMPERATURE_FIELDS if not provided
+    :return: Dictionary of output key -> formatted cell text
+    :raises ParseError: If the table is missing a required header
+    """
+    with METRICS.timer('parse'):
+        rows = get_parser(parser)(fragment.decode(encoding or 'utf-8', 'replace'))
+    with METRICS.timer('extract'):
+        return extract_fields(rows, fields)
+
+
+def slice_history_table(page):
+    """ Helper function for parse_weather_page.
+    Finds the weather history table in the raw bytes of a page, without
+    parsing anything, and slices it out.
+
+    :param page: Raw bytes of the results page
+    :return: Bytes from the table's opening tag through its closing tag,
+    or None if the page doesn't have the table
+    """
+    return slice_table(page, HISTORY_TABLE_REGEX)
+
 
+def slice_table(page, table_regex):
+    """ Slices a table out of the raw bytes of a page.
+
+    :param page: Raw bytes of the page
+    :param table_regex: Compiled bytes pattern matching the table's opening tag
+    :return: Bytes from the table's opening tag through its closing tag,
+    or None if the page doesn't have the table
+    """
+    table_start = table_regex.search(page)
+    if table_start is None:
+        return None
+    table_end = page.find(b'</table>', table_start.end())
+    # A truncated page is handed over as is, the parser copes with it
+    if table_end == -1:
+        return page[table_start.start():]
+    return page[table_start.start():table_end + len(b'</table>')]
+
+
+def parse_rows_bs4(fragment):
+    """ Parser backend using BeautifulSoup's pure python html.parser.
+    Always available, but the slowest backend.
+
+    :param fragment: String containing the weather history table
+    :return: List of rows, each a list of the text of its cells
+    """
+    from bs4 import BeautifulSoup
+    table = BeautifulSoup(fragment, 'html.parser')
+    return [[cell.get_text() for cell in row.find_all(['td', 'th'], recursive=False)]
+            for row in table.find_all('tr')]
+
+
+def parse_rows_lxml(fragment):
+    """ Parser backend using lxml's C html parser.
+
+    :param fragment: String containing the weather history table
+    :return: List of rows, each a list of the text of its cells
+    """
+    import lxml.html
+    table = lxml.html.fragment_fromstring(fragment)
+    return [[cell.text_content() for cell in row.iterchildren('td', 'th')]
+            for row in table.iter('tr')]
+
+
+# Parser backends by name, from fastest to slowest
+PARSERS = {'lxml': parse_rows_lxml, 'bs4': parse_rows_bs4}
+
+
+def get_parser(name=None):
+    """ Looks up a parser backend.  lxml is an optional dependency, so when
+    no name is given it is used if installed and bs4 is used otherwise.
+
+    :param name: Name of a backend in PARSERS, or None for the fastest
+    :return: The backend function
+    """
+    if name is not None:
+        return PARSERS[name]
+    try:
+        import lxml.html
+    except ImportError:
+        return parse_rows_bs4
+    return parse_rows_lxml
+
+
+def compile_field_spec(spec):
+    """ Compiles a field spec, mapping each row label to the columns to
+    read from that row, into the dispatch table used by extract_fields.
+    Labels are stripped so they can be matched against cell text directly,
+    and each row's columns are sorted with the highest index kept so short
+    rows (like section headings sharing a data row's label) can be skipped.
+
+    :param spec: Dictionary of row label -> ((column index, output key), ...)
+    :return: Dictionary of row label -> (highest column index, columns)
+    """
+    dispatch = dict()
+    for label, columns in spec.items():
+        columns = tuple(sorted(columns))
+        dispatch[label.strip()] = (columns[-1][0], columns)
+    return dispatch
+
+
+# The compiled dispatch tables for the field specs.  ACTUAL_FIELDS only
+# reads the Actual column of the temperature rows, for callers which get
+# the Average and Record columns elsewhere (see ClimatologyTable).
+TEMPERATURE_FIELDS = compile_field_spec(TEMPERATURE_FIELD_SPEC)
+ALL_FIELDS = compile_field_spec(dict(TEMPERATURE_FIELD_SPEC, **EXTRA_FIELD_SPEC))
+ACTUAL_FIELDS = compile_field_spec(dict(
+    (label, tuple(column for column in columns if column[0] == 1))
+    for label, columns in TEMPERATURE_FIELD_SPEC.items()))
+# Output keys of the Average and Record columns, which depend only on the
+# station and the day of the year
+CLIMATOLOGY_KEYS = frozenset(key for columns in TEMPERATURE_FIELD_SPEC.values()
+                             for column, key in columns if column != 1)
+
+
+def extract_fields(rows, fields=None):
+    """ Helper function for parse_weather_page.
+    Checks that the table has all the headers we require and parses the
+    fields out of its rows, both in a single pass over the rows.  Each row
+    is looked up in the compiled dispatch table by its label, so only the
+    cells which are wanted are ever cleaned.  The pass stops as soon as
+    every header and field has been found, so a narrow field spec like
+    ACTUAL_FIELDS never looks at the rest of the table.
+
+    :param rows: List of rows, each a list of the text of its cells
+    :param fields: Compiled field spec, TEMPERATURE_FIELDS if not provided
+    :return: Dictionary of output key -> formatted cell text
+    :raises ParseError: If the table is missing a required header
+    """
+    if fields is None:
+        fields = TEMPERATURE_FIELDS
+    wanted = sum(len(columns) for _, columns in fields.values())
+    actual_header = False
+    average_header = False
+    record_header = False
+    all_headers = False
+    field_dict = dict()
+    for cells in rows:
+        if not cells:
+            continue
+        field = fields.get(cells[0].strip())
+        if field is None:
+            # Not a data row we want, look for the header keywords
+            # until they've all been seen
+            if not all_headers:
+                row_text = ''.join(cells)
+                if 'Actual' in row_text:
+                    actual_header = True
+                if 'Average' in row_text:
+                    average_header = True
+                if 'Record' in row_text:
+                    record_header = True
+                all_headers = actual_header and average_header and record_header
+            continue
+        highest_column, columns = field
+        if len(cells) <= highest_column:
+            continue
+        for column, key in columns:
+            field_dict[key] = clean_cell_text(cells[column])
+        if all_headers and len(field_dict) == wanted:
+            break
     # Check to make sure the table has all the headers we require
-    if not table_is_complete(history_table_rows):
-        return '{"error": "Table does not have all required headers"}'
+    if not all_headers:
+        raise ParseError('Table does not have all required headers')
+    return field_dict
 
-    # Parse the data from each row with information we care about,
-    # and store it in a dictionary
-    temperature_dict = dict()
-    for row in history_table_rows:
-        row_text = row.get_text()
-        if 'Mean Temperature' in row_text:
-            cells = row.findAll('td')
-            temperature_dict['Actual Mean Temperature'] = get_cell_data(cells[1])
-            temperature_dict['Average Mean Temperature'] = get_cell_data(cells[2])
-        elif 'Max Temperature' in row_text:
-            cells = row.findAll('td')
-            temperature_dict['Actual Max Temperature'] = get_cell_data(cells[1])
-            temperature_dict['Average Max Temperature'] = get_cell_data(cells[2])
-            temperature_dict['Record Max Temperature'] = get_cell_data(cells[3])
-        elif 'Min Temperature' in row_text:
-            cells = row.findAll('td')
-            temperature_dict['Actual Min Temperature'] = get_cell_data(cells[1])
-            temperature_dict['Average Min Temperature'] = get_cell_data(cells[2])
-            temperature_dict['Record Min Temperature'] = get_cell_data(cells[3])
-    # Convert the temperature_dict to a json string and return it
-    return json.dumps(temperature_dict, sort_keys=True)
+
+def parse_reading(text):
+    """ Splits the formatted text of a cell into its numeric parts,
+    e.g. '104F (1999)' -> (104, 'F', 1999).
+
+    :param text: Formatted cell text, as returned by clean_cell_text
+    :return: Tuple of (value, unit, year), with None for any part which
+    isn't there.  Value is None for blank or unreadable cells.
+    """
+    reading = READING_REGEX.search(text)
+    if reading is None:
+        return None, None, None
+    value, unit, year = reading.groups()
+    value = float(value) if '.' in value else int(value)
+    return value, unit or None, int(year) if year else None
+
+
+def build_weather_record(field_dict):
+    """ Converts the text parsed out of the weather history table into a
+    WeatherRecord of numbers.
+
+    :param field_dict: Dictionary of output key -> formatted cell text,
+    as parsed with TEMPERATURE_FIELDS
+    :return: WeatherRecord of the temperatures
+    """
+    readings = dict((key, parse_reading(text)) for key, text in field_dict.items())
+    missing = (None, None, None)
+    # Every temperature on a page shares one unit
+    unit = None
+    for _, reading_unit, _ in readings.values():
+        if reading_unit:
+            unit = reading_unit
+            break
+    record_max = readings.get('Record Max Temperature', missing)
+    record_min = readings.get('Record Min Temperature', missing)
+    return WeatherRecord(
+        actual_mean=readings.get('Actual Mean Temperature', missing)[0],
+        average_mean=readings.get('Average Mean Temperature', missing)[0],
+        actual_max=readings.get('Actual Max Temperature', missing)[0],
+        average_max=readings.get('Average Max Temperature', missing)[0],
+        record_max=record_max[0],
+        record_max_year=record_max[2],
+        actual_min=readings.get('Actual Min Temperature', missing)[0],
+        average_min=readings.get('Average Min Temperature', missing)[0],
+        record_min=record_min[0],
+        record_min_year=record_min[2],
+        unit=unit)
+
+
+def record_is_broken(field_dict):
+    """ Checks whether a day's actual temperatures beat the records shown
+    with them, which means the records came from before the day happened
+    (e.g. out of a ClimatologyTable) and are out of date.
+
+    :param field_dict: Dictionary of output key -> formatted cell text
+    :return: True if the actual max is above the record max or the actual
+    min is below the record min
+    """
+    actual_max = parse_reading(field_dict.get('Actual Max Temperature', ''))[0]
+    record_max = parse_reading(field_dict.get('Record Max Temperature', ''))[0]
+    if actual_max is not None and record_max is not None and actual_max > record_max:
+        return True
+    actual_min = parse_reading(field_dict.get('Actual Min Temperature', ''))[0]
+    record_min = parse_reading(field_dict.get('Record Min Temperature', ''))[0]
+    return actual_min is not None and record_min is not None and actual_min < record_min
+
+
+def parse_range_response(response, results_url, start_date, end_date):
+    """ Checks the response's status code and parses each day's fields out
+    of a Monthly or Custom history page.  See parse_weather_response.
+
+    :param response: requests.Response for the range's page
+    :param results_url: The url which was requested, used in error messages
+    :param start_date: First datetime.date of the range
+    :param end_date: Last datetime.date of the range
+    :return: Dictionary of datetime.date -> dictionary of output key ->
+    formatted cell text
+    :raises StatusCodeError: If the response wasn't a 200
+    :raises ParseError: If the page doesn't have the range table
+    :raises RequestError: If the connection failed while reading the page
+    """
+    fragment = read_response_table(response, results_url, RANGE_TABLE_REGEX)
+    return parse_range_table(fragment, start_date, end_date,
+                             encoding=response.encoding)
+
+
+def parse_range_page(page, results_url, start_date, end_date, parser=None,
+                     encoding=None):
+    """ Parses each day's temperatures out of the raw bytes of a Monthly or
+    Custom history page.  Like parse_weather_page only the range table is
+    sliced out and parsed.
+
+    :param page: Raw bytes of the range's page
+    :param results_url: The url which was requested, used in error messages
+    :param start_date: First datetime.date wanted, earlier days are skipped
+    :param end_date: Last datetime.date wanted, later days are skipped
+    :param parser: Name of the parser backend in PARSERS to use,
+    the fastest one installed is used if not provided
+    :param encoding: Encoding of the page, utf-8 if not provided
+    :return: Dictionary of datetime.date -> dictionary of output key ->
+    formatted cell text
+    :raises ParseError: If the page doesn't have the range table
+    """
+    fragment = slice_table(page, RANGE_TABLE_REGEX)
+    if fragment is None:
+        raise missing_table_error(results_url)
+    return parse_range_table(fragment, start_date, end_date, parser, encoding)
+
+
+def parse_range_table(fragment, start_date, end_date, parser=None,
+                      encoding=None):
+    """ Parses each day's fields out of the range table's bytes.
+    See parse_history_table.
+
+    :param fragment: Bytes of the range table
+    :param start_date: First datetime.date wanted
+    :param end_date: Last datetime.date wanted
+    :param parser: Name of the parser backend in PARSERS to use,
+    the fastest one installed is used if not provided
+    :param encoding: Encoding of the page, utf-8 if not provided
+    :return: Dictionary of datetime.date -> dictionary of output key ->
+    formatted cell text
+    """
+    with METRICS.timer('parse'):
+        rows = get_parser(parser)(fragment.decode(encoding or 'utf-8', 'replace'))
+    with METRICS.timer('extract'):
+        return extract_range_fields(rows, start_date, end_date)
+
+
+def extract_range_fields(rows, start_date, end_date):
+    """ Helper function for parse_range_page.
+    Walks the rows of the range table.  The first header row starts with
+    the year and names the temperature unit, each month's header row starts
+    with the month's name, and every other row is a day starting with the
+    day of the month.  Values are formatted like the daily view's, e.g. '86F'.
+
+    :param rows: List of rows, each a list of the text of its cells
+    :param start_date: First datetime.date wanted
+    :param end_date: Last datetime.date wanted
+    :return: Dictionary of datetime.date -> dictionary of output key ->
+    formatted cell text
+    """
+    highest_column = RANGE_FIELD_SPEC[-1][0]
+    year = None
+    month = None
+    unit = ''
+    days = dict()
+    for cells in rows:
+        if not cells:
+            continue
+        label = cells[0].strip()
+        if YEAR_REGEX.search(label):
+            year = int(label)
+            unit_match = RANGE_UNIT_REGEX.search(''.join(cells))
+            if unit_match:
+                unit = unit_match.group(1)
+        elif label in MONTH_NUMBERS:
+            month = MONTH_NUMBERS[label]
+        elif DAY_REGEX.search(label) and year is not None and month is not None \
+                and len(cells) > highest_column:
+            try:
+                date = datetime.date(year, month, int(label))
+            except ValueError:
+                continue
+            if start_date <= date <= end_date:
+                day = dict()
+                for column, key in RANGE_FIELD_SPEC:
+                    text = clean_cell_text(cells[column])
+                    # Missing days are shown as '-', leave those blank
+                    day[key] = text + unit if text[-1:].isdigit() else ''
+                days[date] = day
+    return days
+
+
+class WeatherColumns(object):
+    """ Accumulates WeatherRecords for many days column by column in
+    contiguous arrays, rather than holding an object per day.  Numeric
+    columns are arrays of doubles with NaN for missing values, record
+    years are arrays of ints with 0 for missing years.
+    """
+    value_columns = ('actual_mean', 'average_mean', 'actual_max',
+                     'average_max', 'record_max', 'actual_min',
+                     'average_min', 'record_min')
+    year_columns = ('record_max_year', 'record_min_year')
+
+    def __init__(self):
+        self.locations = []
+        self.units = []
+        # Dates are stored as proleptic Gregorian ordinals
+        self.dates = array.array('l')
+        self.columns = dict((name, array.array('d')) for name in self.value_columns)
+        self.columns.update((name, array.array('l')) for name in self.year_columns)
+
+    def append(self, location, date, record):
+        """ Adds one day's record to the end of every column.
+
+        :param location: Location the record was scraped for
+        :param date: datetime.date the record was scraped for
+        :param record: WeatherRecord to add
+        """
+        self.locations.append(location)
+        self.units.append(record.unit)
+        self.dates.append(date.toordinal())
+        for name in self.value_columns:
+            value = getattr(record, name)
+            self.columns[name].append(float('nan') if value is None else value)
+        for name in self.year_columns:
+            self.columns[name].append(getattr(record, name) or 0)
+
+    def __len__(self):
+        return len(self.dates)
+
+    def to_numpy(self):
+        """ Wraps every column in a NumPy array without copying it.
+        Requires NumPy, which is an optional dependency.
+
+        :return: Dictionary of column name -> numpy.ndarray, including
+        'dates' as datetime64[D]
+        """
+        import numpy
+        arrays = dict((name, numpy.frombuffer(column, dtype=column.typecode))
+                      for name, column in self.columns.items())
+        # Ordinal 719163 is 1970-01-01, the datetime64 epoch
+        arrays['dates'] = (numpy.frombuffer(self.dates, dtype=self.dates.typecode)
+                           - 719163).astype('datetime64[D]')
+        return arrays
 
 
 def table_is_complete(table_rows):
@@ -311,14 +1428,3308 @@ def get_cell_data(cell):
     :param cell: A cell from the table containing temperature data
     :return temperature: String with the formatted temperature value
     """
-    temperature = cell.get_text().strip()
-    temperature = temperature.replace('\xa0', '')
-    temperature = temperature.replace('\n', ' ')
-    temperature = temperature.replace('°', '')
-    return temperature
+    return clean_cell_text(cell.get_text())
 
 
-if __name__ == '__main__':
+def clean_cell_text(text):
+    """ Formats the text of a cell containing temperature data.
+
+    :param text: The text of a cell from the table
+    :return temperature: String with the formatted temperature value
+    """
+    # Chained replaces measure faster than str.translate on strings this short
+    return text.strip().replace('\xa0', '').replace('\n', ' ').replace('°', '')
+
+
+class RateLimiter(object):
+    """ Paces and protects the requests sent to each host, no matter how
+    many threads are fetching.  Each host gets its own state, so a slow or
+    failing host never holds back requests headed somewhere else.
+    * A token bucket spaces requests out to the host's current rate,
+      letting up to 'burst' of them go at once.
+    * The rate adapts to how the host copes (AIMD): it is halved whenever
+      the host answers 429/503 or slower than latency_target, and creeps
+      back up by about one request per second every second while it
+      doesn't.  No response raises it by more than max_increase, so a host
+      slowed right down recovers gradually instead of being sent the full
+      rate again after its first success.  A host without a limit is left
+      unlimited until it first pushes back, then starts at half the rate
+      it was being sent.
+    * A circuit breaker pauses a host after failure_threshold failures in
+      a row.  Requests wait out the cooldown, then a single trial request
+      goes through: success closes the breaker, failure doubles the
+      cooldown up to max_cooldown.
+    fetch_limited reports each request's outcome back with record or
+    record_failure.
+    """
+
+    def __init__(self, rate=None, burst=1, adaptive=True, min_rate=0.1,
+                 latency_target=2.0, hold=1.0, failure_threshold=5,
+                 cooldown=5.0, max_cooldown=300.0, max_increase=0.1):
+        """ :param rate: Maximum requests per second for each host,
+        None or 0 for no limit
+        :param burst: Number of requests a host may be sent at once
+        :param adaptive: Adapt each host's rate to its responses
+        :param min_rate: Lowest rate a host is slowed down to
+        :param latency_target: Seconds a response may take before it counts
+        as the host pushing back
+        :param hold: Seconds after slowing a host down before it can be
+        slowed again, so one episode of pushback halves the rate only once
+        :param failure_threshold: Failures in a row which pause a host
+        :param cooldown: Seconds a host is first paused for
+        :param max_cooldown: Longest a host is paused for
+        :param max_increase: Most requests per second a single successful
+        response raises a host's rate by
+        """
+        self.rate = rate or None
+        self.burst = burst
+        self.adaptive = adaptive
+        self.min_rate = min_rate
+        self.latency_target = latency_target
+        self.hold = hold
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.max_increase = max_increase
+        self._hosts = dict()
+        self._condition = threading.Condition()
+
+    def host(self, url):
+        """ :param url: A url about to be, or just, requested
+        :return: HostState of the url's host
+        """
+        import urllib.parse
+        host = urllib.parse.urlsplit(url).netloc
+        state = self._hosts.get(host)
+        if state is None:
+            state = self._hosts[host] = HostState(self.rate)
+        return state
+
+    def rate_of(self, url):
+        """ :param url: Any url on the host
+        :return: The host's current requests per second, None if unlimited
+        """
+        with self._condition:
+            return self.host(url).rate
+
+    def wait(self, url):
+        """ Blocks the calling thread until the url's host may be sent
+        another request.
+
+        :param url: The url about to be requested
+        """
+        with self._condition:
+            state = self.host(url)
+            # Wait out an open circuit breaker, then let one trial through
+            while state.open_until is not None:
+                now = time.monotonic()
+                if now < state.open_until:
+                    self._condition.wait(state.open_until - now)
+                elif not state.trial:
+                    state.trial = True
+                    break
+                else:
+                    self._condition.wait(self.cooldown)
+            # Reserve the next free slot while holding the lock,
+            # but do the sleeping outside of it
+            now = time.monotonic()
+            slot = now
+            if state.rate:
+                interval = 1.0 / state.rate
+                next_slot = state.next_slot or now
+                # The bucket holds 'burst' tokens, so a request may go up
+                # to burst - 1 intervals ahead of the schedule
+                slot = max(now, next_slot - (self.burst - 1) * interval)
+                state.next_slot = max(slot, next_slot) + interval
+            if state.last_slot is not None:
+                gap = slot - state.last_slot
+                state.gap_average = gap if state.gap_average is None \
+                    else state.gap_average * 0.8 + gap * 0.2
+            state.last_slot = slot
+        if slot > now:
+            time.sleep(slot - now)
+
+    def record(self, url, response):
+        """ Reports a response to the limiter.  429 and 5xx responses
+        (including ones retried away by the Fetcher) slow the host down,
+        and a final 429 or 5xx counts as a failure.
+
+        :param url: The url which was requested
+        :param response: requests.Response for it
+        """
+        statuses = []
+        latency = 0.0
+        for hop in response.history + [response]:
+            statuses.append(hop.status_code)
+            latency = max(latency, hop.elapsed.total_seconds())
+            retries = getattr(hop.raw, 'retries', None)
+            if retries is not None:
+                statuses.extend(attempt.status for attempt in retries.history
+                                if attempt.status is not None)
+        pushback = latency > self.latency_target or \
+            any(status == 429 or status >= 500 for status in statuses)
+        failed = response.status_code == 429 or response.status_code >= 500
+        with self._condition:
+            state = self.host(url)
+            if failed:
+                self.fail(state)
+            else:
+                state.failures = 0
+                state.open_until = None
+                state.trial = False
+                state.paused_for = 0.0
+            if pushback:
+                self.slow_down(state)
+            elif state.rate is not None and self.adaptive:
+                # Additive increase, about one request per second more for
+                # every second of requests but less while the rate is low
+                state.rate += min(1.0 / state.rate, self.max_increase)
+                if self.rate is not None:
+                    state.rate = min(state.rate, self.rate)
+            self._condition.notify_all()
+
+    def record_failure(self, url):
+        """ Reports a request which got no response at all (a timeout or a
+        connection error), which both slows the host down and counts as
+        a failure.
+
+        :param url: The url which was requested
+        """
+        with self._condition:
+            state = self.host(url)
+            self.fail(state)
+            self.slow_down(state)
+            self._condition.notify_all()
+
+    def fail(self, state):
+        """ Counts a failure against a host, opening its circuit breaker
+        once there are too many in a row or when its trial request failed.
+        Called with the lock held.
+
+        :param state: HostState of the host
+        """
+        state.failures += 1
+        if state.trial or state.failures >= self.failure_threshold:
+            state.paused_for = min(state.paused_for * 2, self.max_cooldown) \
+                if state.paused_for else self.cooldown
+            state.open_until = time.monotonic() + state.paused_for
+            state.trial = False
+            METRICS.count('circuit_opens_total')
+
+    def slow_down(self, state):
+        """ Halves a host's rate (multiplicative decrease), unless it was
+        already slowed down within the last 'hold' seconds.  Called with the
+        lock held.
+
+        :param state: HostState of the host
+        """
+        now = time.monotonic()
+        if not self.adaptive or now - state.slowed_at < self.hold:
+            return
+        rate = state.rate
+        if rate is None:
+            # Never limited before, start from the rate it was being sent
+            rate = 1.0 / state.gap_average if state.gap_average else self.min_rate
+        state.rate = max(self.min_rate, rate / 2.0)
+        state.slowed_at = now
+        METRICS.count('rate_decreases_total')
+
+
+class HostState(object):
+    """ What a RateLimiter keeps for each host.
+    """
+
+    def __init__(self, rate):
+        """ :param rate: Requests per second to start the host at,
+        None for no limit
+        """
+        self.rate = rate
+        # When the token bucket next has a token to spare
+        self.next_slot = None
+        # Spacing of the requests sent, to find where to start limiting
+        # a host which had no limit
+        self.last_slot = None
+        self.gap_average = None
+        self.slowed_at = -float('inf')
+        # Circuit breaker
+        self.failures = 0
+        self.open_until = None
+        self.trial = False
+        self.paused_for = 0.0
+
+
+class StationTable(object):
+    """ Remembers which station each location's findweather url redirects
+    to, e.g. 'Atlanta, GA' -> '/history/airport/KFTY'.  The station is the
+    same for every date, so once it is known later dates are requested
+    straight from the station's DailyHistory url, skipping the redirect.
+    The table can be preloaded, inspected with items(), and persisted as a
+    json file so it carries over between runs.  Safe to share between
+    threads.
+    """
+    # Matches the station part of a resolved history url path
+    station_regex = re.compile(r'^(/history/[^/]+/[^/]+)/\d{4}/\d{1,2}/\d{1,2}/'
+                               r'(?:Daily|Monthly|Custom)History\.html$')
+
+    def __init__(self, path=None):
+        """ :param path: Optional json file to load the table from and save
+        it to whenever a new station is recorded
+        """
+        self.path = path
+        self._stations = dict()
+        self._lock = threading.Lock()
+        if path is not None:
+            try:
+                with open(path) as stations_file:
+                    self._stations = json.load(stations_file)
+            except FileNotFoundError:
+                pass
+
+    def get(self, location):
+        """ :param location: Validated location string
+        :return: The location's station path, or None if not known yet
+        """
+        return self._stations.get(location_key(location))
+
+    def record(self, location, resolved_url):
+        """ Records the station a location's findweather url redirected to.
+
+        :param location: Validated location string
+        :param resolved_url: Final url of the redirected request
+        :return: The station path, or None if the url isn't a history url
+        """
+        import urllib.parse
+        path = urllib.parse.urlsplit(resolved_url).path
+        station = self.station_regex.search(path)
+        if station is None:
+            return None
+        with self._lock:
+            self._stations[location_key(location)] = station.group(1)
+            self.save()
+        return station.group(1)
+
+    def preload(self, stations):
+        """ Adds known stations to the table.
+
+        :param stations: Dictionary mapping locations to station paths
+        """
+        with self._lock:
+            for location, station in stations.items():
+                self._stations[location_key(location)] = station
+            self.save()
+
+    def items(self):
+        """ :return: Sorted list of (location, station path) pairs
+        """
+        with self._lock:
+            return sorted(self._stations.items())
+
+    def save(self):
+        """ Writes the table to its json file, if it has one.  The file may
+        be shared by several processes (e.g. --work), so it is re-read under
+        a lock and the stations other processes recorded are merged in
+        before writing.  Writes to a temporary file of this process first so
+        a crash can't leave a half written table.
+        """
+        if self.path is None:
+            return
+        with FileLock(self.path + '.lock'):
+            try:
+                with open(self.path) as stations_file:
+                    stations = json.load(stations_file)
+            except FileNotFoundError:
+                stations = dict()
+            stations.update(self._stations)
+            self._stations = stations
+            temporary_path = '%s.%s.tmp' % (self.path, os.getpid())
+            with open(temporary_path, 'w') as stations_file:
+                json.dump(stations, stations_file, indent=2, sort_keys=True)
+            os.replace(temporary_path, self.path)
+
+
+class FileLock(object):
+    """ Holds an exclusive lock on a lock file, so that processes sharing
+    a file can take turns updating it.  Uses fcntl where it is available
+    and msvcrt on Windows.
+    """
+
+    def __init__(self, path):
+        """ :param path: Lock file, created if missing
+        """
+        self.path = path
+        self._file = None
+
+    def __enter__(self):
+        self._file = open(self.path, 'a')
+        try:
+            import fcntl
+        except ImportError:
+            import msvcrt
+            self._file.seek(0)
+            # Retries for up to 10 seconds before raising
+            msvcrt.locking(self._file.fileno(), msvcrt.LK_LOCK, 1)
+        else:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc_info):
+        try:
+            import fcntl
+        except ImportError:
+            import msvcrt
+            self._file.seek(0)
+            msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+        self._file.close()
+        self._file = None
+
+
+def get_station_url(station, search_day, search_month, search_year,
+                    base_url=WUNDERGROUND_URL):
+    """ Creates the DailyHistory url for a station which is already known,
+    so no redirect is needed to reach the results page.
+
+    :param station: Station path recorded by a StationTable
+    :param search_day: validated string for day that exists
+    :param search_month: validated string for month which exists
+    :param search_year: validated string for year which exists
+    :param base_url: Scheme and host the url should point at
+    :return: The url of the results page
+    """
+    return '%s%s/%s/%s/%s/DailyHistory.html' \
+           % (base_url, station, search_year, search_month, search_day)
+
+
+def get_station_range_url(station, start_date, end_date,
+                          base_url=WUNDERGROUND_URL):
+    """ Creates the Monthly or Custom history url for a station which is
+    already known, so no redirect is needed to reach the range's page.
+
+    :param station: Station path recorded by a StationTable
+    :param start_date: First datetime.date of the range
+    :param end_date: Last datetime.date of the range, in the same month
+    :param base_url: Scheme and host the url should point at
+    :return: The url of the range's page
+    """
+    history_type, query = get_range_view(start_date, end_date)
+    url = '%s%s/%s/%s/%s/%s.html' % (base_url, station, start_date.year,
+                                     start_date.month, start_date.day,
+                                     history_type)
+    if query:
+        url += '?' + query
+    return url
+
+
+def location_key(location):
+    """ Normalizes a validated location the same way get_url formats it,
+    and ignores capitalization, so that 'Atlanta, GA' and 'atlanta, ga'
+    share cache entries.
+
+    :param location: Validated location string
+    :return: Normalized location string
+    """
+    return location.replace(' ', '+').upper()
+
+
+class PageCache(object):
+    """ A persistent SQLite cache of scraped results keyed by the
+    normalized location and date.  The parsed json is stored rather than
+    the page, so a cache hit skips both the network and BeautifulSoup.
+    A result fetched once its date was over (everywhere, see
+    settle_seconds) never changes on wunderground and never expires.  One
+    fetched while its date was still filling in is partial and expires
+    after 'today_ttl' seconds, even once the date is in the past.
+    Once more than 'max_entries' results are stored the least recently
+    used ones are evicted.  Hits don't write to the database one by one,
+    when they were used is kept in memory and written in batches of
+    'touch_batch', and before every put so that eviction sees it.
+    Safe to share between threads.
+    """
+
+    def __init__(self, path, max_entries=1000000, today_ttl=3600,
+                 settle_seconds=24 * 3600, touch_batch=256):
+        """ :param path: File to keep the cache in, created if missing
+        :param max_entries: Most results to keep before evicting
+        :param today_ttl: Seconds a result fetched before its date was
+        over stays fresh
+        :param settle_seconds: Seconds after a date ends here before a
+        result for it is final, which covers stations in time zones behind
+        this machine's
+        :param touch_batch: Number of hits to gather before writing when
+        they were used
+        """
+        self.max_entries = max_entries
+        self.today_ttl = today_ttl
+        self.settle_seconds = settle_seconds
+        self.touch_batch = touch_batch
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # Maps the key of each result hit since the last write to when
+        self._touches = dict()
+        import sqlite3
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS pages ('
+            'location TEXT NOT NULL, date TEXT NOT NULL, data TEXT NOT NULL, '
+            'fetched_at REAL NOT NULL, accessed_at REAL NOT NULL, '
+            'PRIMARY KEY (location, date))')
+        self._connection.execute(
+            'CREATE INDEX IF NOT EXISTS pages_accessed_at ON pages (accessed_at)')
+        self._connection.commit()
+        self._size = self._connection.execute(
+            'SELECT COUNT(*) FROM pages').fetchone()[0]
+
+    def get(self, location, date):
+        """ Looks up the cached result for a location and date.
+
+        :param location: Validated location string
+        :param date: datetime.date of the result
+        :return: The cached json string, or None on a miss
+        """
+        key = (location_key(location), date.isoformat())
+        now = time.time()
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT data, fetched_at FROM pages WHERE location = ? AND date = ?',
+                key).fetchone()
+            # Partial results are only good until the ttl runs out
+            if row is None or not self.is_fresh(date, row[1], now):
+                self.misses += 1
+                METRICS.count('cache_requests_total', cache='page', result='miss')
+                return None
+            self._touches[key] = now
+            if len(self._touches) >= self.touch_batch:
+                self._write_touches()
+                self._connection.commit()
+            self.hits += 1
+            METRICS.count('cache_requests_total', cache='page', result='hit')
+            return row[0]
+
+    def put(self, location, date, json_data):
+        """ Stores the result for a location and date, evicting the least
+        recently used results if the cache has grown too large.
+
+        :param location: Validated location string
+        :param date: datetime.date of the result
+        :param json_data: json string returned by scrape_weather_data
+        """
+        key = (location_key(location), date.isoformat())
+        now = time.time()
+        with self._lock:
+            self._write_touches()
+            cursor = self._connection.execute(
+                'INSERT OR IGNORE INTO pages VALUES (?, ?, ?, ?, ?)',
+                key + (json_data, now, now))
+            if cursor.rowcount:
+                self._size += 1
+            else:
+                self._connection.execute(
+                    'UPDATE pages SET data = ?, fetched_at = ?, accessed_at = ? '
+                    'WHERE location = ? AND date = ?', (json_data, now, now) + key)
+            if self._size > self.max_entries:
+                self._connection.execute(
+                    'DELETE FROM pages WHERE rowid IN (SELECT rowid FROM pages '
+                    'ORDER BY accessed_at LIMIT ?)', (self._size - self.max_entries,))
+                self._size = self.max_entries
+            self._connection.commit()
+
+    def _write_touches(self):
+        """ Writes when the results hit since the last write were used,
+        without committing.  The lock must be held.
+        """
+        if self._touches:
+            self._connection.executemany(
+                'UPDATE pages SET accessed_at = ? WHERE location = ? AND date = ?',
+                [(accessed_at,) + key for key, accessed_at in self._touches.items()])
+            self._touches.clear()
+
+    def cached_dates(self, location, start_date, end_date):
+        """ Finds which dates of a range have fresh results cached for a
+        location, without counting hits or misses.
+
+        :param location: Validated location string
+        :param start_date: First datetime.date of the range
+        :param end_date: Last datetime.date of the range
+        :return: Set of datetime.date
+        """
+        now = time.time()
+        with self._lock:
+            rows = self._connection.execute(
+                'SELECT date, fetched_at FROM pages WHERE location = ? AND '
+                'date BETWEEN ? AND ?', (location_key(location),
+                                         start_date.isoformat(),
+                                         end_date.isoformat())).fetchall()
+        dates = set()
+        for date_string, fetched_at in rows:
+            date = read_iso_date(date_string)
+            if self.is_fresh(date, fetched_at, now):
+                dates.add(date)
+        return dates
+
+    def is_fresh(self, date, fetched_at, now):
+        """ :param date: datetime.date of a result
+        :param fetched_at: Time the result was fetched at
+        :param now: The current time
+        :return: True if the result was fetched after its date was over,
+        or is partial but younger than today_ttl
+        """
+        ended = time.mktime((date + datetime.timedelta(days=1)).timetuple())
+        return fetched_at >= ended + self.settle_seconds \
+            or now - fetched_at <= self.today_ttl
+
+    def discard(self, location, date):
+        """ Drops the cached result for a location and date, so that it is
+        fetched again.
+
+        :param location: Validated location string
+        :param date: datetime.date of the result
+        """
+        with self._lock:
+            cursor = self._connection.execute(
+                'DELETE FROM pages WHERE location = ? AND date = ?',
+                (location_key(location), date.isoformat()))
+            self._size -= cursor.rowcount
+            self._connection.commit()
+
+    def stats(self):
+        """ :return: Dictionary of the hit and miss counters
+        """
+        return {'hits': self.hits, 'misses': self.misses}
+
+    def close(self):
+        """ Writes any hits not written yet and closes the underlying
+        database.
+        """
+        with self._lock:
+            self._write_touches()
+            self._connection.commit()
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ClimatologyTable(object):
+    """ A persistent SQLite table of the Average and Record columns
+    (CLIMATOLOGY_KEYS) of each station's daily pages, keyed by the station
+    and the day of the year, so at most 366 entries per station.  These
+    columns are the same on a station-day's page whatever year is asked
+    for, so once known they are reused across years and only the Actual
+    column has to be read off later pages (see ACTUAL_FIELDS).
+    Entries are refetched after 'max_age' seconds to pick up new normals,
+    and invalidated early when an actual temperature beats the stored
+    record (see record_is_broken).  Safe to share between threads.
+    """
+
+    def __init__(self, path, max_age=30 * 24 * 3600):
+        """ :param path: File to keep the table in, created if missing
+        :param max_age: Seconds an entry is reused before it is refetched
+        """
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._lock = threading.Lock()
+        import sqlite3
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS climatology ('
+            'station TEXT NOT NULL, day TEXT NOT NULL, data TEXT NOT NULL, '
+            'fetched_at REAL NOT NULL, PRIMARY KEY (station, day))')
+        self._connection.commit()
+
+    def get(self, station, date):
+        """ Looks up the Average and Record columns of a station-day.
+
+        :param station: Station path, or location key if it isn't known
+        :param date: datetime.date of any year
+        :return: Dictionary of output key -> formatted cell text, or None
+        on a miss
+        """
+        key = (station, date.strftime('%m-%d'))
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT data, fetched_at FROM climatology '
+                'WHERE station = ? AND day = ?', key).fetchone()
+            if row is None or time.time() - row[1] > self.max_age:
+                self.misses += 1
+                METRICS.count('cache_requests_total', cache='climatology',
+                              result='miss')
+                return None
+            self.hits += 1
+            METRICS.count('cache_requests_total', cache='climatology', result='hit')
+            return json.loads(row[0])
+
+    def put(self, station, date, field_dict):
+        """ Stores the Average and Record columns read off a daily page.
+
+        :param station: Station path, or location key if it isn't known
+        :param date: datetime.date the page was for
+        :param field_dict: Dictionary of output key -> formatted cell text,
+        fields other than CLIMATOLOGY_KEYS are left out
+        """
+        climate = dict((key, text) for key, text in field_dict.items()
+                       if key in CLIMATOLOGY_KEYS)
+        if not climate:
+            return
+        with self._lock:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO climatology VALUES (?, ?, ?, ?)',
+                (station, date.strftime('%m-%d'),
+                 json.dumps(climate, sort_keys=True), time.time()))
+            self._connection.commit()
+
+    def invalidate(self, station, date):
+        """ Drops a station-day whose record has been broken, so that it
+        is read off the next daily page fetched for it.
+
+        :param station: Station path, or location key if it isn't known
+        :param date: datetime.date of any year
+        """
+        with self._lock:
+            self._connection.execute(
+                'DELETE FROM climatology WHERE station = ? AND day = ?',
+                (station, date.strftime('%m-%d')))
+            self._connection.commit()
+            self.invalidations += 1
+
+    def stats(self):
+        """ :return: Dictionary of the hit, miss and invalidation counters
+        """
+        return {'hits': self.hits, 'misses': self.misses,
+                'invalidations': self.invalidations}
+
+    def close(self):
+        """ Closes the underlying database.
+        """
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class HistoryStore(object):
+    """ A persistent SQLite store of every day scraped, so a run's results
+    can be queried again later without the network.  Each row holds a
+    location's WeatherRecord for one date as numbers, keyed (and so
+    indexed) by the normalized location and the date, so range queries and
+    aggregates over one location only ever read that location's rows.
+    The database is kept in WAL mode, so queries can run while a batch is
+    writing.  Writes are buffered and upserted batch_size at a time, and a
+    day stored again only overwrites the fields it has, so a range view
+    result doesn't wipe out the averages and records stored for that day.
+    Safe to share between threads.
+    """
+    # Columns after location and date, in WeatherRecord order
+    columns = WeatherRecord._fields
+    # Columns which may be compared against a threshold
+    value_columns = WeatherColumns.value_columns
+
+    def __init__(self, path, batch_size=500):
+        """ :param path: File to keep the store in, created if missing
+        :param batch_size: Number of days buffered before they are written
+        """
+        self.batch_size = batch_size
+        self._pending = []
+        self._lock = threading.Lock()
+        import sqlite3
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode = WAL')
+        # Safe in WAL mode, a crash can only lose the last transactions
+        self._connection.execute('PRAGMA synchronous = NORMAL')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS history ('
+            'location TEXT NOT NULL, date TEXT NOT NULL, '
+            'actual_mean REAL, average_mean REAL, actual_max REAL, '
+            'average_max REAL, record_max REAL, record_max_year INTEGER, '
+            'actual_min REAL, average_min REAL, record_min REAL, '
+            'record_min_year INTEGER, unit TEXT, '
+            'PRIMARY KEY (location, date)) WITHOUT ROWID')
+        self._connection.commit()
+        self._upsert = 'INSERT INTO history VALUES (?, ?, %s) ' \
+                       'ON CONFLICT (location, date) DO UPDATE SET %s' % (
+                           ', '.join('?' for _ in self.columns),
+                           ', '.join('%s = COALESCE(excluded.%s, %s)'
+                                     % (name, name, name) for name in self.columns))
+
+    def put(self, location, date, record):
+        """ Buffers one day's record, writing the buffer out once it holds
+        batch_size days.
+
+        :param location: Validated location string
+        :param date: datetime.date of the record
+        :param record: WeatherRecord to store
+        """
+        with self._lock:
+            self._pending.append((location_key(location), date.isoformat()) +
+                                 tuple(record))
+            if len(self._pending) >= self.batch_size:
+                self._flush()
+
+    def put_json(self, location, date, json_data):
+        """ Stores a scrape result, as returned by scrape_weather_data.
+        Errors are left out.
+
+        :param location: Validated location string
+        :param date: datetime.date of the result
+        :param json_data: json string of output key -> formatted cell text
+        """
+        field_dict = json.loads(json_data)
+        if 'error' not in field_dict:
+            self.put(location, date, build_weather_record(field_dict))
+
+    def flush(self):
+        """ Writes out every buffered day.
+        """
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        """ Writes out every buffered day in one transaction.
+        Called with the lock held.
+        """
+        if not self._pending:
+            return
+        with METRICS.timer('store'):
+            self._connection.executemany(self._upsert, self._pending)
+            self._connection.commit()
+        self._pending = []
+
+    def query(self, sql, parameters):
+        """ Runs a query after writing out the buffered days, so that they
+        are included.
+
+        :param sql: SQL to run
+        :param parameters: Tuple of its parameters
+        :return: List of rows
+        """
+        with self._lock:
+            self._flush()
+            return self._connection.execute(sql, parameters).fetchall()
+
+    def records(self, location, start_date, end_date):
+        """ Reads back every stored day of a location in a range.
+
+        :param location: Validated location string
+        :param start_date: First datetime.date of the range
+        :param end_date: Last datetime.date of the range
+        :return: List of (datetime.date, WeatherRecord) tuples in date order
+        """
+        rows = self.query('SELECT date, %s FROM history WHERE location = ? AND '
+                          'date BETWEEN ? AND ? ORDER BY date'
+                          % ', '.join(self.columns),
+                          (location_key(location), start_date.isoformat(),
+                           end_date.isoformat()))
+        return [(read_iso_date(row[0]), WeatherRecord(*row[1:])) for row in rows]
+
+    def stored_dates(self, location, start_date, end_date):
+        """ Finds which dates of a range are stored for a location.
+
+        :param location: Validated location string
+        :param start_date: First datetime.date of the range
+        :param end_date: Last datetime.date of the range
+        :return: Set of datetime.date
+        """
+        rows = self.query('SELECT date FROM history WHERE location = ? AND '
+                          'date BETWEEN ? AND ?',
+                          (location_key(location), start_date.isoformat(),
+                           end_date.isoformat()))
+        return set(read_iso_date(row[0]) for row in rows)
+
+    def aggregate(self, location, start_date, end_date):
+        """ Summarizes a location's actual temperatures over a range.
+
+        :param location: Validated location string
+        :param start_date: First datetime.date of the range
+        :param end_date: Last datetime.date of the range
+        :return: Dictionary with the number of 'days' stored, the lowest
+        actual min as 'min', the highest actual max as 'max' and the average
+        actual mean as 'mean', None for any which have no data
+        """
+        row = self.query('SELECT COUNT(*), MIN(actual_min), MAX(actual_max), '
+                         'AVG(actual_mean) FROM history WHERE location = ? AND '
+                         'date BETWEEN ? AND ?',
+                         (location_key(location), start_date.isoformat(),
+                          end_date.isoformat()))[0]
+        return {'days': row[0], 'min': row[1], 'max': row[2], 'mean': row[3]}
+
+    def days_above(self, location, start_date, end_date, threshold,
+                   column='actual_max'):
+        """ Finds the days in a range where a temperature was above a
+        threshold.
+
+        :param location: Validated location string
+        :param start_date: First datetime.date of the range
+        :param end_date: Last datetime.date of the range
+        :param threshold: Temperature the column must be above
+        :param column: One of value_columns, e.g. 'actual_mean'
+        :return: List of datetime.date in order
+        """
+        if column not in self.value_columns:
+            raise ValueError('Unknown column %s' % column)
+        rows = self.query('SELECT date FROM history WHERE location = ? AND '
+                          'date BETWEEN ? AND ? AND %s > ? ORDER BY date' % column,
+                          (location_key(location), start_date.isoformat(),
+                           end_date.isoformat(), threshold))
+        return [read_iso_date(row[0]) for row in rows]
+
+    def record_days(self, location, start_date, end_date):
+        """ Finds the days in a range which set a record.  A day set its
+        record max (or min) if its page shows the record as set in the
+        day's own year, or if its actual temperature beat the record shown.
+
+        :param location: Validated location string
+        :param start_date: First datetime.date of the range
+        :param end_date: Last datetime.date of the range
+        :return: List of (datetime.date, 'max' or 'min') tuples in date order
+        """
+        year = 'CAST(substr(date, 1, 4) AS INTEGER)'
+        rows = self.query(
+            'SELECT date, actual_max, record_max, record_max_year = %s, '
+            'actual_min, record_min, record_min_year = %s FROM history '
+            'WHERE location = ? AND date BETWEEN ? AND ? AND ('
+            'record_max_year = %s OR actual_max > record_max OR '
+            'record_min_year = %s OR actual_min < record_min) ORDER BY date'
+            % (year, year, year, year),
+            (location_key(location), start_date.isoformat(), end_date.isoformat()))
+        results = []
+        for date, actual_max, record_max, max_set, actual_min, record_min, \
+                min_set in rows:
+            date = read_iso_date(date)
+            if max_set or (actual_max is not None and record_max is not None
+                           and actual_max > record_max):
+                results.append((date, 'max'))
+            if min_set or (actual_min is not None and record_min is not None
+                           and actual_min < record_min):
+                results.append((date, 'min'))
+        return results
+
+    def close(self):
+        """ Writes out the buffered days and closes the underlying database.
+        """
+        self.flush()
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+ArchiveEntry = collections.namedtuple('ArchiveEntry', [
+    'location', 'kind', 'start_date', 'end_date', 'segment', 'offset',
+    'length', 'codec', 'encoding'])
+
+
+def get_page_codec():
+    """ Picks how PageArchive compresses the pages it appends.  zstandard
+    is an optional dependency, it is used when installed as it compresses
+    html about as well as zlib at several times the speed, and zlib is used
+    otherwise.
+
+    :return: Name of the codec, 'zstd' or 'zlib'
+    """
+    try:
+        import zstandard
+    except ImportError:
+        return 'zlib'
+    return 'zstd'
+
+
+def compress_page(data, codec):
+    """ :param data: Bytes to compress
+    :param codec: Name of the codec, see get_page_codec
+    :return: The compressed bytes
+    """
+    if codec == 'zstd':
+        import zstandard
+        return zstandard.ZstdCompressor(level=9).compress(data)
+    import zlib
+    return zlib.compress(data, 6)
+
+
+def decompress_page(data, codec):
+    """ :param data: Bytes compressed by compress_page
+    :param codec: Name of the codec they were compressed with
+    :return: The original bytes
+    """
+    if codec == 'zstd':
+        import zstandard
+        return zstandard.ZstdDecompressor().decompress(data)
+    import zlib
+    return zlib.decompress(data)
+
+
+class PageArchive(object):
+    """ An append-only archive of the raw tables read off wunderground, so
+    that when the extractor changes (a new field, a fixed parser) years of
+    pages can be parsed again with replay_archive instead of downloaded
+    again.  Only the history table of a daily page (or the range table of
+    a monthly or custom page) is ever read, see read_table, so that is what
+    is kept, along with the encoding it was sent in.
+    Each table is compressed on its own (see get_page_codec) and appended
+    to the current segment file in the archive's directory, a new segment
+    is started once one would grow past segment_size bytes.  An SQLite
+    index maps each location (see location_key), kind ('daily' or 'range')
+    and dates to the segment, offset and length of its table, so spellings
+    of the same location share an entry.  A table archived again is
+    appended again and the index pointed at the new copy.  Safe to share
+    between threads.
+    """
+
+    def __init__(self, path, segment_size=256 * 1024 * 1024, codec=None):
+        """ :param path: Directory to keep the archive in, created if missing
+        :param segment_size: Most bytes appended to a segment file
+        :param codec: Codec to compress new tables with, see get_page_codec
+        """
+        self.path = path
+        self.segment_size = segment_size
+        self.codec = codec or get_page_codec()
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        import sqlite3
+        self._connection = sqlite3.connect(os.path.join(path, 'index.sqlite'),
+                                           check_same_thread=False)
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS pages ('
+            'location TEXT NOT NULL, kind TEXT NOT NULL, '
+            'start_date TEXT NOT NULL, end_date TEXT NOT NULL, '
+            'segment INTEGER NOT NULL, offset INTEGER NOT NULL, '
+            'length INTEGER NOT NULL, codec TEXT NOT NULL, encoding TEXT, '
+            'archived_at REAL NOT NULL, '
+            'PRIMARY KEY (location, kind, start_date, end_date))')
+        self._connection.commit()
+        self._segment = self._connection.execute(
+            'SELECT MAX(segment) FROM pages').fetchone()[0] or 1
+        self._file = open(self.segment_path(self._segment), 'ab')
+
+    def segment_path(self, segment):
+        """ :param segment: Number of a segment
+        :return: Path of the segment's file
+        """
+        return os.path.join(self.path, 'segment-%06d.dat' % segment)
+
+    def put(self, location, kind, start_date, end_date, fragment, encoding=None):
+        """ Compresses a table and appends it to the archive.
+
+        :param location: Validated location string
+        :param kind: 'daily' for a history table, 'range' for a range table
+        :param start_date: First datetime.date the table covers
+        :param end_date: Last datetime.date the table covers
+        :param fragment: Bytes of the table
+        :param encoding: Encoding of the page, utf-8 if not provided
+        """
+        data = compress_page(fragment, self.codec)
+        with self._lock:
+            offset = self._file.tell()
+            if offset and offset + len(data) > self.segment_size:
+                self._file.close()
+                self._segment += 1
+                self._file = open(self.segment_path(self._segment), 'ab')
+                offset = 0
+            self._file.write(data)
+            # The table must be in the segment before the index points at it
+            self._file.flush()
+            self._connection.execute(
+                'INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (location_key(location), kind, start_date.isoformat(),
+                 end_date.isoformat(), self._segment, offset, len(data), self.codec, encoding,
+                 time.time()))
+            self._connection.commit()
+
+    def entries(self):
+        """ Lists every table in the archive, in the order they are laid
+        out in the segments so reading them walks each file forwards.
+
+        :return: List of ArchiveEntry
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                'SELECT location, kind, start_date, end_date, segment, offset, '
+                'length, codec, encoding FROM pages '
+                'ORDER BY segment, offset').fetchall()
+        return [ArchiveEntry(location, kind, read_iso_date(start_date),
+                             read_iso_date(end_date), *rest)
+                for location, kind, start_date, end_date, *rest in rows]
+
+    def read(self, entry):
+        """ :param entry: ArchiveEntry of the table to read
+        :return: Bytes of the table
+        """
+        with open(self.segment_path(entry.segment), 'rb') as segment_file:
+            segment_file.seek(entry.offset)
+            return decompress_page(segment_file.read(entry.length), entry.codec)
+
+    def close(self):
+        """ Closes the current segment and the index.
+        """
+        with self._lock:
+            self._file.close()
+            self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def replay_pages(path, entries, fields=None):
+    """ Helper function for replay_archive.
+    Parses a run of tables from one segment again, with the extractor as
+    it is now.  The segment is memory-mapped, so a worker process only
+    reads the pages of it that it was handed.
+
+    :param path: Path of the segment file
+    :param entries: List of ArchiveEntry in the segment
+    :param fields: Compiled field spec for daily tables, see
+    parse_history_table
+    :return: List of (location, date, json_data) tuples
+    """
+    import mmap
+    results = []
+    with open(path, 'rb') as segment_file, \
+            mmap.mmap(segment_file.fileno(), 0, access=mmap.ACCESS_READ) as segment:
+        for entry in entries:
+            fragment = decompress_page(
+                segment[entry.offset:entry.offset + entry.length], entry.codec)
+            if entry.kind == 'daily':
+                try:
+                    json_data = format_fields(parse_history_table(
+                        fragment, None, entry.encoding, fields))
+                except ScraperError as error:
+                    json_data = format_error(error)
+                results.append((entry.location, entry.start_date, json_data))
+                continue
+            try:
+                days = parse_range_table(fragment, entry.start_date,
+                                         entry.end_date, None, entry.encoding)
+                failure = None
+            except ScraperError as error:
+                days = dict()
+                failure = format_error(error)
+            for date in date_range(entry.start_date, entry.end_date):
+                if failure is not None:
+                    json_data = failure
+                elif date in days:
+                    json_data = format_fields(days[date])
+                else:
+                    json_data = format_error(ParseError(
+                        'Range table has no row for %s' % date.isoformat()))
+                results.append((entry.location, date, json_data))
+    return results
+
+
+def replay_archive(archive, workers=None, fields=None, chunk_size=256):
+    """ Re-runs extraction over every table in a PageArchive without any
+    network access, e.g. after a field has been added to the extractor.
+    Tables are handed out chunk_size at a time, each chunk from a single
+    segment, and parsed in worker processes which memory-map the segments
+    themselves, so only the results cross between processes.
+
+    :param archive: PageArchive to replay
+    :param workers: Number of processes to parse in, 0 for one per core.
+    Tables are parsed in the calling process if None.
+    :param fields: Compiled field spec for daily tables, see
+    parse_history_table
+    :param chunk_size: Most tables handed to a worker at once
+    :return: Generator of (location, date, json_data) tuples, in the order
+    the tables were archived
+    """
+    chunks = []
+    for segment, entries in itertools.groupby(archive.entries(),
+                                              lambda entry: entry.segment):
+        entries = list(entries)
+        for start in range(0, len(entries), chunk_size):
+            chunks.append((archive.segment_path(segment),
+                           entries[start:start + chunk_size]))
+    if workers is None:
+        for path, entries in chunks:
+            yield from replay_pages(path, entries, fields)
+        return
+    import concurrent.futures
+    import multiprocessing
+    # Spawned rather than forked for the same reasons as ParsePool
+    with concurrent.futures.ProcessPoolExecutor(
+            workers or os.cpu_count() or 1,
+            mp_context=multiprocessing.get_context('spawn')) as pool:
+        for results in pool.map(replay_pages, [path for path, _ in chunks],
+                                [entries for _, entries in chunks],
+                                itertools.repeat(fields)):
+            yield from results
+
+
+class WorkQueue(object):
+    """ Base class of the queues a backfill's jobs are shared out through,
+    so that worker processes on one or many machines can split them (see
+    work_queue).  A worker leases a few jobs at a time, holding each for
+    lease_seconds, and keeps the leases alive with heartbeats while it
+    scrapes them.  A job whose lease runs out, because its worker died or
+    lost the network, is leased to the next worker to ask, and a job which
+    failed is put back to be retried, until it has been tried max_attempts
+    times.  Subclasses implement these methods over a shared store, see
+    SqliteWorkQueue, and are registered in QUEUES.
+    """
+
+    def __init__(self, max_attempts=QUEUE_MAX_ATTEMPTS):
+        """ :param max_attempts: Times a job is leased before it is failed
+        """
+        self.max_attempts = max_attempts
+
+    def put(self, jobs):
+        """ Adds jobs to the queue.  Jobs already queued are left as they
+        are, unless they failed, in which case they are tried again.
+
+        :param jobs: Iterable of (validated location string, datetime.date)
+        :return: Number of jobs added or put back
+        """
+        raise NotImplementedError
+
+    def lease(self, worker, count, lease_seconds=QUEUE_LEASE_SECONDS):
+        """ Leases jobs which are waiting or whose lease has run out, in the
+        order they were queued.
+
+        :param worker: Name of the worker taking the jobs
+        :param count: Most jobs to lease
+        :param lease_seconds: Seconds the jobs are held for
+        :return: List of (location, datetime.date), empty if nothing is
+        waiting
+        """
+        raise NotImplementedError
+
+    def heartbeat(self, worker, lease_seconds=QUEUE_LEASE_SECONDS):
+        """ Extends every lease a worker holds.
+
+        :param worker: Name of the worker
+        :param lease_seconds: Seconds from now the jobs are held until
+        """
+        raise NotImplementedError
+
+    def complete(self, worker, location, date, error=None):
+        """ Finishes a leased job.  A failed job is put back to be retried
+        until it has been tried max_attempts times.
+
+        :param worker: Name of the worker which held the lease
+        :param location: Location of the job
+        :param date: datetime.date of the job
+        :param error: Error message if the job failed, None if it succeeded
+        :return: False if the worker's lease had run out and the job was
+        handed to another worker, True otherwise
+        """
+        raise NotImplementedError
+
+    def release(self, worker):
+        """ Puts back every job a worker holds without counting the attempt,
+        e.g. when the worker is stopped.
+
+        :param worker: Name of the worker
+        """
+        raise NotImplementedError
+
+    def counts(self):
+        """ :return: Dictionary of state ('pending', 'leased', 'done',
+        'failed') -> number of jobs in it
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """ Closes the connection to the queue.
+        """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class SqliteWorkQueue(WorkQueue):
+    """ A WorkQueue kept in an SQLite file, the default backend.  Leases are
+    taken inside an immediate transaction, so any number of processes can
+    share the file: workers on one machine, or on several if the file is
+    on a shared filesystem whose locks SQLite can rely on.  Jobs are kept
+    in the order they were queued, so consecutive days of a location are
+    leased together and can still be fetched through a range view.  Safe
+    to share between threads.
+    """
+
+    def __init__(self, path, max_attempts=QUEUE_MAX_ATTEMPTS):
+        """ :param path: File to keep the queue in, created if missing
+        :param max_attempts: Times a job is leased before it is failed
+        """
+        super(SqliteWorkQueue, self).__init__(max_attempts)
+        self._lock = threading.Lock()
+        import sqlite3
+        # Transactions are begun explicitly, and waited on for up to a minute
+        # while other workers hold the lock
+        self._connection = sqlite3.connect(path, timeout=60,
+                                           isolation_level=None,
+                                           check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode = WAL')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS jobs ('
+            'location TEXT NOT NULL, date TEXT NOT NULL, '
+            "state TEXT NOT NULL DEFAULT 'pending', "
+            'attempts INTEGER NOT NULL DEFAULT 0, worker TEXT, '
+            'lease_until REAL, error TEXT, PRIMARY KEY (location, date))')
+        self._connection.execute(
+            'CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, lease_until)')
+
+    def put(self, jobs):
+        jobs = iter(jobs)
+        added = 0
+        with self._lock:
+            while True:
+                chunk = [(location, date.isoformat()) for location, date
+                         in itertools.islice(jobs, 10000)]
+                if not chunk:
+                    return added
+                before = self._connection.total_changes
+                self._connection.execute('BEGIN IMMEDIATE')
+                try:
+                    self._connection.executemany(
+                        'INSERT INTO jobs (location, date) VALUES (?, ?) '
+                        'ON CONFLICT (location, date) DO UPDATE SET '
+                        "state = 'pending', attempts = 0, error = NULL "
+                        "WHERE state = 'failed'", chunk)
+                    self._connection.execute('COMMIT')
+                except BaseException:
+                    self._connection.execute('ROLLBACK')
+                    raise
+                added += self._connection.total_changes - before
+
+    def lease(self, worker, count, lease_seconds=QUEUE_LEASE_SECONDS):
+        now = time.time()
+        leased = []
+        with self._lock:
+            self._connection.execute('BEGIN IMMEDIATE')
+            try:
+                rows = self._connection.execute(
+                    "SELECT rowid, location, date, attempts FROM jobs "
+                    "WHERE state = 'pending' OR "
+                    "(state = 'leased' AND lease_until < ?) "
+                    'ORDER BY rowid LIMIT ?', (now, count)).fetchall()
+                for rowid, location, date_string, attempts in rows:
+                    if attempts >= self.max_attempts:
+                        # Every worker it was handed to was lost before finishing it
+                        self._connection.execute(
+                            "UPDATE jobs SET state = 'failed', worker = NULL, "
+                            "error = 'Lease ran out %s times' WHERE rowid = ?"
+                            % attempts, (rowid,))
+                        continue
+                    self._connection.execute(
+                        "UPDATE jobs SET state = 'leased', worker = ?, "
+                        'lease_until = ?, attempts = attempts + 1 WHERE rowid = ?',
+                        (worker, now + lease_seconds, rowid))
+                    leased.append((location, read_iso_date(date_string)))
+                self._connection.execute('COMMIT')
+            except BaseException:
+                self._connection.execute('ROLLBACK')
+                raise
+        METRICS.count('queue_leases_total', value=len(leased))
+        return leased
+
+    def heartbeat(self, worker, lease_seconds=QUEUE_LEASE_SECONDS):
+        with self._lock:
+            self._connection.execute(
+                "UPDATE jobs SET lease_until = ? WHERE state = 'leased' "
+                'AND worker = ?', (time.time() + lease_seconds, worker))
+
+    def complete(self, worker, location, date, error=None):
+        if error is None:
+            update = "UPDATE jobs SET state = 'done', worker = NULL, error = NULL "
+            parameters = ()
+        else:
+            # Retried until it has been tried max_attempts times
+            update = "UPDATE jobs SET state = CASE WHEN attempts >= ? " \
+                     "THEN 'failed' ELSE 'pending' END, worker = NULL, error = ? "
+            parameters = (self.max_attempts, error)
+        with self._lock:
+            cursor = self._connection.execute(
+                update + "WHERE location = ? AND date = ? AND state = 'leased' "
+                'AND worker = ?', parameters + (location, date.isoformat(), worker))
+        return cursor.rowcount > 0
+
+    def release(self, worker):
+        with self._lock:
+            self._connection.execute(
+                "UPDATE jobs SET state = 'pending', worker = NULL, "
+                "attempts = attempts - 1 WHERE state = 'leased' AND worker = ?",
+                (worker,))
+
+    def counts(self):
+        counts = dict((state, 0) for state in ('pending', 'leased', 'done', 'failed'))
+        with self._lock:
+            counts.update(self._connection.execute(
+                'SELECT state, COUNT(*) FROM jobs GROUP BY state').fetchall())
+        return counts
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+QUEUES = {'sqlite': SqliteWorkQueue}
+
+
+def open_queue(address, max_attempts=QUEUE_MAX_ATTEMPTS):
+    """ Opens a work queue.
+
+    :param address: An SQLite file, or 'NAME://LOCATION' to open LOCATION
+    with the backend registered as NAME in QUEUES
+    :param max_attempts: Times a job is leased before it is failed
+    :return: The WorkQueue
+    """
+    if '://' in address:
+        backend, location = address.split('://', 1)
+        return QUEUES[backend](location, max_attempts)
+    return SqliteWorkQueue(address, max_attempts)
+
+
+def read_iso_date(date_string):
+    """ Converts a 'YYYY-MM-DD' string stored by HistoryStore back into a
+    datetime.date, without the cost of strptime.
+
+    :param date_string: String formatted as YYYY-MM-DD
+    :return: The matching datetime.date
+    """
+    return datetime.date(int(date_string[:4]), int(date_string[5:7]),
+                         int(date_string[8:10]))
+
+
+def climatology_key(location, stations=None):
+    """ Picks the key a location's entries in a ClimatologyTable are kept
+    under.  Locations sharing a station share its entries once the station
+    is known.
+
+    :param location: Validated location string
+    :param stations: Optional StationTable
+    :return: The location's station path, or its location key if the
+    station isn't known
+    """
+    station = stations.get(location) if stations is not None else None
+    return station or location_key(location)
+
+
+def coalesce_key(location, date, stations=None):
+    """ Builds the key jobs are coalesced on, so that different spellings
+    of a location share a fetch when they are known to be the same
+    station.  Locations are normalized with location_key, airport codes
+    (as validate_location recognizes them) are their own station, and
+    other locations are resolved through the StationTable once their
+    station is known.
+
+    :param location: Validated location string
+    :param date: datetime.date of the job
+    :param stations: Optional StationTable of known stations
+    :return: Tuple of (station path or location key, datetime.date)
+    """
+    station = stations.get(location) if stations is not None else None
+    if station is None and AIRPORT_REGEX.search(location):
+        station = '/history/airport/%s' % location
+    return station or location_key(location), date
+
+
+class SingleFlight(object):
+    """ Coalesces concurrent calls for the same key into a single call:
+    the first caller runs it, and callers which arrive while it is still
+    running wait for it and share its result (or its exception) instead of
+    running it again.  Keys are forgotten as soon as their call finishes,
+    so results are never kept around, that is what PageCache is for.
+    Safe to share between threads.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.shared = 0
+        self._in_flight = dict()
+        self._lock = threading.Lock()
+
+    def do(self, key, function, *args):
+        """ Calls a function, or waits for the call already in flight for
+        the same key.
+
+        :param key: Hashable key of the call
+        :param function: Function to call
+        :param args: Arguments to call it with
+        :return: Whatever the function returns
+        """
+        import concurrent.futures
+        with self._lock:
+            future = self._in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = self._in_flight[key] = concurrent.futures.Future()
+                self.calls += 1
+            else:
+                self.shared += 1
+        if not leader:
+            METRICS.count('coalesced_total')
+            return future.result()
+        try:
+            future.set_result(function(*args))
+        except BaseException as error:
+            future.set_exception(error)
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+        return future.result()
+
+    def stats(self):
+        """ :return: Dictionary with the number of 'calls' made and the
+        number of callers which 'shared' another's call
+        """
+        with self._lock:
+            return {'calls': self.calls, 'shared': self.shared}
+
+
+# Shared by every scrape in the process, so duplicate lookups are coalesced
+# across batches and threads alike
+SINGLE_FLIGHT = SingleFlight()
+
+
+def date_range(start_date, end_date):
+    """ Generates every date from start_date to end_date, inclusive.
+
+    :param start_date: First datetime.date in the range
+    :param end_date: Last datetime.date in the range
+    :return: Generator of datetime.date objects
+    """
+    one_day = datetime.timedelta(days=1)
+    current = start_date
+    while current <= end_date:
+        yield current
+        current += one_day
+
+
+def scrape_location_date(location, date, rate_limiter=None, fetcher=None,
+                         cache=None, stations=None, base_url=WUNDERGROUND_URL,
+                         climatology=None, parse_pool=None, archive=None):
+    """ Runs the get_url -> scrape_weather_data pipeline for a single
+    location and date.  Used as the unit of work in scrape_range.
+    With a ClimatologyTable only the Actual column is parsed when the
+    station-day's Average and Record columns are already known.  If the
+    actuals beat the stored records the page is parsed in full instead and
+    the new records are stored.  Jobs for the same station and date which
+    run at the same time share one fetch and parse (see SINGLE_FLIGHT).
+
+    :param location: Validated location string
+    :param date: datetime.date to scrape
+    :param rate_limiter: Optional RateLimiter shared between workers
+    :param fetcher: Optional Fetcher shared between workers
+    :param cache: Optional PageCache checked before fetching
+    :param stations: Optional StationTable used to skip the redirect
+    :param base_url: Scheme and host the request should be sent to
+    :param climatology: Optional ClimatologyTable of Average and Record
+    columns to reuse and fill
+    :param parse_pool: Optional ParsePool to parse the page in, it is
+    parsed in the calling thread if not provided
+    :param archive: Optional PageArchive to keep the page's table in
+    :return: A string containing the temperature data formatted as a json,
+    or a DeferredParse of it while the page is parsed in the parse_pool
+    """
+    if cache is not None:
+        json_data = cache.get(location, date)
+        if json_data is not None:
+            return json_data
+    # Concurrent jobs for the same station and date share one fetch
+    json_data = SINGLE_FLIGHT.do(coalesce_key(location, date, stations),
+                                 fetch_location_date, location, date,
+                                 rate_limiter, fetcher, stations, base_url,
+                                 climatology, parse_pool, archive)
+
+    def store(json_data):
+        # Errors may be temporary so they aren't cached
+        if cache is not None and not json_data.startswith('{"error"'):
+            cache.put(location, date, json_data)
+        return json_data
+    return when_parsed(json_data, store)
+
+
+def fetch_location_date(location, date, rate_limiter=None, fetcher=None,
+                        stations=None, base_url=WUNDERGROUND_URL,
+                        climatology=None, parse_pool=None, archive=None):
+    """ Helper function for scrape_location_date.
+    Fetches and parses a location and date's daily page.
+
+    :param location: Validated location string
+    :param date: datetime.date to scrape
+    :param rate_limiter: Optional RateLimiter shared between workers
+    :param fetcher: Optional Fetcher shared between workers
+    :param stations: Optional StationTable used to skip the redirect
+    :param base_url: Scheme and host the request should be sent to
+    :param climatology: Optional ClimatologyTable of Average and Record
+    columns to reuse and fill
+    :param parse_pool: Optional ParsePool to parse the page in
+    :param archive: Optional PageArchive to keep the page's table in
+    :return: A string containing the temperature data formatted as a
+    json, or the error formatted as a json.  A DeferredParse of it is
+    returned while the page is parsed in the parse_pool.
+    """
+    station = stations.get(location) if stations is not None else None
+    if station is not None:
+        url = get_station_url(station, str(date.day), str(date.month),
+                              str(date.year), base_url=base_url)
+    else:
+        url = get_url(location, str(date.day), str(date.month), str(date.year),
+                      base_url=base_url)
+    climate = None
+    if climatology is not None:
+        climate = climatology.get(climatology_key(location, stations), date)
+    try:
+        response = fetch_limited(url, fetcher, rate_limiter)
+        # Remember where the redirect took us so later dates can skip it
+        if station is None and stations is not None and response.status_code == 200:
+            stations.record(location, response.url)
+        fragment = read_response_table(response, url, HISTORY_TABLE_REGEX)
+        if archive is not None:
+            archive.put(location, 'daily', date, date, fragment, response.encoding)
+    except ScraperError as error:
+        # Report the error for this job without stopping the batch
+        METRICS.count('errors_total', type=type(error).__name__)
+        return format_error(error)
+
+    def finish(parsed):
+        return finish_location_date(location, date, parsed, fragment,
+                                    response.encoding, climate, stations,
+                                    climatology)
+    return parse_later(parse_pool, finish, parse_history_table, fragment, None,
+                       response.encoding, None if climate is None else ACTUAL_FIELDS)
+
+
+def finish_location_date(location, date, parsed, fragment, encoding, climate,
+                         stations, climatology):
+    """ Helper function for fetch_location_date.
+    Finishes a daily page's result once its table is parsed.
+
+    :param location: Validated location string
+    :param date: datetime.date of the page
+    :param parsed: Function returning the parsed table
+    :param fragment: The page's table, as read by read_response_table
+    :param encoding: Encoding of the fragment
+    :param climate: The station-day's known Average and Record columns,
+    None if the table was parsed in full
+    :param stations: Optional StationTable
+    :param climatology: Optional ClimatologyTable to fill
+    :return: A string containing the temperature data formatted as a
+    json, or the error formatted as a json
+    """
+    try:
+        field_dict = parsed()
+        if climate is not None:
+            field_dict.update(climate)
+            if record_is_broken(field_dict):
+                # The page already shows the new record, read it from there.
+                # This is rare, so it is parsed here rather than queued again
+                climatology.invalidate(climatology_key(location, stations), date)
+                field_dict = parse_history_table(fragment, None, encoding)
+                climate = None
+        if climatology is not None and climate is None:
+            climatology.put(climatology_key(location, stations), date, field_dict)
+        return format_fields(field_dict)
+    except ScraperError as error:
+        METRICS.count('errors_total', type=type(error).__name__)
+        return format_error(error)
+
+
+def plan_spans(jobs, min_days=RANGE_MIN_DAYS):
+    """ Groups jobs into the spans of days fetched by one request each.
+    Consecutive jobs for the same location on consecutive days of the same
+    month are gathered into a run.  Runs of at least min_days are fetched
+    as one span through a range view, shorter runs are split back into
+    single days.  Only one run is held at a time, so jobs are still pulled
+    lazily.
+
+    :param jobs: Iterable of (validated location string, datetime.date)
+    :param min_days: Shortest run fetched through a range view
+    :return: Generator of (location, start date, end date) tuples, where
+    the start and end date are the same for single days
+    """
+    run = []
+    for location, date in itertools.chain(jobs, [(None, None)]):
+        if run:
+            last_location, last_date = run[-1]
+            if location == last_location and date is not None \
+                    and date.month == last_date.month \
+                    and date - last_date == datetime.timedelta(days=1):
+                run.append((location, date))
+                continue
+            if len(run) >= min_days:
+                yield last_location, run[0][1], last_date
+            else:
+                for run_location, run_date in run:
+                    yield run_location, run_date, run_date
+        run = [(location, date)] if location is not None else []
+
+
+def select_keys(json_data, keys):
+    """ Cuts a scrape result down to the given output keys.  Errors are
+    passed through untouched.
+
+    :param json_data: json string returned by scrape_weather_data
+    :param keys: Collection of output keys to keep, None keeps them all
+    :return: A string containing the kept fields formatted as a json
+    """
+    if keys is None:
+        return json_data
+    field_dict = json.loads(json_data)
+    if 'error' in field_dict:
+        return json_data
+    return format_fields(dict((key, text) for key, text in field_dict.items()
+                              if key in keys))
+
+
+def scrape_location_span(location, start_date, end_date, rate_limiter=None,
+                         fetcher=None, cache=None, stations=None,
+                         base_url=WUNDERGROUND_URL, climatology=None,
+                         parse_pool=None, archive=None):
+    """ Scrapes a span planned by plan_spans.  A single day is scraped with
+    scrape_location_date, a longer span with one request for its Monthly or
+    Custom history page.  Without a ClimatologyTable every result is cut
+    down to the RANGE_KEYS the range views carry, so all results of a
+    range run have the same fields.  With one, the Average and Record
+    columns the range views lack are filled in from it, and only days it
+    doesn't know yet (or whose record the range page shows was broken)
+    fall back to their daily page.
+    Range pages don't carry every field a cached daily result does, so
+    their results are answered from the cache but never stored in it.
+
+    :param location: Validated location string
+    :param start_date: First datetime.date of the span
+    :param end_date: Last datetime.date of the span, in the same month
+    :param rate_limiter: Optional RateLimiter shared between workers
+    :param fetcher: Optional Fetcher shared between workers
+    :param cache: Optional PageCache checked before fetching
+    :param stations: Optional StationTable used to skip the redirect
+    :param base_url: Scheme and host the request should be sent to
+    :param climatology: Optional ClimatologyTable of Average and Record
+    columns to fill the results in from
+    :param parse_pool: Optional ParsePool to parse the pages in
+    :param archive: Optional PageArchive to keep the pages' tables in
+    :return: List of (datetime.date, json_data) tuples, one per day, or a
+    DeferredParse of it while the page is parsed in the parse_pool
+    """
+    keys = RANGE_KEYS if climatology is None else None
+    if start_date == end_date:
+        json_data = scrape_location_date(location, start_date, rate_limiter,
+                                         fetcher, cache, stations, base_url,
+                                         climatology, parse_pool, archive)
+        return when_parsed(json_data, lambda json_data: [
+            (start_date, select_keys(json_data, keys))])
+    dates = list(date_range(start_date, end_date))
+    if cache is not None:
+        cached = [cache.get(location, date) for date in dates]
+        if None not in cached:
+            return [(date, select_keys(json_data, keys))
+                    for date, json_data in zip(dates, cached)]
+    station = stations.get(location) if stations is not None else None
+    if station is not None:
+        url = get_station_range_url(station, start_date, end_date,
+                                    base_url=base_url)
+    else:
+        url = get_range_url(location, start_date, end_date, base_url=base_url)
+    try:
+        response = fetch_limited(url, fetcher, rate_limiter)
+        if station is None and stations is not None and response.status_code == 200:
+            stations.record(location, response.url)
+        fragment = read_response_table(response, url, RANGE_TABLE_REGEX)
+        if archive is not None:
+            archive.put(location, 'range', start_date, end_date, fragment,
+                        response.encoding)
+    except ScraperError as error:
+        # The whole span failed, report it against every day
+        METRICS.count('errors_total', type=type(error).__name__)
+        return [(date, format_error(error)) for date in dates]
+
+    def finish(parsed):
+        return finish_location_span(location, dates, parsed, rate_limiter,
+                                    fetcher, cache, stations, base_url,
+                                    climatology, parse_pool, archive)
+    return parse_later(parse_pool, finish, parse_range_table, fragment,
+                       start_date, end_date, None, response.encoding)
+
+
+def finish_location_span(location, dates, parsed, rate_limiter=None,
+                         fetcher=None, cache=None, stations=None,
+                         base_url=WUNDERGROUND_URL, climatology=None,
+                         parse_pool=None, archive=None):
+    """ Helper function for scrape_location_span.
+    Finishes a span's results once its range table is parsed, falling back
+    to the daily page for days the ClimatologyTable can't fill in.
+
+    :param location: Validated location string
+    :param dates: List of the span's datetime.dates
+    :param parsed: Function returning the parsed range table
+    :return: List of (datetime.date, json_data) tuples, one per day
+    The other parameters are as for scrape_location_span.
+    """
+    try:
+        days = parsed()
+    except ScraperError as error:
+        METRICS.count('errors_total', type=type(error).__name__)
+        return [(date, format_error(error)) for date in dates]
+    results = []
+    for date in dates:
+        if date not in days:
+            results.append((date, format_error(ParseError(
+                'Range table has no row for %s' % date.isoformat()))))
+            continue
+        field_dict = days[date]
+        if climatology is not None:
+            key = climatology_key(location, stations)
+            climate = climatology.get(key, date)
+            if climate is not None:
+                field_dict.update(climate)
+                if record_is_broken(field_dict):
+                    climatology.invalidate(key, date)
+                    climate = None
+            if climate is None:
+                # The daily page has the columns the range page lacks,
+                # and fills them in for the next year asked for
+                results.append((date, finished(scrape_location_date(
+                    location, date, rate_limiter, fetcher, cache, stations,
+                    base_url, climatology, parse_pool, archive))))
+                continue
+        results.append((date, format_fields(field_dict)))
+    return results
+
+
+def scrape_range(locations, start_date, end_date, concurrency=4,
+                 rate_limit=None, cache=None, stations=None, skip=None,
+                 base_url=WUNDERGROUND_URL, range_days=None, climatology=None,
+                 parse_workers=None, archive=None):
+    """ Scrapes every location for every date between start_date and
+    end_date (inclusive).  See scrape_jobs.
+
+    :param locations: Iterable of validated location strings
+    :param start_date: First datetime.date to scrape
+    :param end_date: Last datetime.date to scrape
+    :param concurrency: Maximum number of requests in flight at once
+    :param rate_limit: Maximum requests per second for each host,
+    None for no limit
+    :param cache: Optional PageCache to answer from and fill
+    :param stations: Optional StationTable used to skip redirects
+    :param skip: Optional function taking a location and date, jobs it
+    returns True for are left out (e.g. OutputSink.is_completed)
+    :param base_url: Scheme and host requests should be sent to
+    :param range_days: Fetch runs of at least this many days through the
+    range views, see scrape_jobs
+    :param climatology: Optional ClimatologyTable, see scrape_jobs
+    :param parse_workers: Number of processes to parse pages in,
+    see scrape_jobs
+    :param archive: Optional PageArchive to keep every table read in
+    :return: Generator of (location, date, json_data) tuples
+    """
+    jobs = ((location, date) for location in locations
+            for date in date_range(start_date, end_date))
+    return scrape_jobs(jobs, concurrency, rate_limit, cache, stations, skip,
+                       base_url, range_days, climatology,
+                       parse_workers=parse_workers, archive=archive)
+
+
+def scrape_jobs(jobs, concurrency=4, rate_limit=None, cache=None,
+                stations=None, skip=None, base_url=WUNDERGROUND_URL,
+                range_days=None, climatology=None, profiler=None,
+                parse_workers=None, archive=None):
+    """ Scrapes every (location, date) job using a bounded pool of worker
+    threads.  Results are yielded as soon as each fetch finishes, so they
+    will usually not come back in the order the jobs were given.  Jobs are
+    pulled from the iterable as workers free up, so only a small window of
+    jobs is in flight at once, which keeps memory flat for multi-year runs.
+    With parse_workers the threads only do the network I/O, each table
+    they read is handed to a ParsePool so that parsing uses every core
+    instead of contending for the GIL with the downloads.
+
+    :param jobs: Iterable of (validated location string, datetime.date)
+    :param concurrency: Maximum number of requests in flight at once
+    :param rate_limit: Maximum requests per second for each host,
+    None for no limit.  Each host's rate adapts below this to how it
+    copes, and a failing host is paused, see RateLimiter.
+    :param cache: Optional PageCache to answer from and fill
+    :param stations: Optional StationTable used to skip redirects
+    :param skip: Optional function taking a location and date, jobs it
+    returns True for are left out (e.g. OutputSink.is_completed)
+    :param base_url: Scheme and host requests should be sent to
+    :param range_days: If given, runs of at least this many consecutive
+    days in a month for one location are fetched with a single request
+    for the Monthly or Custom history page (see plan_spans), and results
+    only carry the RANGE_KEYS unless a climatology is given.  Every day is
+    fetched separately if None.
+    :param climatology: Optional ClimatologyTable of the Average and
+    Record columns to reuse across years and fill
+    :param profiler: Optional Profiler to run every task under
+    :param parse_workers: Number of processes to parse pages in, 0 for one
+    per core.  Pages are parsed in the worker threads if None.
+    :param archive: Optional PageArchive to keep every table read in, so
+    it can be parsed again later with replay_archive
+    :return: Generator of (location, date, json_data) tuples
+    """
+    import concurrent.futures
+    rate_limiter = RateLimiter(rate_limit)
+    jobs = ((location, date) for location, date in jobs
+            if skip is None or not skip(location, date))
+    if range_days is None:
+        tasks = ((scrape_location_date, location, date) for location, date in jobs)
+    else:
+        tasks = ((scrape_location_span, location, start_date, end_date)
+                 for location, start_date, end_date in plan_spans(jobs, range_days))
+    parse_pool = ParsePool(parse_workers) if parse_workers is not None else None
+    try:
+        with Fetcher(pool_size=concurrency) as fetcher, \
+                concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as pool:
+            # Maps the futures of tasks running in the threads and of parses
+            # running in the parse_pool to a list of their tasks, each with
+            # its DeferredParse for parses.  Coalesced jobs share a parse,
+            # so more than one task can wait on the same future.
+            pending = dict()
+            running = 0
+            while True:
+                # Keep the threads topped up without queueing every job at
+                # once, pages being parsed don't hold up the next downloads
+                while running < concurrency * 2:
+                    task = next(tasks, None)
+                    if task is None:
+                        break
+                    future = pool.submit(run_task, profiler, *(task + (
+                        rate_limiter, fetcher, cache, stations, base_url, climatology,
+                        parse_pool, archive)))
+                    pending[future] = [(task, None)]
+                    running += 1
+                if not pending:
+                    break
+                done, _ = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    for task, deferred in pending.pop(future):
+                        if deferred is not None:
+                            # Parsed, finishing off may touch the caches or
+                            # fetch a daily page so it is done in a thread
+                            pending[pool.submit(run_task, profiler, deferred.result)] = \
+                                [(task, None)]
+                            running += 1
+                            continue
+                        running -= 1
+                        result = future.result()
+                        if isinstance(result, DeferredParse):
+                            pending.setdefault(result.future, []).append((task, result))
+                            continue
+                        function, location, date = task[:3]
+                        if function is scrape_location_span:
+                            # A span answers for each of its days
+                            for date, json_data in result:
+                                yield location, date, json_data
+                        else:
+                            yield location, date, result
+    finally:
+        if parse_pool is not None:
+            parse_pool.close()
+
+
+def run_task(profiler, function, *args):
+    """ Runs one task of scrape_jobs in a worker thread, timing it as the
+    'task' stage.
+
+    :param profiler: Optional Profiler to run the task under
+    :param function: scrape_location_date or scrape_location_span
+    :param args: Arguments to call it with
+    :return: Whatever the function returns
+    """
+    with METRICS.timer('task'):
+        if profiler is None:
+            return function(*args)
+        return profiler.call(function, *args)
+
+
+class ParsePool(object):
+    """ Runs the CPU-bound parse stage of a batch in worker processes, so
+    that it isn't held to a single core by the GIL while the fetching
+    threads do the network I/O.  Workers are sent the raw bytes of a table
+    and send back the small dictionaries parsed out of it.
+    At most max_pending tables are queued for the workers at once, threads
+    with another table to parse wait for a slot, which pushes back on the
+    downloads when parsing can't keep up.
+    """
+
+    def __init__(self, workers=None, max_pending=None):
+        """ :param workers: Number of processes, one per core if not provided
+        :param max_pending: Most tables queued or being parsed at once,
+        twice the number of workers if not provided
+        """
+        import concurrent.futures
+        import multiprocessing
+        self.workers = workers or os.cpu_count() or 1
+        # Workers are spawned rather than forked, forking while the fetching
+        # threads run could copy a lock one of them holds into the child
+        self.pool = concurrent.futures.ProcessPoolExecutor(
+            self.workers, mp_context=multiprocessing.get_context('spawn'))
+        self.slots = threading.BoundedSemaphore(max_pending or self.workers * 2)
+
+    def submit(self, function, *args):
+        """ Hands a parse function to a worker process without waiting for
+        its result, once a slot is free.  The round trip is timed as the
+        'parse' stage, the workers' own stage timings aren't collected.
+
+        :param function: Module level function to call, e.g.
+        parse_history_table
+        :param args: Arguments to call it with, which must be picklable
+        :return: concurrent.futures.Future of whatever the function returns
+        """
+        self.slots.acquire()
+        started = time.perf_counter()
+        try:
+            future = self.pool.submit(function, *args)
+        except BaseException:
+            self.slots.release()
+            raise
+
+        def done(future):
+            self.slots.release()
+            METRICS.observe('stage_seconds', time.perf_counter() - started,
+                            stage='parse')
+        future.add_done_callback(done)
+        return future
+
+    def run(self, function, *args):
+        """ Calls a parse function in a worker process and waits for its
+        result, see submit.
+
+        :param function: Module level function to call
+        :param args: Arguments to call it with, which must be picklable
+        :return: Whatever the function returns
+        :raises ScraperError: Whatever the function raised
+        """
+        return self.submit(function, *args).result()
+
+    def close(self):
+        """ Shuts the worker processes down.
+        """
+        self.pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def run_parse(parse_pool, function, *args):
+    """ Runs a parse function in a ParsePool, or in the calling thread.
+
+    :param parse_pool: Optional ParsePool to run the function in
+    :param function: Module level parse function, e.g. parse_history_table
+    :param args: Arguments to call it with
+    :return: Whatever the function returns
+    """
+    if parse_pool is None:
+        return function(*args)
+    return parse_pool.run(function, *args)
+
+
+class DeferredParse(object):
+    """ A result whose page is still being parsed in a ParsePool.  It is
+    handed back by the fetching thread as soon as the page is read, so the
+    thread can start its next download instead of waiting on the parse.
+    Once the parse is done, result runs the rest of the job (climatology,
+    formatting, caching), scrape_jobs does so in one of its threads.
+    """
+
+    def __init__(self, future, finish):
+        """ :param future: concurrent.futures.Future of the parse
+        :param finish: Function taking a function which returns the parsed
+        table (or raises the parse's ScraperError), returning the result
+        """
+        self.future = future
+        self.finish = finish
+        self.lock = threading.Lock()
+        self.done = False
+        self.value = None
+
+    def result(self):
+        """ Waits for the parse and finishes the result, only once however
+        many jobs share it.
+
+        :return: The finished result
+        """
+        with self.lock:
+            if not self.done:
+                self.value = self.finish(self.future.result)
+                self.done = True
+            return self.value
+
+    def then(self, function):
+        """ :param function: Function to pass the finished result through
+        :return: DeferredParse of what the function returns
+        """
+        return DeferredParse(self.future, lambda parsed: function(self.result()))
+
+
+def parse_later(parse_pool, finish, function, *args):
+    """ Parses a table and finishes a result with it.  Without a ParsePool
+    both happen in the calling thread, with one a DeferredParse is returned
+    while the table is parsed.
+
+    :param parse_pool: Optional ParsePool to run the function in
+    :param finish: Function taking a function which returns the parsed
+    table (or raises the parse's ScraperError), returning the result
+    :param function: Module level parse function, e.g. parse_history_table
+    :param args: Arguments to call it with
+    :return: The result, or a DeferredParse of it
+    """
+    if parse_pool is None:
+        return finish(lambda: function(*args))
+    return DeferredParse(parse_pool.submit(function, *args), finish)
+
+
+def when_parsed(result, function):
+    """ :param result: A result, or a DeferredParse of one
+    :param function: Function to pass the finished result through
+    :return: What the function returns, or a DeferredParse of it
+    """
+    if isinstance(result, DeferredParse):
+        return result.then(function)
+    return function(result)
+
+
+def finished(result):
+    """ :param result: A result, or a DeferredParse of one
+    :return: The finished result, waiting for its parse if need be
+    """
+    if isinstance(result, DeferredParse):
+        return result.result()
+    return result
+
+
+def work_queue(queue, worker, concurrency=4, rate_limit=None, cache=None,
+               stations=None, base_url=WUNDERGROUND_URL, range_days=None,
+               climatology=None, lease_seconds=QUEUE_LEASE_SECONDS, poll=1.0):
+    """ Scrapes jobs pulled from a WorkQueue until it is drained.  Jobs are
+    leased a few at a time as scrape_jobs frees up, and a background thread
+    sends heartbeats so that they stay leased however long they take.
+    Each job is completed in the queue once its result has been handed on
+    and the next one is asked for, so a worker which dies mid-job loses no
+    results, its jobs are scraped again by another worker once their
+    leases run out.  When nothing is left to lease but other workers still
+    hold leases, the queue is polled in case they are abandoned.
+
+    :param queue: WorkQueue to pull jobs from
+    :param worker: Name of this worker, unique among the queue's workers
+    :param concurrency: Maximum number of requests in flight at once
+    :param rate_limit: Maximum requests per second for each host,
+    None for no limit
+    :param cache: Optional PageCache to answer from and fill
+    :param stations: Optional StationTable used to skip redirects
+    :param base_url: Scheme and host requests should be sent to
+    :param range_days: Fetch runs of at least this many days through the
+    range views, see scrape_jobs
+    :param climatology: Optional ClimatologyTable, see scrape_jobs
+    :param lease_seconds: Seconds each lease is held for between heartbeats
+    :param poll: Seconds to wait before looking for abandoned jobs again
+    :return: Generator of (location, date, json_data) tuples
+    """
+    def leased_jobs():
+        # Only leases more jobs when scrape_jobs asks for them, and stops
+        # as soon as there are none rather than waiting for more
+        while True:
+            jobs = queue.lease(worker, concurrency, lease_seconds)
+            if not jobs:
+                return
+            yield from jobs
+
+    def send_heartbeats():
+        while not stopped.wait(lease_seconds / 3.0):
+            queue.heartbeat(worker, lease_seconds)
+
+    stopped = threading.Event()
+    heartbeats = threading.Thread(target=send_heartbeats, daemon=True)
+    heartbeats.start()
+    try:
+        while True:
+            for location, date, json_data in scrape_jobs(
+                    leased_jobs(), concurrency, rate_limit, cache, stations,
+                    base_url=base_url, range_days=range_days,
+                    climatology=climatology):
+                yield location, date, json_data
+                error = None
+                if json_data.startswith('{"error"'):
+                    error = json.loads(json_data)['error']
+                queue.complete(worker, location, date, error)
+            counts = queue.counts()
+            if not counts['pending'] and not counts['leased']:
+                return
+            time.sleep(poll)
+    finally:
+        stopped.set()
+        heartbeats.join()
+        # Whatever is still held goes straight back rather than waiting
+        # for its lease to run out
+        queue.release(worker)
+
+
+def format_batch_result(location, date, json_data):
+    """ Combines a scrape result with the location and date it belongs to
+    as a single line of json, so batch output can be streamed line by line.
+
+    :param location: Location the data was scraped for
+    :param date: datetime.date the data was scraped for
+    :param json_data: json string returned by scrape_weather_data
+    :return: A single line json string
+    """
+    return json.dumps({'location': location,
+                       'date': date.isoformat(),
+                       'data': json.loads(json_data)}, sort_keys=True)
+
+
+class OutputSink(object):
+    """ Base class of the streaming output files written by the batch mode.
+    Results are buffered and written in batches to a '.partial' file next
+    to the output path, which is only renamed into place once the run is
+    closed, so a finished output file is never half written.  After every
+    batch the file is synced to disk and its length is saved to a
+    '.checkpoint' file.  If the run is killed, opening the same path again
+    cuts the partial file back to the last checkpoint and reads back which
+    jobs it already holds, so they can be skipped instead of refetched.
+    Only successful results should be written, so failed jobs are retried.
+    """
+    # Subclasses which can't pick up a partial file set this to False
+    resumable = True
+
+    def __init__(self, path, batch_size=100):
+        """ :param path: File to write the results to
+        :param batch_size: Number of results buffered between writes
+        """
+        self.path = path
+        self.partial_path = path + '.partial'
+        self.checkpoint_path = path + '.checkpoint'
+        self.batch_size = batch_size
+        self.completed = set()
+        self._batch = []
+        offset = self._read_checkpoint()
+        if offset is not None and self.resumable \
+                and os.path.exists(self.partial_path):
+            # Drop anything written after the last checkpoint
+            with open(self.partial_path, 'r+b') as partial_file:
+                partial_file.truncate(offset)
+            self.completed = set(self._read_keys())
+            self._file = open(self.partial_path, 'ab')
+        else:
+            self._file = open(self.partial_path, 'wb')
+            self._start()
+
+    def is_completed(self, location, date):
+        """ :param location: Validated location string
+        :param date: datetime.date of the job
+        :return: True if the job's result is already in the output
+        """
+        return (location_key(location), date.isoformat()) in self.completed
+
+    def write(self, location, date, json_data):
+        """ Buffers one result, writing the buffer out once it is full.
+
+        :param location: Location the data was scraped for
+        :param date: datetime.date the data was scraped for
+        :param json_data: json string returned by scrape_weather_data
+        """
+        self._batch.append((location, date, json.loads(json_data)))
+        self.completed.add((location_key(location), date.isoformat()))
+        if len(self._batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """ Writes out the buffered results, syncs them to disk, and saves
+        a checkpoint.
+        """
+        if self._batch:
+            self._write_batch(self._batch)
+            self._batch = []
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        temporary_path = self.checkpoint_path + '.tmp'
+        with open(temporary_path, 'w') as checkpoint_file:
+            json.dump({'offset': self._file.tell()}, checkpoint_file)
+        os.replace(temporary_path, self.checkpoint_path)
+
+    def close(self):
+        """ Writes out the remaining results and moves the finished file
+        into place.
+        """
+        self.flush()
+        self._finish()
+        self._file.close()
+        os.replace(self.partial_path, self.path)
+        os.remove(self.checkpoint_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        # Leave the partial file and checkpoint behind to resume from
+        # if the run didn't finish
+        if exc_type is None:
+            self.close()
+        else:
+            self.flush()
+            self._file.close()
+
+    def _read_checkpoint(self):
+        """ :return: Length of the partial file at the last checkpoint,
+        or None if there is no checkpoint
+        """
+        try:
+            with open(self.checkpoint_path) as checkpoint_file:
+                return json.load(checkpoint_file)['offset']
+        except (FileNotFoundError, ValueError, KeyError):
+            return None
+
+    def _start(self):
+        """ Writes anything which goes at the start of a new file.
+        """
+        pass
+
+    def _finish(self):
+        """ Writes anything which goes at the end of a finished file.
+        """
+        pass
+
+    def _write_batch(self, batch):
+        """ Writes a batch of results to the partial file.
+
+        :param batch: List of (location, date, field dictionary) tuples
+        """
+        raise NotImplementedError
+
+    def _read_keys(self):
+        """ Reads back the jobs already in the partial file.
+
+        :return: Iterable of (location key, iso date) tuples
+        """
+        raise NotImplementedError
+
+
+class NdjsonSink(OutputSink):
+    """ Writes one line of json per result, formatted like the batch mode
+    prints them.
+    """
+
+    def _write_batch(self, batch):
+        lines = [json.dumps({'location': location, 'date': date.isoformat(),
+                             'data': data}, sort_keys=True) + '\n'
+                 for location, date, data in batch]
+        self._file.write(''.join(lines).encode('utf-8'))
+
+    def _read_keys(self):
+        with open(self.partial_path, encoding='utf-8') as partial_file:
+            for line in partial_file:
+                result = json.loads(line)
+                yield location_key(result['location']), result['date']
+
+
+class CsvSink(OutputSink):
+    """ Writes one row per result with a column for each temperature.
+    """
+    columns = ['location', 'date'] + sorted(
+        key for columns in TEMPERATURE_FIELD_SPEC.values() for _, key in columns)
+
+    def _start(self):
+        self._write_rows([self.columns])
+
+    def _write_batch(self, batch):
+        self._write_rows([location, date.isoformat()]
+                         + [data.get(column, '') for column in self.columns[2:]]
+                         for location, date, data in batch)
+
+    def _write_rows(self, rows):
+        """ Formats rows as csv and writes them to the partial file.
+
+        :param rows: Iterable of lists of cell values
+        """
+        import csv
+        import io
+        text = io.StringIO()
+        csv.writer(text).writerows(rows)
+        self._file.write(text.getvalue().encode('utf-8'))
+
+    def _read_keys(self):
+        import csv
+        with open(self.partial_path, newline='', encoding='utf-8') as partial_file:
+            rows = csv.reader(partial_file)
+            next(rows, None)
+            for row in rows:
+                yield location_key(row[0]), row[1]
+
+
+class ParquetSink(OutputSink):
+    """ Writes results to a Parquet file, one row group per batch, with the
+    same columns as CsvSink.  Requires pyarrow, which is an optional
+    dependency.  A Parquet file can't be read until its footer is written,
+    so a killed run starts this file over rather than resuming it.
+    """
+    resumable = False
+
+    def _start(self):
+        import pyarrow
+        import pyarrow.parquet
+        self._schema = pyarrow.schema([(column, pyarrow.string())
+                                       for column in CsvSink.columns])
+        self._writer = pyarrow.parquet.ParquetWriter(self._file, self._schema)
+
+    def _write_batch(self, batch):
+        import pyarrow
+        columns = [[location for location, _, _ in batch],
+                   [date.isoformat() for _, date, _ in batch]]
+        columns += [[data.get(column, '') for _, _, data in batch]
+                    for column in CsvSink.columns[2:]]
+        self._writer.write_table(pyarrow.Table.from_arrays(columns,
+                                                           schema=self._schema))
+
+    def _finish(self):
+        self._writer.close()
+
+
+# Output sinks by format name
+SINKS = {'ndjson': NdjsonSink, 'csv': CsvSink, 'parquet': ParquetSink}
+
+
+def open_sink(path, output_format=None, batch_size=100):
+    """ Opens an output sink, resuming it if a previous run was killed.
+
+    :param path: File to write the results to
+    :param output_format: Name of a format in SINKS, guessed from the
+    path's extension if not provided (ndjson if it can't be guessed)
+    :param batch_size: Number of results buffered between writes
+    :return: The OutputSink
+    """
+    if output_format is None:
+        extension = os.path.splitext(path)[1].lstrip('.').lower()
+        output_format = extension if extension in SINKS else 'ndjson'
+    return SINKS[output_format](path, batch_size)
+
+
+def parse_date(date_string):
+    """ Converts a 'YYYY-MM-DD' string into a datetime.date.  Used as an
+    argparse type so bad dates are reported as usage errors.
+
+    :param date_string: String formatted as YYYY-MM-DD
+    :return: The matching datetime.date
+    """
+    import argparse
+    try:
+        return datetime.datetime.strptime(date_string, '%Y-%m-%d').date()
+    except ValueError:
+        raise argparse.ArgumentTypeError('"%s" is not a YYYY-MM-DD date'
+                                         % date_string)
+
+
+def validate_job(location_string, date_string):
+    """ Validates a job's location and 'YYYY-MM-DD' date string with the
+    same rules as the interactive prompts.
+
+    :param location_string: Location string to validate
+    :param date_string: Date string to validate
+    :return date: The job's datetime.date, or None if the job is invalid
+    :return error: Message saying what is invalid, or None if valid
+    """
+    if not validate_location(location_string):
+        return None, 'Location invalid'
+    date_parts = JOB_DATE_REGEX.search(date_string)
+    if date_parts is None:
+        return None, 'Date invalid'
+    year_string, month_string, day_string = date_parts.groups()
+    # The validators expect months and days without leading zeros
+    month_string = month_string.lstrip('0')
+    day_string = day_string.lstrip('0')
+    if not validate_month(month_string):
+        return None, 'Month invalid'
+    if not validate_day(day_string, month_string):
+        return None, 'Day invalid'
+    try:
+        if not validate_year(year_string, month_string, day_string):
+            return None, 'Year invalid'
+    except ValueError:
+        # validate_month lets some impossible months like '20' through
+        return None, 'Month invalid'
+    return datetime.date(int(year_string), int(month_string), int(day_string)), None
+
+
+MONTH_DAY_TABLE = None
+
+
+def month_day_table():
+    """ Builds the calendar table validate_dates checks dates against, once.
+    Every month and day a YYYY-MM-DD date can be written with (one or two
+    digits each) is run through validate_month and validate_day, so bulk
+    validation agrees with the prompts without calling them per date.
+
+    :return: Dictionary of (month digits, day digits) -> (month number,
+    day number, error message or None)
+    """
+    global MONTH_DAY_TABLE
+    if MONTH_DAY_TABLE is None:
+        digits = [str(number) for number in range(10)]
+        digits += ['%02d' % number for number in range(100)]
+        table = dict()
+        for month_digits in digits:
+            # The validators expect months and days without leading zeros
+            month_string = month_digits.lstrip('0')
+            month_valid = validate_month(month_string)
+            for day_digits in digits:
+                day_string = day_digits.lstrip('0')
+                if not month_valid:
+                    error = 'Month invalid'
+                elif not validate_day(day_string, month_string):
+                    error = 'Day invalid'
+                elif int(month_string) > 12:
+                    # validate_month lets some impossible months like '20' through
+                    error = 'Month invalid'
+                else:
+                    error = None
+                table[month_digits, day_digits] = (int(month_string or 0),
+                                                   int(day_string or 0), error)
+        MONTH_DAY_TABLE = table
+    return MONTH_DAY_TABLE
+
+
+def validate_dates(date_strings, today=None):
+    """ Validates many 'YYYY-MM-DD' date strings at once with the same rules
+    as validate_job.  Each distinct string is checked only once, with a
+    lookup in the month_day_table, a leap year check for February 29th, and
+    a comparison against today, which is only looked up once per call.
+    Thousands of stations asking for the same dates cost the same as one.
+
+    :param date_strings: Iterable of date strings to validate
+    :param today: datetime.date dates after which are invalid, today if not
+    provided
+    :return: Dictionary of date string -> (datetime.date or None, error
+    message or None)
+    """
+    import calendar
+    table = month_day_table()
+    today = today or datetime.date.today()
+    latest = (today.year, today.month, today.day)
+    results = dict()
+    for date_string in date_strings:
+        if date_string in results:
+            continue
+        date_parts = JOB_DATE_REGEX.search(date_string)
+        if date_parts is None:
+            results[date_string] = (None, 'Date invalid')
+            continue
+        year_string, month_digits, day_digits = date_parts.groups()
+        month, day, error = table[month_digits, day_digits]
+        year = int(year_string)
+        if error is not None:
+            pass
+        elif year < 1:
+            # validate_job can't build a date for year 0 and reports the month
+            error = 'Month invalid'
+        elif month == 2 and day == 29 and not calendar.isleap(year):
+            error = 'Year invalid'
+        elif (year, month, day) > latest:
+            error = 'Year invalid'
+        if error is None:
+            results[date_string] = (datetime.date(year, month, day), None)
+        else:
+            results[date_string] = (None, error)
+    return results
+
+
+def validate_jobs(requested, today=None):
+    """ Validates many (location, date string) jobs at once with the same
+    rules as validate_job, checking each distinct location and date string
+    only once (see validate_dates).
+
+    :param requested: List of (location string, date string) tuples
+    :param today: datetime.date dates after which are invalid, today if not
+    provided
+    :return jobs: List of valid (location, datetime.date) jobs, in order
+    :return errors: List of (location, date string, error message) tuples,
+    one per invalid job
+    """
+    dates = validate_dates((date_string for _, date_string in requested), today)
+    locations = dict()
+    jobs = []
+    errors = []
+    for location, date_string in requested:
+        location_valid = locations.get(location)
+        if location_valid is None:
+            location_valid = locations[location] = validate_location(location)
+        if not location_valid:
+            errors.append((location, date_string, 'Location invalid'))
+            continue
+        date, error = dates[date_string]
+        if error is None:
+            jobs.append((location, date))
+        else:
+            errors.append((location, date_string, error))
+    return jobs, errors
+
+
+def expand_jobs(locations, ranges):
+    """ Lazily expands date ranges into a job for every location and day.
+    Each range's days are built once, from ordinals, and shared by every
+    location rather than stepped through again for each one.
+
+    :param locations: List of valid location strings
+    :param ranges: List of (first datetime.date, last datetime.date) tuples
+    :return: Generator of (location, datetime.date) jobs, location by location
+    """
+    spans = [[datetime.date.fromordinal(ordinal) for ordinal in
+              range(start_date.toordinal(), end_date.toordinal() + 1)]
+             for start_date, end_date in ranges]
+    for location in locations:
+        for dates in spans:
+            yield from zip(itertools.repeat(location), dates)
+
+
+def read_jobs(lines):
+    """ Reads jobs from lines of text, one 'location date' per line, e.g.
+    'Atlanta, GA 2017-10-11'.  The date is whatever follows the last run of
+    whitespace.  Blank lines and lines starting with '#' are skipped.
+
+    :param lines: Iterable of lines, e.g. an open file or sys.stdin
+    :return: Generator of (location string, date string) tuples
+    """
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        parts = line.rsplit(None, 1)
+        if len(parts) == 2:
+            yield parts[0], parts[1]
+        else:
+            yield line, ''
+
+
+def plan_jobs(arguments, stdin=None):
+    """ Collects and validates the jobs asked for on the command line and in
+    the jobs file.  Single jobs are all validated up front, date ranges are
+    expanded lazily.
+
+    :param arguments: argparse.Namespace returned by parse_arguments
+    :param stdin: File to read jobs from when the jobs file is '-',
+    sys.stdin if not provided
+    :return jobs: Iterable of valid (location, datetime.date) jobs
+    :return errors: List of json strings, one per invalid job
+    """
+    requested = []
+    for location in arguments.locations:
+        for date_string in arguments.dates:
+            requested.append((location, date_string))
+    if arguments.jobs_file == '-':
+        requested.extend(read_jobs(stdin or sys.stdin))
+    elif arguments.jobs_file:
+        with open(arguments.jobs_file) as jobs_file:
+            requested.extend(read_jobs(jobs_file))
+    jobs, invalid = validate_jobs(requested)
+    errors = [format_job_error(location, date_string, error)
+              for location, date_string, error in invalid]
+    range_locations = []
+    if arguments.start is not None:
+        for location in arguments.locations:
+            if validate_location(location):
+                range_locations.append(location)
+            else:
+                errors.append(format_job_error(location, None, 'Location invalid'))
+    range_jobs = expand_jobs(range_locations, [(arguments.start, arguments.end)])
+    return itertools.chain(jobs, range_jobs), errors
+
+
+def plan_sync(jobs, store=None, cache=None, revise_days=SYNC_REVISE_DAYS,
+              today=None):
+    """ Diffs jobs against what is already stored or cached, so a sync only
+    fetches the days which are missing, plus the last revise_days days up
+    to today, which wunderground may still have been revising when they
+    were fetched.  Cached results of those recent days are discarded so
+    they are fetched again rather than answered from the cache.  Each
+    location's stored and cached dates are read with one query per
+    location rather than one per job.
+
+    :param jobs: Iterable of (validated location string, datetime.date)
+    :param store: Optional HistoryStore of days already scraped
+    :param cache: Optional PageCache of results already scraped
+    :param revise_days: Number of most recent days always fetched again
+    :param today: datetime.date the recent days end on, today if not
+    provided
+    :return jobs: List of the (location, datetime.date) jobs to fetch,
+    in the order they were given
+    :return counts: Dictionary with the number of jobs 'planned' and
+    'skipped', and how many of the planned ones are 'revised' days which
+    were already stored or cached
+    """
+    jobs = list(jobs)
+    revise_from = (today or datetime.date.today()) - \
+        datetime.timedelta(days=revise_days - 1)
+    # First and last date asked for at each location
+    spans = dict()
+    for location, date in jobs:
+        first, last = spans.get(location, (date, date))
+        spans[location] = (min(first, date), max(last, date))
+    known = dict()
+    for location, (first, last) in spans.items():
+        known[location] = set()
+        if store is not None:
+            known[location] |= store.stored_dates(location, first, last)
+        if cache is not None:
+            known[location] |= cache.cached_dates(location, first, last)
+    planned = []
+    counts = {'planned': 0, 'skipped': 0, 'revised': 0}
+    for location, date in jobs:
+        if date not in known[location]:
+            planned.append((location, date))
+        elif date >= revise_from:
+            counts['revised'] += 1
+            if cache is not None:
+                cache.discard(location, date)
+            planned.append((location, date))
+        else:
+            counts['skipped'] += 1
+    counts['planned'] = len(planned)
+    return planned, counts
+
+
+def format_job_error(location, date_string, message):
+    """ Formats an invalid job as a single line of json.
+
+    :param location: Location string of the job
+    :param date_string: Date string of the job, None for a whole range
+    :param message: What is invalid about the job
+    :return: A single line json string
+    """
+    return json.dumps({'location': location, 'date': date_string,
+                       'error': message}, sort_keys=True)
+
+
+def parse_arguments(argv):
+    """ Parses the command line arguments for the non-interactive batch mode
+    and the service mode.  Jobs can be given as locations with --date
+    and/or --start and --end, and as lines of a jobs file (or stdin).
+
+    :param argv: List of command line arguments, excluding the program name
+    :return: argparse.Namespace with locations, dates, start, end,
+    jobs_file, range_days, revise_days, concurrency, parse_workers,
+    rate_limit, cache, climatology, store, archive, replay, stations,
+    metrics, profile, serve, lru_size, queue, work, output and format
+    attributes
+    """
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Scrape wunderground history for many locations and dates.')
+    parser.add_argument('--location', dest='locations', action='append',
+                        default=[],
+                        help='Location to scrape, may be given more than once')
+    parser.add_argument('--date', dest='dates', action='append', default=[],
+                        help='Date to scrape for each location (YYYY-MM-DD), '
+                             'may be given more than once')
+    parser.add_argument('--start', type=parse_date, default=None,
+                        help='First date of a range to scrape for each '
+                             'location (YYYY-MM-DD)')
+    parser.add_argument('--end', type=parse_date, default=None,
+                        help='Last date of the range (YYYY-MM-DD)')
+    parser.add_argument('--jobs-file', default=None,
+                        help='File of jobs, one "location YYYY-MM-DD" per '
+                             'line, or - to read them from stdin')
+    parser.add_argument('--range-view', dest='range_days', type=int,
+                        nargs='?', const=RANGE_MIN_DAYS, default=None,
+                        metavar='MIN_DAYS',
+                        help='Fetch runs of at least MIN_DAYS days in a month '
+                             '(default %s) with one request for the monthly '
+                             'or custom history page.  Only actual '
+                             'temperatures are scraped unless --climatology '
+                             'is given.' % RANGE_MIN_DAYS)
+    parser.add_argument('--sync', dest='revise_days', type=int, nargs='?',
+                        const=SYNC_REVISE_DAYS, default=None,
+                        metavar='REVISE_DAYS',
+                        help='Only fetch the days missing from --store or '
+                             '--cache, plus the last REVISE_DAYS days up to '
+                             'today (default %s) which may have been revised'
+                             % SYNC_REVISE_DAYS)
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help='Maximum number of requests in flight')
+    parser.add_argument('--parse-workers', type=int, nargs='?', const=0,
+                        default=None, metavar='N',
+                        help='Parse pages in N processes (one per core if N '
+                             'is left out) instead of in the fetching threads')
+    parser.add_argument('--rate-limit', type=float, default=None,
+                        help='Maximum requests per second to wunderground')
+    parser.add_argument('--cache', default=None,
+                        help='SQLite file to cache results in between runs')
+    parser.add_argument('--climatology', default=None,
+                        help='SQLite file keeping each station\'s average '
+                             'and record temperatures by day of the year, '
+                             'to reuse across years')
+    parser.add_argument('--store', default=None,
+                        help='SQLite file to keep every day scraped in, to '
+                             'query later without the network')
+    parser.add_argument('--archive', default=None,
+                        help='Directory to keep the compressed tables of '
+                             'every page read in, to parse again later with '
+                             '--replay')
+    parser.add_argument('--replay', default=None, metavar='ARCHIVE',
+                        help='Parse every page kept in an --archive directory '
+                             'again instead of scraping, without the network')
+    parser.add_argument('--stations', default=None,
+                        help='Json file remembering the station each '
+                             'location redirects to')
+    parser.add_argument('--metrics', default=None,
+                        help='File to write timings and counters for the '
+                             'run to, as a json summary if it ends in .json '
+                             'and in the Prometheus text format otherwise, '
+                             'or - for a json summary on stderr')
+    parser.add_argument('--profile', default=None,
+                        help='File to dump cProfile stats for the run to, '
+                             'read them with "python -m pstats FILE"')
+    parser.add_argument('--serve', type=parse_address, default=None,
+                        metavar='[HOST:]PORT',
+                        help='Run as a service answering lookups over HTTP '
+                             'instead of running a batch')
+    parser.add_argument('--lru-size', type=int, default=10000,
+                        help='Most results the service keeps in memory')
+    parser.add_argument('--queue', default=None,
+                        help='SQLite file (or NAME://LOCATION of another '
+                             'backend) to add the jobs to, for workers '
+                             'started with --work to share out')
+    parser.add_argument('--work', type=int, nargs='?', const=1, default=None,
+                        metavar='PROCESSES',
+                        help='Scrape the jobs in --queue in PROCESSES worker '
+                             'processes (default 1) until it is drained, '
+                             'writing the results to --store')
+    parser.add_argument('--output', default=None,
+                        help='File to stream results to instead of stdout, '
+                             'a killed run resumes where it left off')
+    parser.add_argument('--format', choices=sorted(SINKS), default=None,
+                        help='Format of the output file, guessed from its '
+                             'extension by default')
+    args = parser.parse_args(argv)
+    if (args.start is None) != (args.end is None):
+        parser.error('--start and --end must be given together')
+    if args.start is not None:
+        if args.end < args.start:
+            parser.error('--end must not be before --start')
+        if args.end > datetime.date.today():
+            parser.error('--end must be today or in the past')
+    if args.locations and not (args.dates or args.start):
+        parser.error('--location needs --date or --start and --end')
+    if not (args.locations or args.jobs_file or args.serve or args.replay
+            or args.work):
+        parser.error('give --location, --jobs-file, --replay or --work')
+    if args.work is not None and args.queue is None:
+        parser.error('--work needs a --queue to pull jobs from')
+    if args.work is not None and args.output:
+        parser.error('--output can\'t be shared between workers, use --store')
+    if args.queue is not None:
+        # Workers don't archive, profile or collect metrics
+        unsupported = [flag for flag, value in (
+            ('--archive', args.archive), ('--parse-workers', args.parse_workers),
+            ('--metrics', args.metrics), ('--profile', args.profile))
+            if value is not None]
+        if unsupported:
+            parser.error('%s can\'t be used with --queue' % ', '.join(unsupported))
+    if args.revise_days is not None and not (args.store or args.cache):
+        parser.error('--sync needs --store or --cache to sync against')
+    return args
+
+
+def run_batch(arguments):
+    """ Runs the non-interactive batch mode.  Results are printed as one
+    json line each, or streamed to the output file with errors printed to
+    stderr instead.
+
+    :param arguments: argparse.Namespace returned by parse_arguments
+    """
+    metrics = enable_metrics() if arguments.metrics else None
+    profiler = Profiler() if arguments.profile else None
+    try:
+        if profiler is None:
+            scrape_batch(arguments)
+        else:
+            profiler.call(scrape_batch, arguments, profiler)
+    finally:
+        if profiler is not None:
+            profiler.dump(arguments.profile)
+        if metrics is not None:
+            write_metrics(metrics, arguments.metrics)
+            disable_metrics()
+
+
+def write_metrics(metrics, path):
+    """ Exports metrics at the end of a run.
+
+    :param metrics: The run's Metrics
+    :param path: File to write to, a json summary if it ends in .json and
+    the Prometheus text format otherwise, or - for a json summary on stderr
+    """
+    if path == '-':
+        print(json.dumps({'metrics': metrics.summary()}, sort_keys=True),
+              file=sys.stderr)
+    elif path.lower().endswith('.json'):
+        with open(path, 'w') as metrics_file:
+            json.dump(metrics.summary(), metrics_file, indent=2, sort_keys=True)
+    else:
+        with open(path, 'w') as metrics_file:
+            metrics_file.write(metrics.to_prometheus())
+
+
+def scrape_batch(arguments, profiler=None):
+    """ Scrapes the jobs of a batch run and writes out their results.
+    See run_batch.
+
+    :param arguments: argparse.Namespace returned by parse_arguments
+    :param profiler: Optional Profiler to run the worker threads under
+    """
+    jobs, errors = plan_jobs(arguments)
+    # Invalid jobs are reported and left out, the rest still run
+    for error in errors:
+        print(error, file=sys.stderr)
+    page_cache = None
+    if arguments.cache:
+        page_cache = PageCache(arguments.cache)
+    climatology = None
+    if arguments.climatology:
+        climatology = ClimatologyTable(arguments.climatology)
+    store = None
+    if arguments.store:
+        store = HistoryStore(arguments.store)
+    archive = None
+    if arguments.archive:
+        archive = PageArchive(arguments.archive)
+    station_table = StationTable(arguments.stations)
+    if arguments.revise_days is not None:
+        jobs, counts = plan_sync(jobs, store, page_cache, arguments.revise_days)
+        print(json.dumps({'sync': counts}, sort_keys=True), file=sys.stderr)
+    sink = None
+    if arguments.output:
+        sink = open_sink(arguments.output, arguments.format)
+    skip = sink.is_completed if sink is not None else None
+    replayed = None
+    if arguments.replay:
+        replayed = PageArchive(arguments.replay)
+        results = ((location, date, json_data) for location, date, json_data
+                   in replay_archive(replayed, arguments.parse_workers)
+                   if skip is None or not skip(location, date))
+    else:
+        results = scrape_jobs(
+            jobs, arguments.concurrency, arguments.rate_limit, page_cache,
+            station_table, skip, range_days=arguments.range_days,
+            climatology=climatology, profiler=profiler,
+            parse_workers=arguments.parse_workers, archive=archive)
+    for location, date, json_data in results:
+        if store is not None:
+            store.put_json(location, date, json_data)
+        if sink is None:
+            print(format_batch_result(location, date, json_data), flush=True)
+        elif json_data.startswith('{"error"'):
+            print(format_batch_result(location, date, json_data), file=sys.stderr)
+        else:
+            sink.write(location, date, json_data)
+    if sink is not None:
+        sink.close()
+    if store is not None:
+        store.close()
+    if archive is not None:
+        archive.close()
+    if replayed is not None:
+        replayed.close()
+    if page_cache is not None:
+        # Report the cache counters without mixing them into the results
+        print(json.dumps({'cache': page_cache.stats()}), file=sys.stderr)
+        page_cache.close()
+    if climatology is not None:
+        print(json.dumps({'climatology': climatology.stats()}), file=sys.stderr)
+        climatology.close()
+    coalesced = SINGLE_FLIGHT.stats()
+    if coalesced['shared']:
+        # Only worth mentioning when duplicate jobs were asked for
+        print(json.dumps({'coalesced': coalesced}, sort_keys=True), file=sys.stderr)
+
+
+class ResultLRU(object):
+    """ A bounded in-memory cache of scrape results for the service mode,
+    evicting the least recently used result once it holds max_entries.
+    Only used from the service's event loop thread, so it has no lock.
+    """
+
+    def __init__(self, max_entries=10000):
+        """ :param max_entries: Most results to keep
+        """
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._results = collections.OrderedDict()
+
+    def get(self, key):
+        """ :param key: Key the result was stored under
+        :return: The result, or None on a miss
+        """
+        json_data = self._results.get(key)
+        if json_data is None:
+            self.misses += 1
+            METRICS.count('cache_requests_total', cache='lru', result='miss')
+            return None
+        self._results.move_to_end(key)
+        self.hits += 1
+        METRICS.count('cache_requests_total', cache='lru', result='hit')
+        return json_data
+
+    def put(self, key, json_data):
+        """ :param key: Key to store the result under
+        :param json_data: json string returned by scrape_weather_data
+        """
+        self._results[key] = json_data
+        self._results.move_to_end(key)
+        if len(self._results) > self.max_entries:
+            self._results.popitem(last=False)
+
+    def stats(self):
+        """ :return: Dictionary of the hit, miss and size counters
+        """
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self._results)}
+
+
+class HistoryService(object):
+    """ Answers lookups over HTTP from a long-running process, so callers
+    don't pay for starting the interpreter and opening a connection to
+    wunderground on every lookup.  An asyncio server handles the clients,
+    keeping their connections alive, and hands the scrapes to a pool of
+    threads sharing one warm Fetcher, RateLimiter and StationTable.
+    Results are kept in a ResultLRU, and concurrent lookups of the same
+    station and date are coalesced (see SINGLE_FLIGHT).
+    Endpoints:
+    * GET /history?location=...&date=YYYY-MM-DD answers one lookup
+    * POST /history with a json body of {"jobs": [{"location": ...,
+      "date": ...}, ...]} answers up to SERVICE_MAX_JOBS lookups at once,
+      as a json list in the same order
+    * GET /stats reports the LRU and coalescing counters
+    Lookups are answered like batch mode results (see format_batch_result)
+    with a 200, or a 502 if wunderground couldn't be scraped.  Invalid
+    lookups are answered with a 400, like format_job_error.
+    """
+
+    def __init__(self, concurrency=8, rate_limit=None, cache=None,
+                 stations=None, lru_size=10000, base_url=WUNDERGROUND_URL):
+        """ :param concurrency: Maximum number of requests to wunderground
+        in flight
+        :param rate_limit: Maximum requests per second to wunderground,
+        None for no limit
+        :param cache: Optional PageCache to answer from and fill
+        :param stations: Optional StationTable used to skip redirects
+        :param lru_size: Most results kept in memory
+        :param base_url: Scheme and host requests should be sent to
+        """
+        import concurrent.futures
+        self.cache = cache
+        self.stations = stations if stations is not None else StationTable()
+        self.base_url = base_url
+        self.lru = ResultLRU(lru_size)
+        self.fetcher = Fetcher(pool_size=concurrency)
+        self.rate_limiter = RateLimiter(rate_limit)
+        self.executor = concurrent.futures.ThreadPoolExecutor(concurrency)
+        # Tasks serving the connections currently open
+        self._connections = set()
+
+    async def lookup(self, location, date):
+        """ Scrapes a location and date, answering from the LRU if it can.
+        Today's results are still filling in, so only past dates are kept.
+
+        :param location: Validated location string
+        :param date: datetime.date to scrape
+        :return: A string containing the temperature data formatted as a
+        json, or the error formatted as a json
+        """
+        import asyncio
+        key = coalesce_key(location, date, self.stations)
+        json_data = self.lru.get(key)
+        if json_data is not None:
+            return json_data
+        json_data = await asyncio.get_event_loop().run_in_executor(
+            self.executor, scrape_location_date, location, date,
+            self.rate_limiter, self.fetcher, self.cache, self.stations,
+            self.base_url)
+        if date < datetime.date.today() and not json_data.startswith('{"error"'):
+            # The scrape may have taught the StationTable the location's
+            # station, store it under the key later lookups will use
+            self.lru.put(coalesce_key(location, date, self.stations), json_data)
+        return json_data
+
+    async def answer(self, location, date_string):
+        """ Validates and answers one lookup.
+
+        :param location: Location string asked for
+        :param date_string: 'YYYY-MM-DD' date string asked for
+        :return status_code: 200, 400 if the lookup is invalid, or 502 if
+        wunderground couldn't be scraped
+        :return body: json string of the result
+        """
+        date, error = validate_job(location, date_string)
+        if error is not None:
+            return 400, format_job_error(location, date_string, error)
+        json_data = await self.lookup(location, date)
+        status_code = 502 if json_data.startswith('{"error"') else 200
+        return status_code, format_batch_result(location, date, json_data)
+
+    async def route(self, method, target, body):
+        """ Answers one HTTP request.
+
+        :param method: Request method, e.g. 'GET'
+        :param target: Request target, the path and query string
+        :param body: Bytes of the request body
+        :return status_code: HTTP status code of the response
+        :return payload: json string to respond with
+        """
+        import asyncio
+        import urllib.parse
+        url = urllib.parse.urlsplit(target)
+        if url.path == '/stats' and method == 'GET':
+            return 200, json.dumps({'lru': self.lru.stats(),
+                                    'coalesced': SINGLE_FLIGHT.stats()},
+                                   sort_keys=True)
+        if url.path != '/history':
+            return 404, json.dumps({'error': 'Not found'})
+        if method == 'GET':
+            query = urllib.parse.parse_qs(url.query)
+            return await self.answer(query.get('location', [''])[0],
+                                     query.get('date', [''])[0])
+        if method != 'POST':
+            return 405, json.dumps({'error': 'Method not allowed'})
+        try:
+            jobs = [(job['location'], job['date'])
+                    for job in json.loads(body.decode('utf-8'))['jobs']]
+        except (ValueError, KeyError, TypeError):
+            return 400, json.dumps({'error': 'Body must be {"jobs": '
+                                             '[{"location": ..., "date": ...}]}'})
+        if len(jobs) > SERVICE_MAX_JOBS:
+            return 413, json.dumps({'error': 'At most %s jobs per request'
+                                             % SERVICE_MAX_JOBS})
+        answers = await asyncio.gather(*(self.answer(str(location), str(date))
+                                         for location, date in jobs))
+        return 200, '[%s]' % ', '.join(answer for _, answer in answers)
+
+    async def handle_connection(self, reader, writer):
+        """ Serves the requests a client sends over one connection, keeping
+        it open between requests unless the client asks to close it.
+
+        :param reader: asyncio.StreamReader of the connection
+        :param writer: asyncio.StreamWriter of the connection
+        """
+        import asyncio
+        import http
+        task = asyncio.current_task()
+        self._connections.add(task)
+        try:
+            while True:
+                status_code = None
+                try:
+                    request_line = await reader.readline()
+                    if not request_line.strip():
+                        break
+                    headers = dict()
+                    while True:
+                        line = await reader.readline()
+                        if not line.strip():
+                            break
+                        name, _, value = line.decode('latin-1').partition(':')
+                        headers[name.strip().lower()] = value.strip()
+                    method, target, version = request_line.decode('latin-1').split()
+                    length = int(headers.get('content-length') or 0)
+                    if length > SERVICE_MAX_BODY:
+                        status_code, payload = 413, json.dumps(
+                            {'error': 'Request body is over %s bytes' % SERVICE_MAX_BODY})
+                    else:
+                        body = await reader.readexactly(length)
+                except (ValueError, asyncio.LimitOverrunError):
+                    # A line over the reader's limit, a malformed request line
+                    # or a bad Content-Length
+                    status_code, payload = 400, json.dumps({'error': 'Bad request'})
+                if status_code is None:
+                    with METRICS.timer('service'):
+                        status_code, payload = await self.route(method, target, body)
+                    keep_alive = version == 'HTTP/1.1' and \
+                        headers.get('connection', '').lower() != 'close'
+                else:
+                    # The rest of the request is left unread, so the
+                    # connection can't be used for another one
+                    keep_alive = False
+                payload = payload.encode('utf-8')
+                writer.write(('HTTP/1.1 %s %s\r\nContent-Type: application/json\r\n'
+                              'Content-Length: %s\r\nConnection: %s\r\n\r\n'
+                              % (status_code, http.HTTPStatus(status_code).phrase,
+                                 len(payload), 'keep-alive' if keep_alive else 'close')
+                              ).encode('latin-1') + payload)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            # The client went away, there is nobody left to answer
+            pass
+        except asyncio.CancelledError:
+            # Hung up on by stop, which doesn't need to hear about it
+            pass
+        finally:
+            self._connections.discard(task)
+            writer.close()
+
+    async def start(self, host='127.0.0.1', port=8080):
+        """ Starts listening on the current event loop.
+
+        :param host: Address to listen on
+        :param port: Port to listen on, 0 for any free port
+        :return: asyncio.Server, whose sockets hold the port listened on
+        """
+        import asyncio
+        return await asyncio.start_server(self.handle_connection, host, port)
+
+    async def stop(self, server):
+        """ Stops listening and hangs up on the clients still connected.
+
+        :param server: asyncio.Server returned by start
+        """
+        import asyncio
+        server.close()
+        for task in self._connections:
+            task.cancel()
+        await asyncio.gather(*self._connections, return_exceptions=True)
+        await server.wait_closed()
+
+    def close(self):
+        """ Waits for the scrapes in flight and closes the pooled
+        connections.
+        """
+        self.executor.shutdown()
+        self.fetcher.close()
+
+
+def parse_address(address):
+    """ Splits a '[HOST:]PORT' address, used as an argparse type.
+
+    :param address: Address string, e.g. '8080' or '0.0.0.0:8080'
+    :return: Tuple of (host, port), host defaults to 127.0.0.1
+    """
+    import argparse
+    host, _, port = address.rpartition(':')
+    try:
+        return host or '127.0.0.1', int(port)
+    except ValueError:
+        raise argparse.ArgumentTypeError('"%s" is not a [HOST:]PORT address'
+                                         % address)
+
+
+def run_service(arguments):
+    """ Runs the service mode until it is interrupted.
+
+    :param arguments: argparse.Namespace returned by parse_arguments
+    """
+    import asyncio
+    page_cache = PageCache(arguments.cache) if arguments.cache else None
+    service = HistoryService(arguments.concurrency, arguments.rate_limit,
+                             page_cache, StationTable(arguments.stations),
+                             arguments.lru_size)
+    loop = asyncio.new_event_loop()
+    server = loop.run_until_complete(service.start(*arguments.serve))
+    print(json.dumps({'serving': 'http://%s:%s' % server.sockets[0].getsockname()[:2]}),
+          file=sys.stderr)
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        loop.run_until_complete(service.stop(server))
+        loop.close()
+        service.close()
+        if page_cache is not None:
+            page_cache.close()
+
+
+def run_queue(arguments):
+    """ Runs the work queue mode.  The jobs asked for are added to the
+    queue, then with --work that many worker processes are started to
+    scrape the queue until it is drained.  Workers on other machines join
+    in by running with the same --queue and --work.
+
+    :param arguments: argparse.Namespace returned by parse_arguments
+    """
+    jobs, errors = plan_jobs(arguments)
+    for error in errors:
+        print(error, file=sys.stderr)
+    with open_queue(arguments.queue) as queue:
+        added = queue.put(jobs)
+        print(json.dumps({'queued': added}), file=sys.stderr)
+    if arguments.work == 1:
+        run_worker(arguments)
+    elif arguments.work:
+        import multiprocessing
+        # Spawned rather than forked for the same reasons as ParsePool
+        context = multiprocessing.get_context('spawn')
+        workers = [context.Process(target=run_worker, args=(arguments,))
+                   for _ in range(arguments.work)]
+        for process in workers:
+            process.start()
+        for process in workers:
+            process.join()
+    with open_queue(arguments.queue) as queue:
+        print(json.dumps({'queue': queue.counts()}, sort_keys=True),
+              file=sys.stderr)
+
+
+def run_worker(arguments, base_url=WUNDERGROUND_URL):
+    """ Runs one worker of the work queue mode, see work_queue.  Results
+    go to the --store shared between the workers, with only errors printed
+    on stderr, or are printed one json line each without one.
+
+    :param arguments: argparse.Namespace returned by parse_arguments
+    :param base_url: Scheme and host requests should be sent to
+    """
+    import socket
+    worker = '%s:%s' % (socket.gethostname(), os.getpid())
+    # Each day is written before its job is completed, so a worker dying
+    # can't lose results the queue counts as done
+    store = HistoryStore(arguments.store, batch_size=1) if arguments.store else None
+    page_cache = PageCache(arguments.cache) if arguments.cache else None
+    climatology = None
+    if arguments.climatology:
+        climatology = ClimatologyTable(arguments.climatology)
+    queue = open_queue(arguments.queue)
+    try:
+        for location, date, json_data in work_queue(
+                queue, worker, arguments.concurrency, arguments.rate_limit,
+                page_cache, StationTable(arguments.stations), base_url,
+                arguments.range_days, climatology):
+            if store is not None:
+                store.put_json(location, date, json_data)
+                if json_data.startswith('{"error"'):
+                    print(format_batch_result(location, date, json_data),
+                          file=sys.stderr)
+            else:
+                print(format_batch_result(location, date, json_data), flush=True)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        queue.close()
+        for resource in (store, page_cache, climatology):
+            if resource is not None:
+                resource.close()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        arguments = parse_arguments(sys.argv[1:])
+        if arguments.serve is not None:
+            # Long-running service mode, answers lookups over HTTP
+            run_service(arguments)
+        elif arguments.queue is not None:
+            # Work queue mode, shares the jobs out between workers
+            run_queue(arguments)
+        else:
+            # Non-interactive batch mode, one json line per result
+            run_batch(arguments)
+        sys.exit()
     # Get inputs from the user
     location, month, day, year = get_inputs()
     # Get the results url for the location from wunderground
@@ -0,0 +1,663 @@
+""" Module: wunderground_scraper_benchmarks.py
+
+The purpose of this module is to provide performance benchmarks for the
+wunderground_scraper.py module.  Every benchmark runs against local stand-in
+servers and saved fixture pages, so no network access is needed.  In order to
+run these benchmarks, navigate to the root project directory and run the
+following command:
+
+'python wunderground_scraper_benchmarks.py'
+
+Each benchmark prints its timings and fails if the optimization it measures
+stops paying off, or if a measurement regresses past its stored baseline in
+benchmark_baselines.json.  Baselines depend on the machine, so after changing
+machines (or deliberately changing performance) record new ones with:
+
+'UPDATE_BASELINES=1 python wunderground_scraper_benchmarks.py'
+NOTE:  This assumes you are running within an activated virtual environment
+and have the project's requirements already installed.  See the project README
+for instructions on setting that up.
+"""
+import datetime
+import json
+import os
+import requests
+import time
+import tracemalloc
+import unittest
+import wunderground_scraper
+from bs4 import BeautifulSoup
+from wunderground_scraper_tests import FakeWundergroundServer, HAVE_LXML, \
+    read_fixture
+
+
+BASELINES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'benchmark_baselines.json')
+# How far past its baseline a measurement may drift before it fails,
+# timings are noisier than sizes
+TIME_TOLERANCE = 2.0
+SIZE_TOLERANCE = 1.25
+UPDATE_BASELINES = bool(os.environ.get('UPDATE_BASELINES'))
+
+
+def load_baselines():
+    """ :return: Dictionary of measurement name -> stored baseline value
+    """
+    try:
+        with open(BASELINES_PATH) as baselines_file:
+            return json.load(baselines_file)
+    except FileNotFoundError:
+        return dict()
+
+
+BASELINES = load_baselines()
+
+
+def tearDownModule():
+    """ Saves the measurements as the new baselines when asked to.
+    """
+    if UPDATE_BASELINES:
+        with open(BASELINES_PATH, 'w') as baselines_file:
+            json.dump(BASELINES, baselines_file, indent=2, sort_keys=True)
+            baselines_file.write('\n')
+
+
+def report(name, value, unit):
+    """ Prints a single benchmark measurement.
+
+    :param name: What was measured
+    :param value: The measurement
+    :param unit: Unit the measurement is in
+    """
+    print('%-50s %10.3f %s' % (name, value, unit))
+
+
+def check_baseline(test, name, value, tolerance=TIME_TOLERANCE,
+                   higher_is_better=False):
+    """ Fails a benchmark if a measurement has regressed past its stored
+    baseline, or records it as the new baseline when updating them.
+    Measurements without a baseline only print a note.
+
+    :param test: The running unittest.TestCase
+    :param name: Key of the measurement in the baselines file
+    :param value: The measurement
+    :param tolerance: Factor the measurement may be worse than the baseline
+    :param higher_is_better: True for throughputs, False for costs
+    """
+    if UPDATE_BASELINES:
+        BASELINES[name] = value
+        return
+    baseline = BASELINES.get(name)
+    if baseline is None:
+        print('%-50s no baseline recorded' % name)
+    elif higher_is_better:
+        test.assertGreaterEqual(value, baseline / tolerance,
+                                '%s regressed: %s vs baseline %s'
+                                % (name, value, baseline))
+    else:
+        test.assertLessEqual(value, baseline * tolerance,
+                             '%s regressed: %s vs baseline %s'
+                             % (name, value, baseline))
+
+
+class BenchmarkFetcher(unittest.TestCase):
+    """ Benchmarks for the pooled Fetcher.
+    """
+
+    lookups = 200
+    # Roughly what a TLS handshake to wunderground costs
+    handshake = 0.01
+
+    def time_lookups(self, server, fetcher, parse=False):
+        """ Times fetching a series of pages through the findweather
+        redirect.  Parsing is left out unless asked for so only the network
+        cost is measured.
+
+        :param server: FakeWundergroundServer to send requests to
+        :param fetcher: Fetcher to use, or None for one-off requests
+        :param parse: Scrape the pages with scrape_weather_fields instead
+        :return: Average seconds per lookup
+        """
+        started = time.perf_counter()
+        for day in range(self.lookups):
+            url = wunderground_scraper.get_url('KFTY', str(day % 28 + 1), '10',
+                                               '2017', base_url=server.url)
+            if parse:
+                wunderground_scraper.scrape_weather_fields(url, fetcher)
+            elif fetcher is None:
+                requests.get(url, timeout=3)
+            else:
+                fetcher.get(url)
+        return (time.perf_counter() - started) / self.lookups
+
+    def test_connection_reuse(self):
+        """ Compares per-lookup latency of one-off requests.get calls
+        against lookups sharing a pooled, kept-alive Fetcher.  The server
+        charges a delay on every new connection to stand in for the
+        handshake that reusing connections avoids.
+        """
+        with FakeWundergroundServer(connect_delay=self.handshake) as server:
+            one_off = self.time_lookups(server, None)
+            one_off_connections = server.connections
+        with FakeWundergroundServer(connect_delay=self.handshake) as server, \
+                wunderground_scraper.Fetcher() as fetcher:
+            pooled = self.time_lookups(server, fetcher)
+            pooled_connections = server.connections
+        report('requests.get latency per lookup', one_off * 1000, 'ms')
+        report('Fetcher latency per lookup', pooled * 1000, 'ms')
+        report('requests.get connections', one_off_connections, '')
+        report('Fetcher connections', pooled_connections, '')
+        self.assertEqual(pooled_connections, 1)
+        self.assertLess(pooled, one_off)
+        check_baseline(self, 'fetcher_seconds_per_lookup', pooled)
+
+    def test_single_lookup(self):
+        """ Times a complete lookup through a pooled Fetcher: the redirect,
+        the streamed page, and the parse.
+        """
+        with FakeWundergroundServer() as server, \
+                wunderground_scraper.Fetcher() as fetcher:
+            latency = self.time_lookups(server, fetcher, parse=True)
+        report('single lookup latency', latency * 1000, 'ms')
+        check_baseline(self, 'lookup_seconds', latency)
+
+
+def time_calls(function, *args, repeat=200):
+    """ Times repeated calls to a function.
+
+    :param function: Function to call
+    :param args: Arguments to call it with
+    :param repeat: Number of calls to make
+    :return: Average seconds per call
+    """
+    started = time.perf_counter()
+    for _ in range(repeat):
+        function(*args)
+    return (time.perf_counter() - started) / repeat
+
+
+def parse_whole_page(page):
+    """ The original parse, a BeautifulSoup tree of the whole decoded page
+    walked twice.  Kept as the baseline the parser backends are measured
+    against.
+
+    :param page: Raw bytes of the results page
+    """
+    soup = BeautifulSoup(page.decode('utf-8'), 'html.parser')
+    rows = soup.find('table', id='historyTable').find_all('tr')
+    wunderground_scraper.table_is_complete(rows)
+    for row in rows:
+        if 'Temperature' in row.get_text():
+            [wunderground_scraper.get_cell_data(cell) for cell in row.find_all('td')]
+
+
+class BenchmarkParsers(unittest.TestCase):
+    """ Benchmarks for the parser backends over the saved fixture page.
+    """
+
+    def setUp(self):
+        self.page = read_fixture('DailyHistory.html')
+
+    def test_parsers(self):
+        """ Compares parsing the whole page against slicing out the
+        history table and parsing it with each backend.
+        """
+        whole_page = time_calls(parse_whole_page, self.page)
+        report('bs4 whole page parse', whole_page * 1000, 'ms')
+        for name in wunderground_scraper.PARSERS:
+            if name == 'lxml' and not HAVE_LXML:
+                continue
+            sliced = time_calls(wunderground_scraper.parse_weather_page,
+                                self.page, 'url', name)
+            report('%s sliced table parse' % name, sliced * 1000, 'ms')
+            self.assertLess(sliced, whole_page)
+            check_baseline(self, '%s_parse_seconds' % name, sliced)
+
+
+def parse_from_threads(parse_pool, fragment, pages, threads=8):
+    """ Parses a table many times from several threads at once, the way the
+    fetching threads of a batch hand over the tables they read.
+
+    :param parse_pool: ParsePool to parse in, or None to parse in the threads
+    :param fragment: Bytes of the weather history table
+    :param pages: Total number of tables to parse
+    :param threads: Number of threads parsing at once
+    :return: Pages parsed per second
+    """
+    import concurrent.futures
+    started = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(threads) as pool:
+        for _ in pool.map(lambda _: wunderground_scraper.run_parse(
+                parse_pool, wunderground_scraper.parse_history_table,
+                fragment, 'bs4'), range(pages)):
+            pass
+    return pages / (time.perf_counter() - started)
+
+
+class BenchmarkParsePool(unittest.TestCase):
+    """ Benchmarks for parsing in worker processes instead of threads.
+    """
+
+    pages = 400
+
+    def test_parse_pool_scaling(self):
+        """ Measures parse throughput from eight threads, first parsing in
+        the threads themselves and then in 1, 2, 4... worker processes up to
+        the number of cores.  Threads are held to one core by the GIL, so
+        only the worker processes should scale with the cores.
+        """
+        fragment = wunderground_scraper.slice_history_table(
+            read_fixture('DailyHistory.html'))
+        cores = os.cpu_count() or 1
+        threaded = parse_from_threads(None, fragment, self.pages)
+        report('parsed in 8 threads', threaded, 'pages/s')
+        throughputs = dict()
+        workers = 1
+        while workers <= cores:
+            with wunderground_scraper.ParsePool(workers) as parse_pool:
+                # Warm the workers up so spawning them isn't counted
+                parse_from_threads(parse_pool, fragment, workers * 4)
+                throughputs[workers] = parse_from_threads(parse_pool, fragment,
+                                                          self.pages)
+            report('parsed in %s worker processes' % workers,
+                   throughputs[workers], 'pages/s')
+            workers *= 2
+        most = max(throughputs)
+        if most >= 2:
+            # Pickling costs a little, but each doubling of the workers
+            # should still get most of the way to doubling throughput
+            self.assertGreater(throughputs[most], threaded * most * 0.6)
+        else:
+            print('only one core, scaling not checked')
+
+
+def extract_substring_chain(rows):
+    """ The original row extraction, a pass over the rows checking the
+    headers then a pass of substring checks against each row's full text,
+    with three chained replaces per cell.  Kept as the baseline
+    extract_fields is measured against.
+
+    :param rows: List of rows, each a list of the text of its cells
+    :return: Dictionary of output key -> formatted cell text
+    """
+    def clean(text):
+        return text.strip().replace('\xa0', '').replace('\n', ' ').replace('°', '')
+    headers = set()
+    for cells in rows:
+        row_text = ''.join(cells)
+        for header in ('Actual', 'Average', 'Record'):
+            if header in row_text:
+                headers.add(header)
+    if len(headers) != 3:
+        raise wunderground_scraper.ParseError('Table does not have all '
+                                              'required headers')
+    temperature_dict = dict()
+    for cells in rows:
+        row_text = ''.join(cells)
+        if 'Mean Temperature' in row_text:
+            temperature_dict['Actual Mean Temperature'] = clean(cells[1])
+            temperature_dict['Average Mean Temperature'] = clean(cells[2])
+        elif 'Max Temperature' in row_text:
+            temperature_dict['Actual Max Temperature'] = clean(cells[1])
+            temperature_dict['Average Max Temperature'] = clean(cells[2])
+            temperature_dict['Record Max Temperature'] = clean(cells[3])
+        elif 'Min Temperature' in row_text:
+            temperature_dict['Actual Min Temperature'] = clean(cells[1])
+            temperature_dict['Average Min Temperature'] = clean(cells[2])
+            temperature_dict['Record Min Temperature'] = clean(cells[3])
+    return temperature_dict
+
+
+class BenchmarkExtraction(unittest.TestCase):
+    """ Benchmarks for extracting fields out of already parsed rows.
+    """
+
+    def setUp(self):
+        fragment = wunderground_scraper.slice_history_table(
+            read_fixture('DailyHistory.html'))
+        self.rows = wunderground_scraper.parse_rows_bs4(fragment.decode('utf-8'))
+
+    def test_extraction(self):
+        """ Compares the substring chain against the compiled dispatch table.
+        """
+        chain = time_calls(extract_substring_chain, self.rows, repeat=20000)
+        dispatch = time_calls(wunderground_scraper.extract_fields, self.rows,
+                              repeat=20000)
+        report('substring chain extraction', chain * 1000000, 'us')
+        report('dispatch table extraction', dispatch * 1000000, 'us')
+        self.assertLess(dispatch, chain)
+        check_baseline(self, 'extract_seconds', dispatch)
+
+
+def read_whole_page(url):
+    """ The original fetch, downloading the whole page before slicing the
+    table out of it.  Kept as the baseline the streamed read is measured
+    against.
+
+    :param url: Url of the results page
+    :return: Tuple of (field dictionary, bytes read)
+    """
+    response = requests.get(url, timeout=3)
+    fields = wunderground_scraper.parse_weather_page(response.content, url,
+                                                     encoding=response.encoding)
+    return fields, len(response.content)
+
+
+def read_streamed_page(url):
+    """ Streams the page, reading only as far as the end of the table.
+
+    :param url: Url of the results page
+    :return: Tuple of (field dictionary, bytes read)
+    """
+    response = wunderground_scraper.fetch_page(url)
+    fragment, bytes_read = wunderground_scraper.read_table(
+        response, wunderground_scraper.HISTORY_TABLE_REGEX)
+    return wunderground_scraper.parse_history_table(fragment), bytes_read
+
+
+class BenchmarkStreaming(unittest.TestCase):
+    """ Benchmarks for reading only as much of a page as the table needs.
+    """
+
+    pages = 20
+    # Scripts, ads and footer wunderground sends after the table
+    tail = 300 * 1024
+    # Roughly a fast home connection
+    bandwidth = 10 * 1024 * 1024
+
+    def time_pages(self, read):
+        """ Times reading a series of pages with a padded tail from a
+        server limited to the benchmark's bandwidth.
+
+        :param read: Function taking a url, returning (fields, bytes read)
+        :return: Tuple of (average seconds per page, average bytes read)
+        """
+        page = read_fixture('DailyHistory.html').replace(
+            b'</body>', b'<script>' + b'x' * self.tail + b'</script></body>')
+        with FakeWundergroundServer(bandwidth=self.bandwidth) as server:
+            server.page = page
+            url = server.url + '/history/airport/KFTY/2017/10/11/DailyHistory.html'
+            total_bytes = 0
+            started = time.perf_counter()
+            for _ in range(self.pages):
+                fields, bytes_read = read(url)
+                self.assertEqual(len(fields), 8)
+                total_bytes += bytes_read
+            elapsed = time.perf_counter() - started
+        return elapsed / self.pages, total_bytes / self.pages
+
+    def test_streaming(self):
+        """ Compares downloading the whole page against streaming it up to
+        the end of the history table.
+        """
+        whole, whole_bytes = self.time_pages(read_whole_page)
+        streamed, streamed_bytes = self.time_pages(read_streamed_page)
+        report('whole page wall time per page', whole * 1000, 'ms')
+        report('streamed wall time per page', streamed * 1000, 'ms')
+        report('whole page bytes read per page', whole_bytes, 'bytes')
+        report('streamed bytes read per page', streamed_bytes, 'bytes')
+        self.assertLess(streamed_bytes, whole_bytes / 10)
+        self.assertLess(streamed, whole)
+        check_baseline(self, 'streamed_bytes_per_page', streamed_bytes, SIZE_TOLERANCE)
+        check_baseline(self, 'streamed_seconds_per_page', streamed)
+
+
+class BenchmarkBatch(unittest.TestCase):
+    """ Benchmarks for the batch mode's throughput and memory.
+    """
+
+    # Roughly how long wunderground takes to answer a request
+    server_delay = 0.02
+
+    def scrape(self, server, days, concurrency):
+        """ Scrapes one location for a number of days in batch mode.
+
+        :param server: FakeWundergroundServer to send requests to
+        :param days: Number of days to scrape
+        :param concurrency: Maximum number of requests in flight
+        :return: Number of results
+        """
+        start = datetime.date(2016, 1, 1)
+        results = wunderground_scraper.scrape_range(
+            ['KFTY'], start, start + datetime.timedelta(days=days - 1),
+            concurrency=concurrency, base_url=server.url)
+        return sum(1 for _ in results)
+
+    def test_throughput(self):
+        """ Measures jobs per second at different concurrency levels
+        against a server which takes a fixed time to answer.
+        """
+        throughputs = dict()
+        with FakeWundergroundServer(delay=self.server_delay) as server:
+            for concurrency in (1, 4, 16):
+                days = 10 * concurrency
+                started = time.perf_counter()
+                self.assertEqual(self.scrape(server, days, concurrency), days)
+                throughputs[concurrency] = days / (time.perf_counter() - started)
+                report('batch throughput at concurrency %s' % concurrency,
+                       throughputs[concurrency], 'jobs/s')
+                check_baseline(self, 'jobs_per_second_concurrency_%s' % concurrency,
+                               throughputs[concurrency], higher_is_better=True)
+        self.assertGreater(throughputs[4], throughputs[1] * 2)
+        self.assertGreater(throughputs[16], throughputs[4] * 2)
+
+    def test_peak_memory(self):
+        """ Measures the peak memory allocated while scraping a long range,
+        which should stay flat however many days are asked for.
+        """
+        with FakeWundergroundServer() as server:
+            # Warm up first so one-off imports and caches aren't counted
+            self.scrape(server, 4, 4)
+            peaks = dict()
+            for days in (50, 200):
+                tracemalloc.start()
+                self.scrape(server, days, 4)
+                peaks[days] = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                report('peak memory for %s days' % days, peaks[days] / 1024, 'KiB')
+        self.assertLess(peaks[200], peaks[50] * 2)
+        check_baseline(self, 'peak_bytes_200_days', peaks[200], SIZE_TOLERANCE)
+
+
+def validate_each_job(requested):
+    """ Validates jobs one at a time with validate_job, the way plan_jobs
+    used to.  Kept as the baseline validate_jobs is measured against.
+
+    :param requested: List of (location string, date string) tuples
+    :return: Number of valid jobs
+    """
+    valid = 0
+    for location, date_string in requested:
+        date, error = wunderground_scraper.validate_job(location, date_string)
+        if error is None:
+            valid += 1
+    return valid
+
+
+def expand_each_location(locations, start_date, end_date):
+    """ Expands a range by stepping through it again for every location,
+    the way plan_jobs used to.  Kept as the baseline expand_jobs is
+    measured against.
+
+    :param locations: List of location strings
+    :param start_date: First datetime.date in the range
+    :param end_date: Last datetime.date in the range
+    :return: Generator of (location, datetime.date) jobs
+    """
+    return ((location, date) for location in locations
+            for date in wunderground_scraper.date_range(start_date, end_date))
+
+
+def station_code(number):
+    """ :param number: Number of the station, below 26 ** 3
+    :return: A valid airport code for it, e.g. 'KAAB' for 1
+    """
+    letters = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+    return 'K' + letters[number // 676] + letters[number // 26 % 26] + letters[number % 26]
+
+
+def consume(jobs):
+    """ :param jobs: Iterable of jobs to run through without keeping them
+    :return: Seconds it took
+    """
+    import collections
+    started = time.perf_counter()
+    collections.deque(jobs, maxlen=0)
+    return time.perf_counter() - started
+
+
+class BenchmarkPlanning(unittest.TestCase):
+    """ Benchmarks for validating and expanding the jobs of a backfill of
+    years of data for thousands of stations.
+    """
+
+    stations = 1000
+
+    def test_bulk_validation(self):
+        """ Compares validating a jobs file one job at a time against
+        validating it in bulk.
+        """
+        dates = [date.isoformat() for date in wunderground_scraper.date_range(
+            datetime.date(2015, 1, 1), datetime.date(2015, 12, 31))]
+        requested = [(station_code(station), date_string)
+                     for station in range(self.stations // 5) for date_string in dates]
+        started = time.perf_counter()
+        each = validate_each_job(requested)
+        looped = time.perf_counter() - started
+        started = time.perf_counter()
+        jobs, errors = wunderground_scraper.validate_jobs(requested)
+        bulk = time.perf_counter() - started
+        report('validate %s jobs one at a time' % len(requested), looped * 1000, 'ms')
+        report('validate %s jobs in bulk' % len(requested), bulk * 1000, 'ms')
+        report('bulk validation speedup', looped / bulk, 'x')
+        self.assertEqual(len(jobs), each)
+        self.assertEqual(errors, [])
+        self.assertLess(bulk * 3, looped)
+        check_baseline(self, 'validate_jobs_seconds', bulk)
+
+    def test_range_expansion(self):
+        """ Compares expanding 5 years for every station by stepping through
+        the range per station against sharing one list of its days.
+        """
+        locations = [station_code(station) for station in range(self.stations)]
+        start_date = datetime.date(2012, 1, 1)
+        end_date = datetime.date(2016, 12, 31)
+        looped = consume(expand_each_location(locations, start_date, end_date))
+        shared = consume(wunderground_scraper.expand_jobs(
+            locations, [(start_date, end_date)]))
+        total = len(locations) * ((end_date - start_date).days + 1)
+        report('expand %s jobs per location' % total, looped * 1000, 'ms')
+        report('expand %s jobs from shared days' % total, shared * 1000, 'ms')
+        report('range expansion speedup', looped / shared, 'x')
+        self.assertLess(shared, looped)
+        check_baseline(self, 'expand_jobs_seconds', shared)
+
+
+class BenchmarkHistoryStore(unittest.TestCase):
+    """ Benchmarks for queries over a history store holding decades of
+    data for hundreds of stations.
+    """
+
+    stations = 200
+    years = 30
+
+    @classmethod
+    def setUpClass(cls):
+        import random
+        import tempfile
+        cls.directory = tempfile.TemporaryDirectory()
+        cls.store = wunderground_scraper.HistoryStore(
+            os.path.join(cls.directory.name, 'history.sqlite'), batch_size=100000)
+        random.seed(0)
+        start = datetime.date(2017 - cls.years, 1, 1).toordinal()
+        days = datetime.date(2017, 1, 1).toordinal() - start
+        started = time.perf_counter()
+        for station in range(cls.stations):
+            for ordinal in range(start, start + days):
+                high = random.randint(40, 100)
+                cls.store.put('K%03d' % station, datetime.date.fromordinal(ordinal),
+                              wunderground_scraper.WeatherRecord(
+                                  high - 10, 60, high, 70, 105, 1950,
+                                  high - 20, 50, 10, 1950, 'F'))
+        cls.store.flush()
+        cls.load_seconds = time.perf_counter() - started
+        cls.rows = cls.stations * days
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.store.close()
+        cls.directory.cleanup()
+
+    def test_queries(self):
+        """ Times range queries and aggregates for one station, which
+        should take milliseconds however many stations are stored.
+        """
+        report('stored %s days' % self.rows, self.rows / self.load_seconds, 'days/s')
+        start = datetime.date(2017 - self.years, 1, 1)
+        end = datetime.date(2016, 12, 31)
+        queries = {
+            'one year of records': (self.store.records, 'K100',
+                                    datetime.date(2010, 1, 1),
+                                    datetime.date(2010, 12, 31)),
+            'aggregate over all years': (self.store.aggregate, 'K100', start, end),
+            'days above 99 over all years': (self.store.days_above, 'K100',
+                                             start, end, 99),
+            'record days over all years': (self.store.record_days, 'K100',
+                                           start, end),
+        }
+        for name, query in sorted(queries.items()):
+            seconds = time_calls(*query, repeat=20)
+            report(name, seconds * 1000, 'ms')
+            self.assertLess(seconds, 0.05)
+            check_baseline(self, 'store_%s_seconds' % name.replace(' ', '_'),
+                           seconds)
+
+    def test_plan_sync(self):
+        """ Times planning a nightly sync of the last year for every
+        station, which should skip every stored day but the last few.
+        """
+        today = datetime.date(2016, 12, 31)
+        jobs = [('K%03d' % station, date) for station in range(self.stations)
+                for date in wunderground_scraper.date_range(
+                    datetime.date(2016, 1, 1), today)]
+        started = time.perf_counter()
+        planned, counts = wunderground_scraper.plan_sync(jobs, self.store,
+                                                         today=today)
+        seconds = time.perf_counter() - started
+        report('plan sync of %s jobs' % len(jobs), seconds * 1000, 'ms')
+        report('sync jobs planned', counts['planned'], '')
+        self.assertEqual(counts['planned'],
+                         self.stations * wunderground_scraper.SYNC_REVISE_DAYS)
+        check_baseline(self, 'plan_sync_seconds', seconds)
+
+
+class BenchmarkMetrics(unittest.TestCase):
+    """ Benchmarks for the cost of the instrumentation while it is disabled.
+    """
+
+    def test_disabled_overhead(self):
+        """ Compares what the disabled timers and counters cost per page
+        against parsing the page.
+        """
+        def instrumentation():
+            # What a page's scrape reports: its requests, download, parse
+            # and extract stages, and the whole task
+            metrics = wunderground_scraper.METRICS
+            metrics.count('requests_total', status=302)
+            metrics.count('requests_total', status=200)
+            for stage in ('download', 'parse', 'extract', 'task'):
+                with metrics.timer(stage):
+                    pass
+            metrics.observe('page_bytes', 16384)
+
+        self.assertFalse(wunderground_scraper.METRICS.enabled)
+        overhead = time_calls(instrumentation, repeat=100000)
+        page = read_fixture('DailyHistory.html')
+        parse = time_calls(wunderground_scraper.parse_weather_page, page, 'url')
+        report('disabled instrumentation per page', overhead * 1000000, 'us')
+        report('fastest parse per page', parse * 1000000, 'us')
+        self.assertLess(overhead, parse / 100)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+""" Module: wunderground_scraper_loadtest.py
+
+The purpose of this module is to load test the service mode of the
+wunderground_scraper.py module.  It starts the service against a local
+stand-in for wunderground (see wunderground_scraper_tests.py), sends it
+lookups from many clients at once over kept-alive connections, and reports
+the p50 and p99 latency and the requests per second it answered.  In order
+to run it, navigate to the root project directory and run the following
+command:
+
+'python wunderground_scraper_loadtest.py'
+
+Lookups cycle through --distinct dates, so after the first pass they are
+answered from the service's LRU.  Pass --url to load test a service which
+is already running instead, e.g. one started with
+'python wunderground_scraper.py --serve 8080'.
+NOTE:  This assumes you are running within an activated virtual environment
+and have the project's requirements already installed.  See the project README
+for instructions on setting that up.
+"""
+import argparse
+import datetime
+import requests
+import threading
+import time
+from wunderground_scraper_tests import FakeWundergroundServer, RunningService
+
+
+def percentile(latencies, fraction):
+    """ :param latencies: Sorted list of latencies
+    :param fraction: Fraction of the latencies to be at or below, e.g. 0.99
+    :return: The latency at that percentile
+    """
+    return latencies[int(round(fraction * (len(latencies) - 1)))]
+
+
+def run_client(url, lookups, distinct, offset, latencies, errors):
+    """ Sends lookups one after another over a single kept-alive connection.
+
+    :param url: Base url of the service
+    :param lookups: Number of lookups to send
+    :param distinct: Number of different dates to cycle through
+    :param offset: Where in the cycle of dates this client starts
+    :param latencies: List to append each lookup's seconds to
+    :param errors: List to append the status code of each failed lookup to
+    """
+    first_date = datetime.date(2016, 1, 1)
+    with requests.Session() as session:
+        for lookup in range(lookups):
+            date = first_date + datetime.timedelta(days=(offset + lookup) % distinct)
+            started = time.perf_counter()
+            response = session.get(url + '/history', params={
+                'location': 'KFTY', 'date': date.isoformat()})
+            latencies.append(time.perf_counter() - started)
+            if response.status_code != 200:
+                errors.append(response.status_code)
+
+
+def load_test(url, lookups, clients, distinct):
+    """ Sends lookups to the service from many clients at once and prints
+    the latencies and throughput.
+
+    :param url: Base url of the service
+    :param lookups: Total number of lookups to send
+    :param clients: Number of clients sending lookups at once
+    :param distinct: Number of different dates to cycle through
+    """
+    latencies = []
+    errors = []
+    threads = [threading.Thread(target=run_client, args=(
+        url, lookups // clients + (client < lookups % clients), distinct, client * distinct // clients,
+        latencies, errors)) for client in range(clients)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    print('%-30s %10d' % ('lookups', len(latencies)))
+    print('%-30s %10d' % ('errors', len(errors)))
+    print('%-30s %10.3f ms' % ('p50 latency', percentile(latencies, 0.5) * 1000))
+    print('%-30s %10.3f ms' % ('p99 latency', percentile(latencies, 0.99) * 1000))
+    print('%-30s %10.3f requests/s' % ('throughput', len(latencies) / elapsed))
+    print('%-30s %s' % ('service stats', requests.get(url + '/stats').text))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Load test the scraper\'s service mode.')
+    parser.add_argument('--lookups', type=int, default=2000,
+                        help='Total number of lookups to send')
+    parser.add_argument('--clients', type=int, default=16,
+                        help='Number of clients sending lookups at once')
+    parser.add_argument('--distinct', type=int, default=200,
+                        help='Number of different dates to look up')
+    parser.add_argument('--upstream-delay', type=float, default=0.05,
+                        help='Seconds the stand-in for wunderground takes '
+                             'to answer each request')
+    parser.add_argument('--concurrency', type=int, default=16,
+                        help='Requests the service sends upstream at once')
+    parser.add_argument('--url', default=None,
+                        help='Load test a service which is already running '
+                             'at this url instead of starting one')
+    arguments = parser.parse_args()
+    if arguments.url:
+        load_test(arguments.url, arguments.lookups, arguments.clients,
+                  arguments.distinct)
+        return
+    with FakeWundergroundServer(delay=arguments.upstream_delay) as upstream, \
+            RunningService(upstream.url,
+                           concurrency=arguments.concurrency) as service:
+        load_test(service.url, arguments.lookups, arguments.clients,
+                  arguments.distinct)
+
+
+if __name__ == '__main__':
+    main()
@@ -12,17 +12,267 @@ NOTE:  This assumes you are running within an activated virtual environment
 and have the project's requirements already installed.  See the project README
 for instructions on setting that up.
 """
+import contextlib
 import datetime
+import io
+import json
+import math
+import os
+import pstats
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
 import wunderground_scraper
 from bs4 import BeautifulSoup
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+try:
+    import lxml.html
+    HAVE_LXML = True
+except ImportError:
+    HAVE_LXML = False
+try:
+    import pyarrow.parquet
+    HAVE_PYARROW = True
+except ImportError:
+    HAVE_PYARROW = False
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'fixtures')
+
+
+def read_fixture(name):
+    """ Reads a saved page out of the fixtures directory.
+
+    :param name: File name of the fixture
+    :return: The fixture's contents as bytes
+    """
+    with open(os.path.join(FIXTURES_DIR, name), 'rb') as fixture:
+        return fixture.read()
+
+
+class FakeWundergroundHandler(BaseHTTPRequestHandler):
+    """ Stands in for wunderground.com.  The findweather url redirects to
+    the history url of the view asked for, DailyHistory urls serve the
+    saved daily page, MonthlyHistory and CustomHistory urls serve the saved
+    October 2017 monthly page, the root url serves a page which isn't a
+    history page, and anything else is a 404.  While the server has failures queued up
+    every request is answered with a 503 instead.
+    """
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate writes, don't let Nagle's
+    # algorithm hold the body back on kept-alive connections
+    disable_nagle_algorithm = True
+    findweather_regex = re.compile(r'^/cgi-bin/findweather/getForecast\?.*'
+                                   r'historytype=(\w+)&.*'
+                                   r'month=(\d+)&day=(\d+)&year=(\d+)&?(.*)')
+    history_regex = re.compile(r'^/history/airport/[A-Z]{4}/\d+/\d+/\d+/'
+                               r'(Daily|Monthly|Custom)History\.html')
+
+    def setup(self):
+        """ Counts every new connection made to the server, and charges
+        the server's connect_delay to stand in for a TLS handshake.
+        """
+        BaseHTTPRequestHandler.setup(self)
+        time.sleep(self.server.connect_delay)
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_GET(self):
+        """ Answers a GET request the way wunderground would.
+        """
+        time.sleep(self.server.delay)
+        with self.server.lock:
+            self.server.requests += 1
+            failing = self.server.failures > 0
+            if failing:
+                self.server.failures -= 1
+        findweather = self.findweather_regex.search(self.path)
+        history = self.history_regex.search(self.path)
+        if failing:
+            self.send_body(503, b'<html><body>Service Unavailable</body></html>')
+        elif findweather:
+            history_type, month, day, year, query = findweather.groups()
+            location = '/history/airport/KFTY/%s/%s/%s/%s.html' \
+                       % (year, month, day, history_type)
+            if query:
+                location += '?' + query
+            self.send_response(302)
+            self.send_header('Location', location)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        elif history:
+            if history.group(1) == 'Daily':
+                self.send_body(200, self.server.page)
+            else:
+                self.send_body(200, self.server.range_page)
+        elif self.path == '/':
+            self.send_body(200, b'<html><body><form action="/search">'
+                                b'<input name="q"></form></body></html>')
+        else:
+            self.send_body(404, b'<html><body>Not Found</body></html>')
+
+    def send_body(self, status_code, body):
+        """ Sends a complete html response.  If the server has a bandwidth
+        the body is sent in chunks no faster than it allows.  If the server
+        is chunked the body is sent with chunked transfer encoding instead
+        of a Content-Length.  Clients which hang up part way through the
+        body are let go quietly.
+
+        :param status_code: HTTP status code to respond with
+        :param body: Bytes to send as the response body
+        """
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        if self.server.chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        else:
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.server.chunked:
+            self.send_chunked(body)
+            return
+        if self.server.truncate is not None:
+            # Hang up part way through the promised body
+            body = body[:self.server.truncate]
+            self.close_connection = True
+        try:
+            if not self.server.bandwidth:
+                self.wfile.write(body)
+                return
+            for offset in range(0, len(body), 4096):
+                self.wfile.write(body[offset:offset + 4096])
+                with self.server.lock:
+                    self.server.bytes_sent += len(body[offset:offset + 4096])
+                time.sleep(4096.0 / self.server.bandwidth)
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+    def send_chunked(self, body):
+        """ Sends a body with chunked transfer encoding, 4096 bytes a chunk
+        and no faster than the server's bandwidth if it has one.
+
+        :param body: Bytes to send as the response body
+        """
+        try:
+            for offset in range(0, len(body), 4096):
+                chunk = body[offset:offset + 4096]
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+                if self.server.bandwidth:
+                    with self.server.lock:
+                        self.server.bytes_sent += len(chunk)
+                    time.sleep(4096.0 / self.server.bandwidth)
+            self.wfile.write(b'0\r\n\r\n')
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+    def log_message(self, *args):
+        """ Keeps the request log out of the test output.
+        """
+        pass
+
+
+class FakeWundergroundServer(ThreadingMixIn, HTTPServer):
+    """ A threaded local server using FakeWundergroundHandler.  Runs in a
+    background thread, use 'url' as the base_url for requests.
+    Counts the connections and requests it receives, answers the next
+    'failures' requests with a 503, and cuts every body off after
+    'truncate' bytes if it is set.  Bodies are sent with chunked transfer
+    encoding while 'chunked' is set.
+    """
+    daemon_threads = True
+
+    def __init__(self, delay=0.0, connect_delay=0.0, bandwidth=None):
+        """ :param delay: Seconds to wait before answering each request
+        :param connect_delay: Seconds to wait before serving a new connection
+        :param bandwidth: Bytes per second bodies are sent at, unlimited if
+        not provided.  Only bodies sent under a bandwidth count bytes_sent.
+        """
+        HTTPServer.__init__(self, ('127.0.0.1', 0), FakeWundergroundHandler)
+        self.delay = delay
+        self.connect_delay = connect_delay
+        self.bandwidth = bandwidth
+        self.failures = 0
+        self.truncate = None
+        self.chunked = False
+        self.connections = 0
+        self.requests = 0
+        self.bytes_sent = 0
+        self.lock = threading.Lock()
+        self.page = read_fixture('DailyHistory.html')
+        self.range_page = read_fixture('MonthlyHistory.html')
+        self.url = 'http://127.0.0.1:%s' % self.server_address[1]
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    def handle_error(self, request, client_address):
+        """ Keeps clients hanging up part way through a response out of
+        the test output.
+        """
+        if not isinstance(sys.exc_info()[1], (BrokenPipeError, ConnectionResetError)):
+            HTTPServer.handle_error(self, request, client_address)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
+
+
+class RunningService(object):
+    """ Runs a HistoryService on its own event loop in a background thread,
+    use 'url' to send it requests.
+    """
+
+    def __init__(self, base_url, **kwargs):
+        """ :param base_url: Scheme and host the service scrapes
+        :param kwargs: Other arguments for HistoryService
+        """
+        import asyncio
+        self.service = wunderground_scraper.HistoryService(base_url=base_url,
+                                                           **kwargs)
+        self.loop = asyncio.new_event_loop()
+        self.server = self.loop.run_until_complete(self.service.start(port=0))
+        self.url = 'http://127.0.0.1:%s' % self.server.sockets[0].getsockname()[1]
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.run_until_complete(self.service.stop(self.server))
+        self.loop.close()
+        self.service.close()
 
 
 class TestWundergroundScraper(unittest.TestCase):
     """ The purpose of this class is to define tests for functions within the
-    wunderground_scraper.py module.
+    wunderground_scraper.py module.  Pages are scraped from a local
+    stand-in server so no network access is needed.
     """
 
+    @classmethod
+    def setUpClass(cls):
+        cls.server = FakeWundergroundServer().__enter__()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.__exit__(None, None, None)
+
+    def setUp(self):
+        self.server.page = read_fixture('DailyHistory.html')
+        self.server.delay = 0.0
+        self.server.truncate = None
+
     def test_validate_location_city(self):
         """ Make sure a valid 'city, state' is seen as valid by the
         validate location function
@@ -195,10 +445,10 @@ class TestWundergroundScraper(unittest.TestCase):
          retrieves the page, parses the data, and returns it in a string
          formatted as a JSON object.
          """
-        url = 'https://www.wunderground.com/history/airport/KFTY/' \
+        url = self.server.url + '/history/airport/KFTY/' \
               '2017/10/11/DailyHistory.html?req_city=Atlanta&' \
               'req_state=GA&req_statename=Georgia&reqdb.zip=30301&' \
-              'reqdb.magic=1&reqdb.wmo=99999'''
+              'reqdb.magic=1&reqdb.wmo=99999'
         json_answer = wunderground_scraper.scrape_weather_data(url)
         expected_answer = '{"Actual Max Temperature": "86F", ' \
                           '"Actual Mean Temperature": "76F", ' \
@@ -217,10 +467,10 @@ class TestWundergroundScraper(unittest.TestCase):
          gracefully and return the error in the json that the user
          receives.
          """
-        url = 'https://www.wunderground.com/a404url'
+        url = self.server.url + '/a404url'
         answer = wunderground_scraper.scrape_weather_data(url)
         expected_answer = '{"error": "Received 404 status code for url: ' \
-                          'https://www.wunderground.com/a404url"}'
+                          '%s/a404url"}' % self.server.url
         self.assertEqual(answer, expected_answer)
 
     def test_scrape_weather_data_wrong(self):
@@ -229,13 +479,56 @@ class TestWundergroundScraper(unittest.TestCase):
         realizes that the data table element we're looking for is not on the
         page and returns the appropriate error string.
         """
-        url = 'https://www.google.com'
+        url = self.server.url + '/'
         answer = wunderground_scraper.scrape_weather_data(url)
         expected_answer = '{"error": "Received a link which does not ' \
                           'contain the data we want.  ' \
                           'Link received %s"}' % url
         self.assertEqual(answer, expected_answer)
 
+    def test_scrape_weather_data_redirect(self):
+        """ Makes sure the findweather url is followed through its redirect
+        to the results page.
+        """
+        url = wunderground_scraper.get_url('Atlanta, GA', '11', '10', '2017',
+                                           base_url=self.server.url)
+        answer = wunderground_scraper.scrape_weather_data(url)
+        self.assertEqual(answer, TestScrapeRange.expected_data)
+
+    def test_scrape_weather_data_truncated(self):
+        """ Makes sure a page cut off before the end of the table is
+        reported as a failed request.
+        """
+        page = self.server.page
+        self.server.truncate = page.find(b'Min Temperature')
+        url = self.server.url + '/history/airport/KFTY/2017/10/11/DailyHistory.html'
+        with self.assertRaises(wunderground_scraper.RequestError):
+            wunderground_scraper.scrape_weather_fields(url)
+
+    def test_scrape_weather_data_truncated_after_table(self):
+        """ Makes sure a page cut off after the table has arrived still
+        scrapes, since the rest of the page is never read.
+        """
+        self.server.page = self.server.page.replace(
+            b'</body>', b'<script>' + b'x' * 200000 + b'</script></body>')
+        self.server.truncate = 100000
+        url = self.server.url + '/history/airport/KFTY/2017/10/11/DailyHistory.html'
+        answer = wunderground_scraper.scrape_weather_data(url)
+        self.assertEqual(answer, TestScrapeRange.expected_data)
+
+    def test_scrape_weather_data_slow(self):
+        """ Makes sure a server slower than the timeout is reported as a
+        failed request.
+        """
+        self.server.delay = 0.5
+        url = self.server.url + '/history/airport/KFTY/2017/10/11/DailyHistory.html'
+        with wunderground_scraper.Fetcher(retries=0, timeout=0.1) as fetcher:
+            with self.assertRaises(wunderground_scraper.RequestError):
+                wunderground_scraper.scrape_weather_fields(url, fetcher)
+            # The script reports it rather than exiting
+            answer = wunderground_scraper.scrape_weather_data(url, fetcher)
+        self.assertIn('error', json.loads(answer))
+
     def test_table_is_complete(self):
         """ Tests to make sure that when passed a complete table
         the table_is_complete method returns true.
@@ -281,5 +574,1977 @@ class TestWundergroundScraper(unittest.TestCase):
         self.assertEqual(answer, '76F')
 
 
+class TestParsers(unittest.TestCase):
+    """ Tests the history table slicing and the parser backends.
+    """
+
+    def test_slice_history_table(self):
+        """ Make sure only the history table is sliced out of the page.
+        """
+        page = b'<html><table id="other"></table>' \
+               b'<table class="x" id="historyTable"><tr><td>1</td></tr></table>' \
+               b'<table id="obsTable"></table></html>'
+        answer = wunderground_scraper.slice_history_table(page)
+        self.assertEqual(answer, b'<table class="x" id="historyTable">'
+                                 b'<tr><td>1</td></tr></table>')
+
+    def test_slice_history_table_missing(self):
+        """ Make sure pages without the history table return None.
+        """
+        page = b'<html><table id="historyTableOld"></table></html>'
+        self.assertIsNone(wunderground_scraper.slice_history_table(page))
+
+    def test_slice_history_table_truncated(self):
+        """ Make sure a table cut off by a truncated page is still returned.
+        """
+        page = b'<html><table id="historyTable"><tr><td>1</td>'
+        answer = wunderground_scraper.slice_history_table(page)
+        self.assertEqual(answer, b'<table id="historyTable"><tr><td>1</td>')
+
+    def test_parse_weather_page(self):
+        """ Make sure every parser backend gets the same data out of the
+        saved fixture page.
+        """
+        page = read_fixture('DailyHistory.html')
+        for name in wunderground_scraper.PARSERS:
+            if name == 'lxml' and not HAVE_LXML:
+                continue
+            answer = wunderground_scraper.parse_weather_page(page, 'url', name)
+            self.assertEqual(wunderground_scraper.format_fields(answer),
+                             TestScrapeRange.expected_data, name)
+
+    def test_parse_weather_page_incomplete(self):
+        """ Make sure a table missing a required header is reported.
+        """
+        page = b'<table id="historyTable"><tr><th>Actual</th>' \
+               b'<th>Average</th></tr></table>'
+        with self.assertRaises(wunderground_scraper.ParseError) as context:
+            wunderground_scraper.parse_weather_page(page, 'url', 'bs4')
+        self.assertEqual(str(context.exception),
+                         'Table does not have all required headers')
+
+    def test_compile_field_spec(self):
+        """ Make sure labels are stripped and each row's columns are sorted
+        with the highest column index kept.
+        """
+        answer = wunderground_scraper.compile_field_spec(
+            {' Dew Point ': ((3, 'Record'), (1, 'Actual'))})
+        self.assertEqual(answer, {'Dew Point': (3, ((1, 'Actual'), (3, 'Record')))})
+
+    def test_parse_weather_page_all_fields(self):
+        """ Make sure the extra rows are parsed when asked for, and that
+        section headings sharing a row's label are skipped.
+        """
+        page = read_fixture('DailyHistory.html')
+        answer = wunderground_scraper.parse_weather_page(
+            page, 'url', fields=wunderground_scraper.ALL_FIELDS)
+        self.assertEqual(answer['Actual Dew Point'], '62F')
+        self.assertEqual(answer['Actual Precipitation'], '0.00in')
+        self.assertEqual(answer['Record Precipitation'], '2.15in (1995)')
+        self.assertEqual(answer['Actual Sea Level Pressure'], '30.05in')
+        self.assertEqual(answer['Actual Max Wind Speed'], '12mph')
+        self.assertEqual(answer['Record Max Temperature'], '104F (1999)')
+
+    def test_clean_cell_text(self):
+        """ Make sure non-breaking spaces and degree symbols are removed
+        and newlines become spaces.
+        """
+        answer = wunderground_scraper.clean_cell_text('\n 104\xa0°F\n(1999) ')
+        self.assertEqual(answer, '104F (1999)')
+
+    @unittest.skipUnless(HAVE_LXML, 'lxml is not installed')
+    def test_get_parser(self):
+        """ Make sure lxml is preferred when it is installed.
+        """
+        answer = wunderground_scraper.get_parser()
+        self.assertIs(answer, wunderground_scraper.parse_rows_lxml)
+
+
+class TestWeatherRecord(unittest.TestCase):
+    """ Tests the typed records and errors.
+    """
+
+    def test_parse_reading(self):
+        """ Make sure readings are split into value, unit and year.
+        """
+        self.assertEqual(wunderground_scraper.parse_reading('104F (1999)'),
+                         (104, 'F', 1999))
+        self.assertEqual(wunderground_scraper.parse_reading('-3F'), (-3, 'F', None))
+        self.assertEqual(wunderground_scraper.parse_reading('0.11in'),
+                         (0.11, 'in', None))
+        self.assertEqual(wunderground_scraper.parse_reading('-'),
+                         (None, None, None))
+
+    def test_build_weather_record(self):
+        """ Make sure the fixture page's text becomes a record of numbers.
+        """
+        page = read_fixture('DailyHistory.html')
+        answer = wunderground_scraper.build_weather_record(
+            wunderground_scraper.parse_weather_page(page, 'url'))
+        expected = wunderground_scraper.WeatherRecord(
+            actual_mean=76, average_mean=64,
+            actual_max=86, average_max=75, record_max=104, record_max_year=1999,
+            actual_min=66, average_min=53, record_min=32, record_min_year=2000,
+            unit='F')
+        self.assertEqual(answer, expected)
+
+    def test_scrape_weather_record_errors(self):
+        """ Make sure scrape_weather_record raises typed errors which
+        scrape_weather_data reports as error json.
+        """
+        with FakeWundergroundServer() as server:
+            url = server.url + '/a404url'
+            with self.assertRaises(wunderground_scraper.StatusCodeError):
+                wunderground_scraper.scrape_weather_record(url)
+            answer = wunderground_scraper.scrape_weather_data(url)
+        expected = '{"error": "Received 404 status code for url: %s"}' % url
+        self.assertEqual(answer, expected)
+
+    def test_weather_columns(self):
+        """ Make sure records are gathered into columns, with blanks as NaN
+        and 0 years.
+        """
+        record = wunderground_scraper.WeatherRecord(
+            actual_mean=76, average_mean=64,
+            actual_max=86, average_max=75, record_max=104, record_max_year=1999,
+            actual_min=66, average_min=53, record_min=None, record_min_year=None,
+            unit='F')
+        columns = wunderground_scraper.WeatherColumns()
+        columns.append('KFTY', datetime.date(2017, 10, 11), record)
+        columns.append('KFTY', datetime.date(2017, 10, 12), record)
+        self.assertEqual(len(columns), 2)
+        self.assertEqual(list(columns.columns['actual_max']), [86.0, 86.0])
+        self.assertEqual(list(columns.columns['record_max_year']), [1999, 1999])
+        self.assertEqual(list(columns.columns['record_min_year']), [0, 0])
+        self.assertTrue(math.isnan(columns.columns['record_min'][0]))
+        self.assertEqual(columns.dates[1], datetime.date(2017, 10, 12).toordinal())
+
+
+class TestFetcher(unittest.TestCase):
+    """ Tests the pooled Fetcher against a local stand-in server.
+    """
+
+    def test_scrape_weather_data_fetcher(self):
+        """ Make sure scrape_weather_data follows the redirect and parses
+        the page when given a fetcher.
+        """
+        with FakeWundergroundServer() as server, \
+                wunderground_scraper.Fetcher() as fetcher:
+            url = wunderground_scraper.get_url('Atlanta, GA', '11', '10', '2017',
+                                               base_url=server.url)
+            answer = wunderground_scraper.scrape_weather_data(url, fetcher)
+        self.assertEqual(answer, TestScrapeRange.expected_data)
+
+    def test_fetcher_reuses_connections(self):
+        """ Make sure every request made through one fetcher, including
+        the redirects, shares a single kept-alive connection.
+        """
+        with FakeWundergroundServer() as server, \
+                wunderground_scraper.Fetcher() as fetcher:
+            for day in range(1, 6):
+                url = wunderground_scraper.get_url('KFTY', str(day), '10', '2017',
+                                                   base_url=server.url)
+                wunderground_scraper.scrape_weather_data(url, fetcher)
+        self.assertEqual(server.requests, 10)
+        self.assertEqual(server.connections, 1)
+
+    def test_fetcher_retries(self):
+        """ Make sure a 503 is retried rather than reported.
+        """
+        with FakeWundergroundServer() as server, \
+                wunderground_scraper.Fetcher(backoff_factor=0) as fetcher:
+            server.failures = 2
+            url = wunderground_scraper.get_url('KFTY', '11', '10', '2017',
+                                               base_url=server.url)
+            answer = wunderground_scraper.scrape_weather_data(url, fetcher)
+        self.assertEqual(answer, TestScrapeRange.expected_data)
+        self.assertEqual(server.requests, 4)
+
+    def test_fetcher_retries_exhausted(self):
+        """ Make sure the status code is reported once the retries run out.
+        """
+        with FakeWundergroundServer() as server, \
+                wunderground_scraper.Fetcher(retries=1, backoff_factor=0) as fetcher:
+            server.failures = 5
+            url = server.url + '/history/airport/KFTY/2017/10/11/DailyHistory.html'
+            answer = wunderground_scraper.scrape_weather_data(url, fetcher)
+        expected = '{"error": "Received 503 status code for url: %s"}' % url
+        self.assertEqual(answer, expected)
+
+
+class TestStreaming(unittest.TestCase):
+    """ Tests reading streamed pages only as far as the table needed.
+    """
+
+    def setUp(self):
+        self.server = FakeWundergroundServer().__enter__()
+
+    def tearDown(self):
+        self.server.__exit__(None, None, None)
+
+    def read(self, page, chunk_size):
+        """ Serves a page from the stand-in server and reads its history
+        table with read_table.
+
+        :param page: Bytes of the page to serve
+        :param chunk_size: Number of bytes to read at a time
+        :return: Tuple of (fragment, bytes_read)
+        """
+        self.server.page = page
+        response = wunderground_scraper.fetch_page(
+            self.server.url + '/history/airport/KFTY/2017/10/11/DailyHistory.html')
+        return wunderground_scraper.read_table(
+            response, wunderground_scraper.HISTORY_TABLE_REGEX, chunk_size)
+
+    def test_read_table_matches_slice(self):
+        """ Make sure the streamed table matches the sliced table whatever
+        chunk boundaries the opening and closing tags are split across.
+        """
+        page = read_fixture('DailyHistory.html')
+        expected = wunderground_scraper.slice_history_table(page)
+        for chunk_size in (1, 7, 64, 1000, 100000):
+            fragment, _ = self.read(page, chunk_size)
+            self.assertEqual(fragment, expected, chunk_size)
+
+    def test_read_table_stops_early(self):
+        """ Make sure nothing much past the end of the table is read.
+        """
+        page = read_fixture('DailyHistory.html').replace(
+            b'</body>', b'<script>' + b'x' * 500000 + b'</script></body>')
+        fragment, bytes_read = self.read(page, 1024)
+        table_end = page.find(b'</table>') + len(b'</table>')
+        self.assertEqual(fragment, wunderground_scraper.slice_history_table(page))
+        self.assertLess(bytes_read, table_end + 1024)
+
+    def test_read_table_missing(self):
+        """ Make sure a page without the table reads as None.
+        """
+        fragment, bytes_read = self.read(b'<html><table id="other"></table></html>', 8)
+        self.assertIsNone(fragment)
+        self.assertEqual(bytes_read, 39)
+
+    def test_read_table_truncated(self):
+        """ Make sure a page cut off inside the table hands over what it has.
+        """
+        fragment, _ = self.read(b'<html><table id="historyTable"><tr><td>1</td>', 5)
+        self.assertEqual(fragment, b'<table id="historyTable"><tr><td>1</td>')
+
+    def test_short_tail_keeps_connection(self):
+        """ Make sure a page with only a little left after the table is
+        drained so the pooled connection is reused.
+        """
+        with wunderground_scraper.Fetcher() as fetcher:
+            for day in range(1, 6):
+                url = wunderground_scraper.get_url('KFTY', str(day), '10', '2017',
+                                                   base_url=self.server.url)
+                self.assertEqual(wunderground_scraper.scrape_weather_data(url, fetcher),
+                                 TestScrapeRange.expected_data)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_chunked_short_tail_keeps_connection(self):
+        """ Make sure a chunked page, which has no Content-Length to tell how
+        much is left, is still drained so the pooled connection is reused.
+        """
+        self.server.chunked = True
+        with wunderground_scraper.Fetcher() as fetcher:
+            for day in range(1, 11):
+                url = wunderground_scraper.get_station_url(
+                    '/history/airport/KFTY', str(day), '10', '2017',
+                    base_url=self.server.url)
+                self.assertEqual(wunderground_scraper.scrape_weather_data(url, fetcher),
+                                 TestScrapeRange.expected_data)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_chunked_long_tail_closes_connection(self):
+        """ Make sure a chunked page with a long tail after the table stops
+        being read after DRAIN_LIMIT bytes.
+        """
+        page = read_fixture('DailyHistory.html').replace(
+            b'</body>', b'<script>' + b'x' * 400000 + b'</script></body>')
+        self.server.page = page
+        self.server.chunked = True
+        self.server.bandwidth = 10 * 1024 * 1024
+        url = wunderground_scraper.get_url('KFTY', '11', '10', '2017',
+                                           base_url=self.server.url)
+        self.assertEqual(wunderground_scraper.scrape_weather_data(url),
+                         TestScrapeRange.expected_data)
+        time.sleep(0.1)
+        self.assertLess(self.server.bytes_sent, len(page) / 2)
+
+    def test_long_tail_closes_connection(self):
+        """ Make sure a page with a long tail after the table stops being
+        sent once the client hangs up.
+        """
+        page = read_fixture('DailyHistory.html').replace(
+            b'</body>', b'<script>' + b'x' * 200000 + b'</script></body>')
+        self.server.page = page
+        self.server.bandwidth = 10 * 1024 * 1024
+        url = wunderground_scraper.get_url('KFTY', '11', '10', '2017',
+                                           base_url=self.server.url)
+        self.assertEqual(wunderground_scraper.scrape_weather_data(url),
+                         TestScrapeRange.expected_data)
+        time.sleep(0.1)
+        self.assertLess(self.server.bytes_sent, len(page) / 2)
+
+
+class TestRateLimiter(unittest.TestCase):
+    """ Tests the adaptive rate limiter and circuit breaker.
+    """
+
+    url = 'http://one.example/page'
+
+    def test_burst(self):
+        """ Make sure a burst goes out at once and the next request waits
+        for a token.
+        """
+        limiter = wunderground_scraper.RateLimiter(10, burst=3)
+        started = time.perf_counter()
+        for _ in range(3):
+            limiter.wait(self.url)
+        self.assertLess(time.perf_counter() - started, 0.05)
+        limiter.wait(self.url)
+        self.assertGreaterEqual(time.perf_counter() - started, 0.09)
+
+    def test_slow_down_and_recover(self):
+        """ Make sure a 503 retried away by the fetcher halves the rate,
+        and that successes bring it back up to the limit.
+        """
+        limiter = wunderground_scraper.RateLimiter(20, hold=0)
+        with FakeWundergroundServer() as server, \
+                wunderground_scraper.Fetcher(backoff_factor=0) as fetcher:
+            url = server.url + '/history/airport/KFTY/2017/10/11/DailyHistory.html'
+            server.failures = 1
+            wunderground_scraper.fetch_limited(url, fetcher, limiter).close()
+            self.assertEqual(limiter.rate_of(url), 10)
+            response = wunderground_scraper.fetch_limited(url, fetcher, limiter)
+            response.close()
+            self.assertAlmostEqual(limiter.rate_of(url), 10.1)
+        for _ in range(200):
+            limiter.record(url, response)
+        self.assertEqual(limiter.rate_of(url), 20)
+
+    def test_recover_gradually(self):
+        """ Make sure a host slowed down to min_rate comes back up a little
+        at a time rather than jumping back to the full rate.
+        """
+        limiter = wunderground_scraper.RateLimiter(20, hold=0,
+                                                   failure_threshold=100)
+        with FakeWundergroundServer() as server:
+            url = server.url + '/history/airport/KFTY/2017/10/11/DailyHistory.html'
+            for _ in range(10):
+                limiter.record_failure(url)
+            self.assertAlmostEqual(limiter.rate_of(url), 0.1)
+            response = wunderground_scraper.fetch_limited(url, None, limiter)
+            response.close()
+        self.assertAlmostEqual(limiter.rate_of(url), 0.2)
+        for _ in range(9):
+            limiter.record(url, response)
+        self.assertAlmostEqual(limiter.rate_of(url), 1.1)
+        # Successes at higher rates still raise it by about 1 / rate
+        for _ in range(500):
+            limiter.record(url, response)
+        self.assertEqual(limiter.rate_of(url), 20)
+
+    def test_unlimited_host_slows_down(self):
+        """ Make sure a host without a limit starts at half the rate it
+        was sent when it first pushes back.
+        """
+        limiter = wunderground_scraper.RateLimiter()
+        for _ in range(5):
+            limiter.wait(self.url)
+            time.sleep(0.02)
+        self.assertIsNone(limiter.rate_of(self.url))
+        limiter.record_failure(self.url)
+        self.assertGreater(limiter.rate_of(self.url), 10)
+        self.assertLess(limiter.rate_of(self.url), 30)
+
+    def test_circuit_breaker(self):
+        """ Make sure repeated failures pause the host, that a failed trial
+        pauses it for longer, and that a good trial closes the breaker.
+        """
+        limiter = wunderground_scraper.RateLimiter(adaptive=False,
+                                                   failure_threshold=2,
+                                                   cooldown=0.1)
+        limiter.record_failure(self.url)
+        started = time.perf_counter()
+        limiter.wait(self.url)
+        self.assertLess(time.perf_counter() - started, 0.05)
+        limiter.record_failure(self.url)
+        started = time.perf_counter()
+        limiter.wait(self.url)
+        self.assertGreaterEqual(time.perf_counter() - started, 0.09)
+        # The trial failed, the next pause is twice as long
+        limiter.record_failure(self.url)
+        started = time.perf_counter()
+        limiter.wait(self.url)
+        self.assertGreaterEqual(time.perf_counter() - started, 0.19)
+        with FakeWundergroundServer() as server:
+            response = wunderground_scraper.fetch_page(server.url + '/')
+            limiter.record(self.url, response)
+            response.close()
+        started = time.perf_counter()
+        limiter.wait(self.url)
+        self.assertLess(time.perf_counter() - started, 0.05)
+
+    def test_jittered_retry(self):
+        """ Make sure retry sleeps are spread between zero and the plain
+        exponential backoff.
+        """
+        from urllib3.util.retry import RequestHistory
+        history = tuple(RequestHistory('GET', '/', None, 503, None)
+                        for _ in range(3))
+        retry = wunderground_scraper.jittered_retry(total=5, backoff_factor=1,
+                                                    history=history)
+        sleeps = [retry.new().get_backoff_time() for _ in range(50)]
+        self.assertTrue(all(0 <= sleep <= 4 for sleep in sleeps))
+        self.assertGreater(len(set(sleeps)), 1)
+
+    def test_scrape_range_errors(self):
+        """ Make sure a host which can't be reached gives every job an
+        error instead of stopping the batch.
+        """
+        with FakeWundergroundServer() as server:
+            base_url = server.url
+        results = list(wunderground_scraper.scrape_range(
+            ['KFTY'], datetime.date(2017, 10, 1), datetime.date(2017, 10, 3),
+            base_url=base_url))
+        self.assertEqual(len(results), 3)
+        for _, _, json_data in results:
+            self.assertIn('error', json.loads(json_data))
+
+
+class TestSingleFlight(unittest.TestCase):
+    """ Tests coalescing concurrent duplicate lookups.
+    """
+
+    def run_together(self, single_flight, key, function, callers=4):
+        """ Calls SingleFlight.do from several threads at once.
+
+        :return: List of what each caller got back, or the exception raised
+        """
+        answers = []
+
+        def call():
+            try:
+                answers.append(single_flight.do(key, function))
+            except Exception as error:
+                answers.append(error)
+        threads = [threading.Thread(target=call) for _ in range(callers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return answers
+
+    def test_single_flight(self):
+        """ Make sure concurrent callers share one call, and that the key
+        is forgotten once the call is done.
+        """
+        single_flight = wunderground_scraper.SingleFlight()
+        calls = []
+
+        def slow():
+            calls.append(1)
+            time.sleep(0.1)
+            return 'result'
+        self.assertEqual(self.run_together(single_flight, 'key', slow),
+                         ['result'] * 4)
+        self.assertEqual(single_flight.stats(), {'calls': 1, 'shared': 3})
+        single_flight.do('key', slow)
+        self.assertEqual(len(calls), 2)
+
+    def test_single_flight_errors(self):
+        """ Make sure every caller sharing a failed call gets its error.
+        """
+        single_flight = wunderground_scraper.SingleFlight()
+
+        def fail():
+            time.sleep(0.1)
+            raise wunderground_scraper.RequestError('Request timed out')
+        answers = self.run_together(single_flight, 'key', fail)
+        self.assertEqual(len(answers), 4)
+        for answer in answers:
+            self.assertIsInstance(answer, wunderground_scraper.RequestError)
+
+    def test_coalesce_key(self):
+        """ Make sure spellings of the same station share a key.
+        """
+        date = datetime.date(2017, 10, 11)
+        stations = wunderground_scraper.StationTable()
+        key = wunderground_scraper.coalesce_key
+        self.assertEqual(key('Atlanta, GA', date), key('atlanta, ga', date))
+        self.assertNotEqual(key('Atlanta, GA', date, stations), key('KFTY', date))
+        stations.preload({'Atlanta, GA': '/history/airport/KFTY'})
+        self.assertEqual(key('atlanta, ga', date, stations), key('KFTY', date))
+        self.assertNotEqual(key('KFTY', date),
+                            key('KFTY', datetime.date(2017, 10, 12)))
+
+    def test_scrape_jobs_coalesced(self):
+        """ Make sure duplicate jobs running at the same time make one
+        request between them.
+        """
+        date = datetime.date(2017, 10, 11)
+        stations = wunderground_scraper.StationTable()
+        stations.preload({'Atlanta, GA': '/history/airport/KFTY'})
+        jobs = [('Atlanta, GA', date), ('atlanta, ga', date), ('KFTY', date)]
+        with FakeWundergroundServer(delay=0.2) as server:
+            results = list(wunderground_scraper.scrape_jobs(
+                jobs, concurrency=3, stations=stations, base_url=server.url))
+            self.assertEqual(server.requests, 1)
+        self.assertEqual([json_data for _, _, json_data in results],
+                         [TestScrapeRange.expected_data] * 3)
+
+
+class TestPageCache(unittest.TestCase):
+    """ Tests the persistent PageCache.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'cache.sqlite')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_location_key(self):
+        """ Make sure location keys are formatted like get_url formats
+        locations and ignore capitalization.
+        """
+        answer = wunderground_scraper.location_key('los angeles, California')
+        self.assertEqual(answer, 'LOS+ANGELES,+CALIFORNIA')
+
+    def test_page_cache(self):
+        """ Make sure results are kept between runs and counted as hits,
+        and that spellings of the same location share an entry.
+        """
+        date = datetime.date(2017, 10, 11)
+        with wunderground_scraper.PageCache(self.path) as cache:
+            self.assertIsNone(cache.get('Atlanta, GA', date))
+            cache.put('Atlanta, GA', date, '{"Actual Max Temperature": "86F"}')
+        with wunderground_scraper.PageCache(self.path) as cache:
+            answer = cache.get('atlanta, ga', date)
+            self.assertEqual(cache.stats(), {'hits': 1, 'misses': 0})
+        self.assertEqual(answer, '{"Actual Max Temperature": "86F"}')
+
+    def test_page_cache_today_expires(self):
+        """ Make sure results for today expire once the ttl runs out but
+        past dates don't.
+        """
+        today = datetime.date.today()
+        past = datetime.date(2017, 10, 11)
+        with wunderground_scraper.PageCache(self.path, today_ttl=0) as cache:
+            cache.put('KFTY', today, '{}')
+            cache.put('KFTY', past, '{}')
+            time.sleep(0.01)
+            self.assertIsNone(cache.get('KFTY', today))
+            self.assertEqual(cache.get('KFTY', past), '{}')
+
+    def test_page_cache_yesterday_expires(self):
+        """ Make sure a result fetched before its date was over expires even
+        once the date is in the past, as it may only have part of the day.
+        """
+        yesterday = datetime.date.today() - datetime.timedelta(days=1)
+        with wunderground_scraper.PageCache(self.path, today_ttl=0) as cache:
+            cache.put('KFTY', yesterday, '{}')
+            time.sleep(0.01)
+            self.assertIsNone(cache.get('KFTY', yesterday))
+            self.assertEqual(cache.cached_dates('KFTY', yesterday, yesterday), set())
+        with wunderground_scraper.PageCache(self.path, today_ttl=0,
+                                            settle_seconds=-2 * 86400) as cache:
+            # Counts as fetched after the date settled
+            self.assertEqual(cache.get('KFTY', yesterday), '{}')
+
+    def test_page_cache_eviction(self):
+        """ Make sure the least recently used result is evicted when the
+        cache grows past its size bound.
+        """
+        dates = [datetime.date(2017, 10, day) for day in range(1, 4)]
+        with wunderground_scraper.PageCache(self.path, max_entries=2) as cache:
+            cache.put('KFTY', dates[0], '{}')
+            cache.put('KFTY', dates[1], '{}')
+            time.sleep(0.01)
+            # Touch the oldest entry so the second becomes least recently used
+            cache.get('KFTY', dates[0])
+            cache.put('KFTY', dates[2], '{}')
+            self.assertEqual(cache.get('KFTY', dates[0]), '{}')
+            self.assertIsNone(cache.get('KFTY', dates[1]))
+            self.assertEqual(cache.get('KFTY', dates[2]), '{}')
+
+    def test_page_cache_batched_touches(self):
+        """ Make sure hits are written in batches rather than one by one,
+        and that hits not written yet are kept when the cache is closed.
+        """
+        import sqlite3
+        dates = [datetime.date(2017, 10, day) for day in range(1, 4)]
+
+        def accessed_at():
+            with contextlib.closing(sqlite3.connect(self.path)) as connection:
+                return dict(connection.execute('SELECT date, accessed_at FROM pages'))
+        with wunderground_scraper.PageCache(self.path, max_entries=2,
+                                            touch_batch=2) as cache:
+            cache.put('KFTY', dates[0], '{}')
+            cache.put('KFTY', dates[1], '{}')
+            written = accessed_at()
+            time.sleep(0.01)
+            cache.get('KFTY', dates[0])
+            self.assertEqual(accessed_at(), written)
+            cache.get('KFTY', dates[0])
+            cache.get('KFTY', dates[1])
+            self.assertGreater(accessed_at()['2017-10-01'], written['2017-10-01'])
+            time.sleep(0.01)
+            cache.get('KFTY', dates[0])
+        with wunderground_scraper.PageCache(self.path, max_entries=2) as cache:
+            # The last hit was written on close, so the second is evicted
+            cache.put('KFTY', dates[2], '{}')
+            self.assertEqual(cache.get('KFTY', dates[0]), '{}')
+            self.assertIsNone(cache.get('KFTY', dates[1]))
+
+    def test_scrape_range_cache(self):
+        """ Make sure a second batch over the same range is answered from
+        the cache without contacting the server.
+        """
+        start = datetime.date(2017, 10, 1)
+        end = datetime.date(2017, 10, 3)
+        with FakeWundergroundServer() as server, \
+                wunderground_scraper.PageCache(self.path) as cache:
+            list(wunderground_scraper.scrape_range(['KFTY'], start, end, cache=cache,
+                                                   base_url=server.url))
+            requests_made = server.requests
+            results = list(wunderground_scraper.scrape_range(
+                ['KFTY'], start, end, cache=cache, base_url=server.url))
+            self.assertEqual(cache.stats(), {'hits': 3, 'misses': 3})
+        self.assertEqual(server.requests, requests_made)
+        for _, _, json_data in results:
+            self.assertEqual(json_data, TestScrapeRange.expected_data)
+
+
+class TestHistoryStore(unittest.TestCase):
+    """ Tests storing scraped days and querying them back.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'history.sqlite')
+        self.store = wunderground_scraper.HistoryStore(self.path)
+        # Two weeks of October at KFTY, getting warmer each day
+        record = wunderground_scraper.build_weather_record(
+            json.loads(TestScrapeRange.expected_data))
+        for day in range(1, 15):
+            self.store.put('KFTY', datetime.date(2017, 10, day), record._replace(
+                actual_max=80 + day, actual_mean=70 + day, actual_min=60 + day))
+
+    def tearDown(self):
+        self.store.close()
+        self.directory.cleanup()
+
+    def test_records(self):
+        """ Make sure a range reads back in date order, whatever the
+        location's capitalization.
+        """
+        records = self.store.records('kfty', datetime.date(2017, 10, 10),
+                                     datetime.date(2017, 10, 20))
+        self.assertEqual([date.day for date, _ in records], [10, 11, 12, 13, 14])
+        self.assertEqual(records[1][1].actual_max, 91)
+        self.assertEqual(records[1][1].record_max_year, 1999)
+        self.assertEqual(records[1][1].unit, 'F')
+
+    def test_upsert_keeps_fields(self):
+        """ Make sure storing a range view result over a day keeps the
+        averages and records already stored for it.
+        """
+        self.store.put_json('KFTY', datetime.date(2017, 10, 11),
+                            '{"Actual Max Temperature": "99F"}')
+        self.store.put_json('KFTY', datetime.date(2017, 10, 12),
+                            '{"error": "Request timed out"}')
+        records = self.store.records('KFTY', datetime.date(2017, 10, 11),
+                                     datetime.date(2017, 10, 12))
+        self.assertEqual(records[0][1].actual_max, 99)
+        self.assertEqual(records[0][1].average_max, 75)
+        self.assertEqual(records[1][1].actual_max, 92)
+
+    def test_batched_writes(self):
+        """ Make sure days are written in batches, and can be read by
+        another connection while the store is open.
+        """
+        reader = wunderground_scraper.HistoryStore(self.path)
+        self.assertEqual(reader.aggregate('KFTY', datetime.date(2017, 1, 1),
+                                          datetime.date(2017, 12, 31))['days'], 0)
+        self.store.flush()
+        self.assertEqual(reader.aggregate('KFTY', datetime.date(2017, 1, 1),
+                                          datetime.date(2017, 12, 31))['days'], 14)
+        reader.close()
+
+    def test_aggregate(self):
+        """ Make sure aggregates cover only the range asked for.
+        """
+        answer = self.store.aggregate('KFTY', datetime.date(2017, 10, 1),
+                                      datetime.date(2017, 10, 3))
+        self.assertEqual(answer, {'days': 3, 'min': 61, 'max': 83, 'mean': 72})
+        answer = self.store.aggregate('KATL', datetime.date(2017, 10, 1),
+                                      datetime.date(2017, 10, 3))
+        self.assertEqual(answer, {'days': 0, 'min': None, 'max': None, 'mean': None})
+
+    def test_days_above(self):
+        """ Make sure days above a threshold are found in any value column.
+        """
+        answer = self.store.days_above('KFTY', datetime.date(2017, 10, 1),
+                                       datetime.date(2017, 10, 31), 92)
+        self.assertEqual([date.day for date in answer], [13, 14])
+        answer = self.store.days_above('KFTY', datetime.date(2017, 10, 1),
+                                       datetime.date(2017, 10, 31), 82,
+                                       column='actual_mean')
+        self.assertEqual([date.day for date in answer], [13, 14])
+        with self.assertRaises(ValueError):
+            self.store.days_above('KFTY', datetime.date(2017, 10, 1),
+                                  datetime.date(2017, 10, 31), 0, column='date')
+
+    def test_record_days(self):
+        """ Make sure days showing their own year's record, or beating the
+        record shown, are found.
+        """
+        record = self.store.records('KFTY', datetime.date(2017, 10, 1),
+                                    datetime.date(2017, 10, 1))[0][1]
+        self.store.put('KFTY', datetime.date(2017, 10, 2), record._replace(
+            actual_max=104, record_max=104, record_max_year=2017))
+        self.store.put('KFTY', datetime.date(2017, 10, 3), record._replace(
+            actual_min=30))
+        answer = self.store.record_days('KFTY', datetime.date(2017, 10, 1),
+                                        datetime.date(2017, 10, 31))
+        self.assertEqual(answer, [(datetime.date(2017, 10, 2), 'max'),
+                                  (datetime.date(2017, 10, 3), 'min')])
+
+    def test_store_scrape_results(self):
+        """ Make sure batch results can be stored and aggregated.
+        """
+        with FakeWundergroundServer() as server:
+            for location, date, json_data in wunderground_scraper.scrape_range(
+                    ['KATL'], datetime.date(2017, 10, 1),
+                    datetime.date(2017, 10, 3), base_url=server.url):
+                self.store.put_json(location, date, json_data)
+        answer = self.store.aggregate('KATL', datetime.date(2017, 10, 1),
+                                      datetime.date(2017, 10, 31))
+        self.assertEqual(answer, {'days': 3, 'min': 66, 'max': 86, 'mean': 76})
+
+    def test_parse_arguments_store(self):
+        """ Make sure --store is optional.
+        """
+        arguments = wunderground_scraper.parse_arguments(
+            ['--location', 'KFTY', '--date', '2017-10-11'])
+        self.assertIsNone(arguments.store)
+        arguments = wunderground_scraper.parse_arguments(
+            ['--location', 'KFTY', '--date', '2017-10-11', '--store', 'h.sqlite'])
+        self.assertEqual(arguments.store, 'h.sqlite')
+
+
+class TestSync(unittest.TestCase):
+    """ Tests planning a sync against stored and cached days.
+    """
+
+    today = datetime.date(2017, 10, 20)
+
+    def setUp(self):
+        self.store = wunderground_scraper.HistoryStore(':memory:')
+        self.cache = wunderground_scraper.PageCache(':memory:')
+        record = wunderground_scraper.build_weather_record(
+            json.loads(TestScrapeRange.expected_data))
+        # October 1st to 10th and 17th to 20th are stored, the 11th is cached
+        for day in list(range(1, 11)) + list(range(17, 21)):
+            self.store.put('KFTY', datetime.date(2017, 10, day), record)
+        self.cache.put('KFTY', datetime.date(2017, 10, 11),
+                       TestScrapeRange.expected_data)
+        self.jobs = [('KFTY', date) for date in wunderground_scraper.date_range(
+            datetime.date(2017, 10, 1), self.today)] + \
+            [('KATL', datetime.date(2017, 10, 1))]
+
+    def tearDown(self):
+        self.store.close()
+        self.cache.close()
+
+    def test_plan_sync(self):
+        """ Make sure only missing days and the last few days are planned,
+        in the order they were given.
+        """
+        jobs, counts = wunderground_scraper.plan_sync(
+            self.jobs, self.store, self.cache, today=self.today)
+        days = [date.day for location, date in jobs if location == 'KFTY']
+        self.assertEqual(days, [12, 13, 14, 15, 16, 18, 19, 20])
+        self.assertEqual(jobs[-1], ('KATL', datetime.date(2017, 10, 1)))
+        self.assertEqual(counts, {'planned': 9, 'skipped': 12, 'revised': 3})
+
+    def test_plan_sync_discards_recent(self):
+        """ Make sure cached results of the last few days are dropped so
+        that they are fetched again.
+        """
+        date = datetime.date(2017, 10, 11)
+        jobs, counts = wunderground_scraper.plan_sync(
+            [('KFTY', date)], cache=self.cache, revise_days=2,
+            today=datetime.date(2017, 10, 12))
+        self.assertEqual(jobs, [('KFTY', date)])
+        self.assertEqual(counts, {'planned': 1, 'skipped': 0, 'revised': 1})
+        self.assertIsNone(self.cache.get('KFTY', date))
+
+    def test_parse_arguments_sync(self):
+        """ Make sure --sync needs something to sync against.
+        """
+        arguments = wunderground_scraper.parse_arguments(
+            ['--location', 'KFTY', '--start', '2017-10-01', '--end',
+             '2017-10-31', '--store', 'h.sqlite', '--sync'])
+        self.assertEqual(arguments.revise_days, wunderground_scraper.SYNC_REVISE_DAYS)
+        with self.assertRaises(SystemExit):
+            wunderground_scraper.parse_arguments(
+                ['--location', 'KFTY', '--date', '2017-10-11', '--sync', '5'])
+
+
+class TestPageArchive(unittest.TestCase):
+    """ Tests keeping raw tables in the archive and replaying them.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'archive')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_put_and_read(self):
+        """ Make sure tables read back as they were put, across segments and
+        after reopening the archive, and that a table archived again
+        replaces the old copy in the index.
+        """
+        date = datetime.date(2017, 10, 11)
+        with wunderground_scraper.PageArchive(self.path, segment_size=100,
+                                              codec='zlib') as archive:
+            # Random bytes don't compress, so this fills the first segment
+            archive.put('KFTY', 'daily', date, date, os.urandom(200))
+            archive.put('KATL', 'daily', date, date, b'<table>2</table>', 'utf-8')
+        with wunderground_scraper.PageArchive(self.path, segment_size=100,
+                                              codec='zlib') as archive:
+            archive.put('KFTY', 'daily', date, date, b'<table>3</table>')
+            entries = archive.entries()
+            self.assertEqual([(entry.location, entry.segment) for entry in entries],
+                             [('KATL', 2), ('KFTY', 2)])
+            self.assertEqual(entries[0].encoding, 'utf-8')
+            self.assertEqual(entries[0].start_date, date)
+            self.assertEqual(archive.read(entries[0]), b'<table>2</table>')
+            self.assertEqual(archive.read(entries[1]), b'<table>3</table>')
+        self.assertTrue(os.path.exists(os.path.join(self.path, 'segment-000001.dat')))
+
+    def test_location_spellings(self):
+        """ Make sure spellings of the same location share an entry, so a
+        replay doesn't answer for the page twice.
+        """
+        date = datetime.date(2017, 10, 11)
+        with wunderground_scraper.PageArchive(self.path) as archive:
+            archive.put('Atlanta, GA', 'daily', date, date, b'<table>1</table>')
+            archive.put('atlanta, ga', 'daily', date, date, b'<table>2</table>')
+            entries = archive.entries()
+            self.assertEqual([entry.location for entry in entries], ['ATLANTA,+GA'])
+            self.assertEqual(archive.read(entries[0]), b'<table>2</table>')
+
+    def test_replay(self):
+        """ Make sure replaying the archive of a scrape gives the same results
+        without any requests, in the calling process and in workers.
+        """
+        jobs = [('KFTY', datetime.date(2017, 10, day)) for day in range(1, 11)] + \
+               [('KFTY', datetime.date(2017, 11, 1))]
+        with FakeWundergroundServer() as server, \
+                wunderground_scraper.PageArchive(self.path) as archive:
+            expected = sorted(wunderground_scraper.scrape_jobs(
+                jobs, base_url=server.url, range_days=7, archive=archive))
+            requests = server.requests
+            self.assertEqual(len(archive.entries()), 2)
+            answer = sorted(wunderground_scraper.replay_archive(archive))
+            self.assertEqual(sorted(wunderground_scraper.replay_archive(
+                archive, workers=1, chunk_size=1)), answer)
+            self.assertEqual(server.requests, requests)
+        # The daily page replays with every field, not just the range's
+        self.assertEqual(answer[:10], expected[:10])
+        self.assertEqual(answer[10][2], TestScrapeRange.expected_data)
+
+    def test_replay_new_fields(self):
+        """ Make sure a replay extracts whatever fields it is asked for, as
+        after adding a field to the extractor.
+        """
+        date = datetime.date(2017, 10, 11)
+        with FakeWundergroundServer() as server, \
+                wunderground_scraper.PageArchive(self.path) as archive:
+            wunderground_scraper.scrape_location_date(
+                'KFTY', date, base_url=server.url, archive=archive)
+            (_, _, json_data), = wunderground_scraper.replay_archive(
+                archive, fields=wunderground_scraper.ALL_FIELDS)
+        self.assertIn('Actual Mean Temperature', json_data)
+        self.assertGreater(len(json.loads(json_data)),
+                           len(json.loads(TestScrapeRange.expected_data)))
+
+    def test_parse_arguments_replay(self):
+        """ Make sure a replay needs no locations or jobs file.
+        """
+        arguments = wunderground_scraper.parse_arguments(
+            ['--replay', self.path, '--store', 'history.sqlite'])
+        self.assertEqual(arguments.replay, self.path)
+        with self.assertRaises(SystemExit):
+            wunderground_scraper.parse_arguments(['--store', 'history.sqlite'])
+
+
+class TestStationTable(unittest.TestCase):
+    """ Tests the StationTable which lets lookups skip the redirect.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'stations.json')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_get_station_url(self):
+        """ Make sure station urls point straight at the DailyHistory page.
+        """
+        answer = wunderground_scraper.get_station_url('/history/airport/KFTY',
+                                                      '11', '10', '2017')
+        expected = 'https://www.wunderground.com/history/airport/KFTY/' \
+                   '2017/10/11/DailyHistory.html'
+        self.assertEqual(answer, expected)
+
+    def test_station_table_record(self):
+        """ Make sure the station is read out of a resolved url and saved
+        to disk, and that other urls are ignored.
+        """
+        stations = wunderground_scraper.StationTable(self.path)
+        answer = stations.record('Atlanta, GA', 'https://www.wunderground.com/'
+                                                'history/airport/KFTY/2017/10/11/'
+                                                'DailyHistory.html?req_city=Atlanta')
+        self.assertEqual(answer, '/history/airport/KFTY')
+        self.assertIsNone(stations.record('40065', 'https://www.google.com/'))
+        reloaded = wunderground_scraper.StationTable(self.path)
+        self.assertEqual(reloaded.items(), [('ATLANTA,+GA', '/history/airport/KFTY')])
+        self.assertIsNone(reloaded.get('40065'))
+
+    def test_station_table_shared(self):
+        """ Make sure tables sharing a file, as the --work processes do,
+        merge the stations each other recorded instead of overwriting them.
+        """
+        first = wunderground_scraper.StationTable(self.path)
+        second = wunderground_scraper.StationTable(self.path)
+        first.preload({'KATL': '/history/airport/KATL'})
+        second.preload({'KFTY': '/history/airport/KFTY'})
+        first.preload({'KPDK': '/history/airport/KPDK'})
+        reloaded = wunderground_scraper.StationTable(self.path)
+        self.assertEqual([location for location, _ in reloaded.items()],
+                         ['KATL', 'KFTY', 'KPDK'])
+        self.assertEqual(sorted(os.listdir(self.directory.name)),
+                         ['stations.json', 'stations.json.lock'])
+
+    def test_station_table_preload(self):
+        """ Make sure preloaded stations can be looked up by any spelling.
+        """
+        stations = wunderground_scraper.StationTable()
+        stations.preload({'Atlanta, GA': '/history/airport/KFTY'})
+        self.assertEqual(stations.get('atlanta, ga'), '/history/airport/KFTY')
+
+    def test_scrape_range_stations(self):
+        """ Make sure only the first lookup for a location goes through
+        the redirect.
+        """
+        stations = wunderground_scraper.StationTable()
+        with FakeWundergroundServer() as server:
+            results = list(wunderground_scraper.scrape_range(
+                ['Atlanta, GA'], datetime.date(2017, 10, 1),
+                datetime.date(2017, 10, 5), concurrency=1, stations=stations,
+                base_url=server.url))
+        # One redirect and five pages
+        self.assertEqual(server.requests, 6)
+        self.assertEqual(stations.get('Atlanta, GA'), '/history/airport/KFTY')
+        for _, _, json_data in results:
+            self.assertEqual(json_data, TestScrapeRange.expected_data)
+
+
+class TestOutputSinks(unittest.TestCase):
+    """ Tests the streaming output sinks.
+    """
+
+    data = '{"Actual Max Temperature": "86F", "Record Max Temperature": "104F (1999)"}'
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write_days(self, sink, days):
+        """ Writes a result for KFTY for each day of October 2017.
+
+        :param sink: OutputSink to write to
+        :param days: Days of the month to write
+        """
+        for day in days:
+            sink.write('KFTY', datetime.date(2017, 10, day), self.data)
+
+    def test_ndjson_sink(self):
+        """ Make sure results are written as json lines and the file only
+        appears once the sink is closed.
+        """
+        path = os.path.join(self.directory.name, 'out.ndjson')
+        with wunderground_scraper.open_sink(path, batch_size=2) as sink:
+            self.write_days(sink, [1, 2, 3])
+            self.assertFalse(os.path.exists(path))
+        with open(path) as output:
+            lines = output.read().splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(lines[0], wunderground_scraper.format_batch_result(
+            'KFTY', datetime.date(2017, 10, 1), self.data))
+        self.assertFalse(os.path.exists(path + '.checkpoint'))
+
+    def test_csv_sink(self):
+        """ Make sure results are written as csv rows under a header.
+        """
+        path = os.path.join(self.directory.name, 'out.csv')
+        with wunderground_scraper.open_sink(path) as sink:
+            self.write_days(sink, [1])
+        with open(path) as output:
+            lines = output.read().splitlines()
+        self.assertEqual(lines[0].split(',')[:3],
+                         ['location', 'date', 'Actual Max Temperature'])
+        self.assertEqual(lines[1].split(',')[:3], ['KFTY', '2017-10-01', '86F'])
+
+    def test_sink_resume(self):
+        """ Make sure a killed run resumes from its last checkpoint, dropping
+        results written after it and skipping the ones before it.
+        """
+        for output_format in ('ndjson', 'csv'):
+            path = os.path.join(self.directory.name, 'out.' + output_format)
+            sink = wunderground_scraper.open_sink(path, batch_size=2)
+            self.write_days(sink, [1, 2, 3])
+            # Results written after the checkpoint are lost with the process
+            sink._file.write(b'{"half a line')
+            sink._file.close()
+            sink = wunderground_scraper.open_sink(path, batch_size=2)
+            self.assertTrue(sink.is_completed('kfty', datetime.date(2017, 10, 2)))
+            self.assertFalse(sink.is_completed('KFTY', datetime.date(2017, 10, 3)))
+            self.write_days(sink, [3, 4])
+            sink.close()
+            with open(path) as output:
+                lines = output.read().splitlines()
+            header = 1 if output_format == 'csv' else 0
+            self.assertEqual(len(lines), 4 + header, output_format)
+
+    @unittest.skipUnless(HAVE_PYARROW, 'pyarrow is not installed')
+    def test_parquet_sink(self):
+        """ Make sure results are written to a readable Parquet file.
+        """
+        path = os.path.join(self.directory.name, 'out.parquet')
+        with wunderground_scraper.open_sink(path, batch_size=2) as sink:
+            self.write_days(sink, [1, 2, 3])
+        table = pyarrow.parquet.read_table(path)
+        self.assertEqual(table.num_rows, 3)
+        self.assertEqual(table.column('Actual Max Temperature').to_pylist(),
+                         ['86F', '86F', '86F'])
+
+    def test_scrape_range_skip(self):
+        """ Make sure jobs the skip function accepts are left out.
+        """
+        with FakeWundergroundServer() as server:
+            results = list(wunderground_scraper.scrape_range(
+                ['KFTY'], datetime.date(2017, 10, 1), datetime.date(2017, 10, 4),
+                skip=lambda location, date: date.day % 2 == 0,
+                base_url=server.url))
+        days = sorted(date.day for _, date, _ in results)
+        self.assertEqual(days, [1, 3])
+
+
+class TestScrapeRange(unittest.TestCase):
+    """ Tests the batch scraping mode against a local stand-in server.
+    """
+
+    expected_data = '{"Actual Max Temperature": "86F", ' \
+                    '"Actual Mean Temperature": "76F", ' \
+                    '"Actual Min Temperature": "66F", ' \
+                    '"Average Max Temperature": "75F", ' \
+                    '"Average Mean Temperature": "64F", ' \
+                    '"Average Min Temperature": "53F", ' \
+                    '"Record Max Temperature": "104F (1999)", ' \
+                    '"Record Min Temperature": "32F (2000)"}'
+
+    def test_date_range(self):
+        """ Make sure date_range includes both ends of the range and
+        crosses month boundaries.
+        """
+        answer = list(wunderground_scraper.date_range(datetime.date(2017, 9, 30),
+                                                      datetime.date(2017, 10, 2)))
+        expected = [datetime.date(2017, 9, 30), datetime.date(2017, 10, 1),
+                    datetime.date(2017, 10, 2)]
+        self.assertEqual(answer, expected)
+
+    def test_scrape_range(self):
+        """ Make sure scrape_range returns one result for every location
+        and date, each with the scraped data.
+        """
+        with FakeWundergroundServer() as server:
+            results = list(wunderground_scraper.scrape_range(
+                ['Atlanta, GA', 'KFTY'], datetime.date(2017, 10, 1),
+                datetime.date(2017, 10, 5), base_url=server.url))
+        self.assertEqual(len(results), 10)
+        jobs = set((location, date) for location, date, _ in results)
+        self.assertEqual(len(jobs), 10)
+        for _, _, json_data in results:
+            self.assertEqual(json_data, self.expected_data)
+
+    def test_scrape_range_concurrency(self):
+        """ Make sure throughput scales with concurrency against a server
+        which takes a fixed amount of time to answer each request.
+        """
+        start = datetime.date(2017, 10, 1)
+        end = datetime.date(2017, 10, 8)
+        timings = dict()
+        with FakeWundergroundServer(delay=0.05) as server:
+            for concurrency in (1, 8):
+                started = time.perf_counter()
+                list(wunderground_scraper.scrape_range(
+                    ['KFTY'], start, end, concurrency=concurrency,
+                    base_url=server.url))
+                timings[concurrency] = time.perf_counter() - started
+        # Each job costs two delayed requests (redirect and page), so
+        # running them eight at a time should be several times faster
+        self.assertLess(timings[8] * 3, timings[1])
+
+    def test_rate_limiter(self):
+        """ Make sure the rate limiter spaces out requests to one host
+        but doesn't hold back other hosts.
+        """
+        limiter = wunderground_scraper.RateLimiter(20)
+        started = time.perf_counter()
+        for _ in range(5):
+            limiter.wait('http://one.example/page')
+        limiter.wait('http://two.example/page')
+        elapsed = time.perf_counter() - started
+        # Four waits of 1/20th of a second for the first host
+        self.assertGreaterEqual(elapsed, 0.19)
+        self.assertLess(elapsed, 0.4)
+
+    def test_parse_arguments(self):
+        """ Make sure the batch mode arguments are parsed into dates
+        and validated locations.
+        """
+        args = wunderground_scraper.parse_arguments(
+            ['--location', 'Atlanta, GA', '--location', 'KFTY',
+             '--start', '2017-10-01', '--end', '2017-10-31',
+             '--concurrency', '8'])
+        self.assertEqual(args.locations, ['Atlanta, GA', 'KFTY'])
+        self.assertEqual(args.start, datetime.date(2017, 10, 1))
+        self.assertEqual(args.end, datetime.date(2017, 10, 31))
+        self.assertEqual(args.concurrency, 8)
+
+    def test_parse_arguments_needs_dates(self):
+        """ Make sure locations without any dates are a usage error.
+        """
+        with self.assertRaises(SystemExit):
+            wunderground_scraper.parse_arguments(['--location', 'KFTY'])
+
+    def test_validate_job(self):
+        """ Make sure jobs are validated with the same rules as the prompts.
+        """
+        self.assertEqual(wunderground_scraper.validate_job('KFTY', '2016-02-29'),
+                         (datetime.date(2016, 2, 29), None))
+        self.assertEqual(wunderground_scraper.validate_job('kfty', '2016-02-29'),
+                         (None, 'Location invalid'))
+        self.assertEqual(wunderground_scraper.validate_job('KFTY', '2016/02/29'),
+                         (None, 'Date invalid'))
+        self.assertEqual(wunderground_scraper.validate_job('KFTY', '2016-13-01'),
+                         (None, 'Month invalid'))
+        self.assertEqual(wunderground_scraper.validate_job('KFTY', '2016-20-01'),
+                         (None, 'Month invalid'))
+        self.assertEqual(wunderground_scraper.validate_job('KFTY', '2016-04-31'),
+                         (None, 'Day invalid'))
+        self.assertEqual(wunderground_scraper.validate_job('KFTY', '2015-02-29'),
+                         (None, 'Year invalid'))
+
+    def test_validate_jobs(self):
+        """ Make sure bulk validation agrees with validate_job, leap days,
+        month lengths and future dates included.
+        """
+        requested = [('kfty', '2016-02-29'), ('KFTY', '2016/02/29'), ('KFTY', '')]
+        for year in ('0000', '1900', '2000', '2015', '2016', '9999'):
+            for month in ('0', '00', '1', '02', '2', '4', '09', '12', '13',
+                          '20', '23', '99'):
+                for day in ('0', '00', '1', '01', '28', '29', '30', '31', '32', '99'):
+                    requested.append(('KFTY', '%s-%s-%s' % (year, month, day)))
+        jobs, errors = wunderground_scraper.validate_jobs(requested)
+        expected_jobs = []
+        expected_errors = []
+        for location, date_string in requested:
+            date, error = wunderground_scraper.validate_job(location, date_string)
+            if error is None:
+                expected_jobs.append((location, date))
+            else:
+                expected_errors.append((location, date_string, error))
+        self.assertEqual(jobs, expected_jobs)
+        self.assertEqual(errors, expected_errors)
+
+    def test_expand_jobs(self):
+        """ Make sure ranges are expanded lazily into a job per location and
+        day, across month ends and leap days.
+        """
+        jobs = wunderground_scraper.expand_jobs(
+            ['KFTY', 'KATL'], [(datetime.date(2016, 2, 28), datetime.date(2016, 3, 1)),
+                               (datetime.date(2016, 12, 31), datetime.date(2016, 12, 31))])
+        self.assertNotIsInstance(jobs, list)
+        dates = [datetime.date(2016, 2, 28), datetime.date(2016, 2, 29),
+                 datetime.date(2016, 3, 1), datetime.date(2016, 12, 31)]
+        self.assertEqual(list(jobs), [('KFTY', date) for date in dates] +
+                         [('KATL', date) for date in dates])
+
+    def test_read_jobs(self):
+        """ Make sure the date is split off the end of each job line and
+        blank and comment lines are skipped.
+        """
+        lines = ['# backfill\n', 'Los Angeles, California 2017-10-11\n', '\n',
+                 'KFTY\t2017-10-12\n', 'KFTY\n']
+        answer = list(wunderground_scraper.read_jobs(lines))
+        expected = [('Los Angeles, California', '2017-10-11'),
+                    ('KFTY', '2017-10-12'), ('KFTY', '')]
+        self.assertEqual(answer, expected)
+
+    def test_plan_jobs(self):
+        """ Make sure jobs from arguments and stdin are combined, and invalid
+        jobs are reported without dropping the valid ones.
+        """
+        args = wunderground_scraper.parse_arguments(
+            ['--location', 'KFTY', '--location', 'kfty', '--date', '2017-10-11',
+             '--start', '2017-10-01', '--end', '2017-10-02', '--jobs-file', '-'])
+        stdin = io.StringIO('Atlanta, GA 2017-10-11\nAtlanta, GA 2017-02-30\n')
+        jobs, errors = wunderground_scraper.plan_jobs(args, stdin)
+        expected = [('KFTY', datetime.date(2017, 10, 11)),
+                    ('Atlanta, GA', datetime.date(2017, 10, 11)),
+                    ('KFTY', datetime.date(2017, 10, 1)),
+                    ('KFTY', datetime.date(2017, 10, 2))]
+        self.assertEqual(list(jobs), expected)
+        self.assertEqual(errors, [
+            '{"date": "2017-10-11", "error": "Location invalid", "location": "kfty"}',
+            '{"date": "2017-02-30", "error": "Day invalid", "location": "Atlanta, GA"}',
+            '{"date": null, "error": "Location invalid", "location": "kfty"}'])
+
+    def test_format_batch_result(self):
+        """ Make sure batch results are formatted as one line of json.
+        """
+        answer = wunderground_scraper.format_batch_result(
+            'KFTY', datetime.date(2017, 10, 11), '{"Actual Max Temperature": "86F"}')
+        expected = '{"data": {"Actual Max Temperature": "86F"}, ' \
+                   '"date": "2017-10-11", "location": "KFTY"}'
+        self.assertEqual(answer, expected)
+
+
+class TestRangeView(unittest.TestCase):
+    """ Tests fetching runs of days through the Monthly and Custom history
+    views.
+    """
+
+    expected_data = '{"Actual Max Temperature": "86F", ' \
+                    '"Actual Mean Temperature": "76F", ' \
+                    '"Actual Min Temperature": "66F"}'
+
+    def test_get_range_url_month(self):
+        """ Make sure a whole month uses the MonthlyHistory view.
+        """
+        answer = wunderground_scraper.get_range_url(
+            'Atlanta, GA', datetime.date(2017, 2, 1), datetime.date(2017, 2, 28))
+        expected = 'https://www.wunderground.com/cgi-bin/findweather/' \
+                   'getForecast?airportorwmo=query&historytype=MonthlyHistory&' \
+                   'backurl=/history/index.html&code=Atlanta,+GA&' \
+                   'month=2&day=1&year=2017'
+        self.assertEqual(answer, expected)
+
+    def test_get_range_url_custom(self):
+        """ Make sure part of a month uses the CustomHistory view.
+        """
+        answer = wunderground_scraper.get_range_url(
+            'KFTY', datetime.date(2017, 10, 5), datetime.date(2017, 10, 20))
+        self.assertIn('historytype=CustomHistory&', answer)
+        self.assertTrue(answer.endswith('month=10&day=5&year=2017&'
+                                        'dayend=20&monthend=10&yearend=2017'))
+
+    def test_get_station_range_url(self):
+        """ Make sure a known station's range url skips the redirect.
+        """
+        answer = wunderground_scraper.get_station_range_url(
+            '/history/airport/KFTY', datetime.date(2017, 10, 5),
+            datetime.date(2017, 10, 20))
+        expected = 'https://www.wunderground.com/history/airport/KFTY/' \
+                   '2017/10/5/CustomHistory.html?dayend=20&monthend=10&yearend=2017'
+        self.assertEqual(answer, expected)
+
+    def test_plan_spans(self):
+        """ Make sure long runs become spans split at month boundaries and
+        short runs, gaps and location changes fall back to single days.
+        """
+        jobs = [('KFTY', datetime.date(2017, 9, day)) for day in range(25, 31)]
+        jobs += [('KFTY', datetime.date(2017, 10, day)) for day in range(1, 11)]
+        jobs += [('KFTY', datetime.date(2017, 10, 12))]
+        jobs += [('KATL', datetime.date(2017, 10, day)) for day in range(1, 3)]
+        answer = list(wunderground_scraper.plan_spans(iter(jobs), min_days=7))
+        september = [('KFTY', datetime.date(2017, 9, day), datetime.date(2017, 9, day))
+                     for day in range(25, 31)]
+        expected = september + [
+            ('KFTY', datetime.date(2017, 10, 1), datetime.date(2017, 10, 10)),
+            ('KFTY', datetime.date(2017, 10, 12), datetime.date(2017, 10, 12)),
+            ('KATL', datetime.date(2017, 10, 1), datetime.date(2017, 10, 1)),
+            ('KATL', datetime.date(2017, 10, 2), datetime.date(2017, 10, 2))]
+        self.assertEqual(answer, expected)
+
+    def test_parse_range_page(self):
+        """ Make sure every parser backend reads each day of the monthly
+        fixture, skipping days outside the range.
+        """
+        page = read_fixture('MonthlyHistory.html')
+        for name in wunderground_scraper.PARSERS:
+            if name == 'lxml' and not HAVE_LXML:
+                continue
+            days = wunderground_scraper.parse_range_page(
+                page, 'url', datetime.date(2017, 10, 10),
+                datetime.date(2017, 10, 31), name)
+            self.assertEqual(sorted(days), list(wunderground_scraper.date_range(
+                datetime.date(2017, 10, 10), datetime.date(2017, 10, 31))), name)
+            self.assertEqual(wunderground_scraper.format_fields(
+                days[datetime.date(2017, 10, 11)]), self.expected_data, name)
+
+    def test_parse_range_page_missing(self):
+        """ Make sure a page without the range table is reported.
+        """
+        with self.assertRaises(wunderground_scraper.ParseError):
+            wunderground_scraper.parse_range_page(
+                read_fixture('DailyHistory.html')[:100], 'url',
+                datetime.date(2017, 10, 1), datetime.date(2017, 10, 31))
+
+    def test_scrape_range_view(self):
+        """ Make sure a whole month is fetched with one redirect and one
+        page, and that the station learned lets the next month skip the
+        redirect.
+        """
+        stations = wunderground_scraper.StationTable()
+        with FakeWundergroundServer() as server:
+            results = list(wunderground_scraper.scrape_range(
+                ['Atlanta, GA'], datetime.date(2017, 10, 1),
+                datetime.date(2017, 10, 31), stations=stations,
+                base_url=server.url, range_days=7))
+            self.assertEqual(server.requests, 2)
+        self.assertEqual(len(results), 31)
+        self.assertEqual(stations.get('Atlanta, GA'), '/history/airport/KFTY')
+        answer = dict((date, json_data) for _, date, json_data in results)
+        self.assertEqual(answer[datetime.date(2017, 10, 11)], self.expected_data)
+
+    def test_scrape_range_view_short_run(self):
+        """ Make sure runs shorter than range_days use the daily pages,
+        cut down to the same fields as the range view.
+        """
+        with FakeWundergroundServer() as server:
+            results = list(wunderground_scraper.scrape_range(
+                ['KFTY'], datetime.date(2017, 10, 1), datetime.date(2017, 10, 3),
+                base_url=server.url, range_days=7))
+            self.assertEqual(server.requests, 6)
+        self.assertEqual(len(results), 3)
+        for _, _, json_data in results:
+            self.assertEqual(json_data, self.expected_data)
+
+    def test_parse_arguments_range_view(self):
+        """ Make sure --range-view defaults its minimum run length.
+        """
+        arguments = wunderground_scraper.parse_arguments(
+            ['--location', 'KFTY', '--date', '2017-10-11', '--range-view'])
+        self.assertEqual(arguments.range_days, wunderground_scraper.RANGE_MIN_DAYS)
+        arguments = wunderground_scraper.parse_arguments(
+            ['--range-view', '3', '--location', 'KFTY', '--date', '2017-10-11'])
+        self.assertEqual(arguments.range_days, 3)
+
+
+class TestClimatology(unittest.TestCase):
+    """ Tests reusing the Average and Record columns across years.
+    """
+
+    climate = {'Average Max Temperature': '75F',
+               'Average Mean Temperature': '64F',
+               'Average Min Temperature': '53F',
+               'Record Max Temperature': '104F (1999)',
+               'Record Min Temperature': '32F (2000)'}
+
+    def setUp(self):
+        self.climatology = wunderground_scraper.ClimatologyTable(':memory:')
+
+    def tearDown(self):
+        self.climatology.close()
+
+    def test_actual_fields(self):
+        """ Make sure ACTUAL_FIELDS only reads the Actual column.
+        """
+        answer = wunderground_scraper.parse_weather_page(
+            read_fixture('DailyHistory.html'), 'url',
+            fields=wunderground_scraper.ACTUAL_FIELDS)
+        self.assertEqual(wunderground_scraper.format_fields(answer),
+                         TestRangeView.expected_data)
+
+    def test_table_reused_across_years(self):
+        """ Make sure entries are shared by every year of a station-day and
+        only the climatology keys are stored.
+        """
+        field_dict = dict(self.climate, **{'Actual Max Temperature': '86F'})
+        self.climatology.put('KFTY', datetime.date(2017, 10, 11), field_dict)
+        self.assertEqual(self.climatology.get('KFTY', datetime.date(1996, 10, 11)),
+                         self.climate)
+        self.assertIsNone(self.climatology.get('KFTY', datetime.date(2017, 10, 12)))
+        self.assertIsNone(self.climatology.get('KATL', datetime.date(2017, 10, 11)))
+        self.assertEqual(self.climatology.stats(),
+                         {'hits': 1, 'misses': 2, 'invalidations': 0})
+
+    def test_table_max_age(self):
+        """ Make sure entries older than max_age are refetched.
+        """
+        self.climatology.max_age = 0
+        self.climatology.put('KFTY', datetime.date(2017, 10, 11), self.climate)
+        time.sleep(0.01)
+        self.assertIsNone(self.climatology.get('KFTY', datetime.date(2017, 10, 11)))
+
+    def test_record_is_broken(self):
+        """ Make sure actuals beating either record are noticed.
+        """
+        field_dict = dict(self.climate, **{'Actual Max Temperature': '86F',
+                                           'Actual Min Temperature': '66F'})
+        self.assertFalse(wunderground_scraper.record_is_broken(field_dict))
+        field_dict['Actual Max Temperature'] = '105F'
+        self.assertTrue(wunderground_scraper.record_is_broken(field_dict))
+        field_dict['Actual Max Temperature'] = '86F'
+        field_dict['Actual Min Temperature'] = '31F'
+        self.assertTrue(wunderground_scraper.record_is_broken(field_dict))
+
+    def test_scrape_reuses_climatology(self):
+        """ Make sure the first scrape of a station-day fills the table and
+        later years are answered with the same data from it.
+        """
+        with FakeWundergroundServer() as server:
+            for year in (2017, 2016):
+                answer = wunderground_scraper.scrape_location_date(
+                    'KFTY', datetime.date(year, 10, 11), base_url=server.url,
+                    climatology=self.climatology)
+                self.assertEqual(answer, TestScrapeRange.expected_data)
+        self.assertEqual(self.climatology.stats()['hits'], 1)
+
+    def test_scrape_broken_record(self):
+        """ Make sure a stored record beaten by the page's actual is
+        replaced with the record shown on the page.
+        """
+        stale = dict(self.climate, **{'Record Max Temperature': '80F (1990)'})
+        self.climatology.put('KFTY', datetime.date(2017, 10, 11), stale)
+        with FakeWundergroundServer() as server:
+            answer = wunderground_scraper.scrape_location_date(
+                'KFTY', datetime.date(2017, 10, 11), base_url=server.url,
+                climatology=self.climatology)
+        self.assertEqual(answer, TestScrapeRange.expected_data)
+        self.assertEqual(self.climatology.stats()['invalidations'], 1)
+        self.assertEqual(self.climatology.get('KFTY', datetime.date(2017, 10, 11)),
+                         self.climate)
+
+    def test_range_view_with_climatology(self):
+        """ Make sure the range view fills in unknown days from their daily
+        pages once, then answers the month with a single request.
+        """
+        stations = wunderground_scraper.StationTable()
+        with FakeWundergroundServer() as server:
+            for expected_requests in (2 + 31, 1):
+                server.requests = 0
+                results = list(wunderground_scraper.scrape_range(
+                    ['KFTY'], datetime.date(2017, 10, 1),
+                    datetime.date(2017, 10, 31), stations=stations,
+                    base_url=server.url, range_days=7,
+                    climatology=self.climatology))
+                self.assertEqual(server.requests, expected_requests)
+                answer = dict((date, json_data) for _, date, json_data in results)
+                self.assertEqual(answer[datetime.date(2017, 10, 11)],
+                                 TestScrapeRange.expected_data)
+
+
+class TestMetrics(unittest.TestCase):
+    """ Tests the per-stage timings, counters and the profiler.
+    """
+
+    def tearDown(self):
+        wunderground_scraper.disable_metrics()
+
+    def test_disabled_by_default(self):
+        """ Make sure nothing is collected until metrics are enabled.
+        """
+        self.assertFalse(wunderground_scraper.METRICS.enabled)
+        with wunderground_scraper.METRICS.timer('parse'):
+            wunderground_scraper.METRICS.count('requests_total', status=200)
+
+    def test_prometheus_format(self):
+        """ Make sure counters and cumulative histogram buckets are
+        exported in the Prometheus text format.
+        """
+        metrics = wunderground_scraper.Metrics()
+        metrics.count('requests_total', status=200)
+        metrics.count('requests_total', 2, status=200)
+        metrics.observe('page_bytes', 2000)
+        metrics.observe('page_bytes', 5000000)
+        lines = metrics.to_prometheus().splitlines()
+        self.assertIn('# TYPE wunderground_requests_total counter', lines)
+        self.assertIn('wunderground_requests_total{status="200"} 3', lines)
+        self.assertIn('# TYPE wunderground_page_bytes histogram', lines)
+        self.assertIn('wunderground_page_bytes_bucket{le="1024"} 0', lines)
+        self.assertIn('wunderground_page_bytes_bucket{le="4096"} 1', lines)
+        self.assertIn('wunderground_page_bytes_bucket{le="4194304"} 1', lines)
+        self.assertIn('wunderground_page_bytes_bucket{le="+Inf"} 2', lines)
+        self.assertIn('wunderground_page_bytes_sum 5002000', lines)
+        self.assertIn('wunderground_page_bytes_count 2', lines)
+
+    def test_summary(self):
+        """ Make sure the json summary gives each series' count and mean.
+        """
+        metrics = wunderground_scraper.Metrics()
+        metrics.count('errors_total', type='ParseError')
+        metrics.observe('stage_seconds', 0.002, stage='parse')
+        metrics.observe('stage_seconds', 0.004, stage='parse')
+        summary = metrics.summary()
+        self.assertEqual(summary['counters'], {'errors_total': {'type=ParseError': 1}})
+        parse = summary['histograms']['stage_seconds']['stage=parse']
+        self.assertEqual(parse['count'], 2)
+        self.assertAlmostEqual(parse['mean'], 0.003)
+        self.assertEqual(parse['buckets']['0.005'], 2)
+
+    def test_scrape_stages(self):
+        """ Make sure scraping reports every stage, the status codes of the
+        redirect and the page, and the bytes read.
+        """
+        metrics = wunderground_scraper.enable_metrics()
+        with FakeWundergroundServer() as server:
+            list(wunderground_scraper.scrape_range(
+                ['KFTY'], datetime.date(2017, 10, 1), datetime.date(2017, 10, 2),
+                base_url=server.url))
+        summary = metrics.summary()
+        self.assertEqual(summary['counters']['requests_total'],
+                         {'status=200': 2, 'status=302': 2})
+        for stage in ('redirect', 'request', 'download', 'parse', 'extract', 'task'):
+            self.assertEqual(summary['histograms']['stage_seconds']['stage=' + stage]
+                             ['count'], 2, stage)
+        self.assertEqual(summary['histograms']['page_bytes']['']['count'], 2)
+
+    def test_retries_counted(self):
+        """ Make sure requests retried after a 503 are counted.
+        """
+        metrics = wunderground_scraper.enable_metrics()
+        with FakeWundergroundServer() as server, \
+                wunderground_scraper.Fetcher(backoff_factor=0) as fetcher:
+            server.failures = 2
+            url = wunderground_scraper.get_url('KFTY', '11', '10', '2017',
+                                               base_url=server.url)
+            wunderground_scraper.scrape_weather_fields(url, fetcher)
+        self.assertEqual(metrics.summary()['counters']['retries_total'], {'': 2})
+
+    def test_write_metrics(self):
+        """ Make sure metrics are written as json or Prometheus text
+        depending on the file's extension.
+        """
+        metrics = wunderground_scraper.Metrics()
+        metrics.count('requests_total', status=200)
+        with tempfile.TemporaryDirectory() as directory:
+            json_path = os.path.join(directory, 'metrics.json')
+            prometheus_path = os.path.join(directory, 'metrics.prom')
+            wunderground_scraper.write_metrics(metrics, json_path)
+            wunderground_scraper.write_metrics(metrics, prometheus_path)
+            with open(json_path) as json_file:
+                self.assertEqual(json.load(json_file), metrics.summary())
+            with open(prometheus_path) as prometheus_file:
+                self.assertEqual(prometheus_file.read(), metrics.to_prometheus())
+
+    def test_profiler(self):
+        """ Make sure the profile covers the work done in worker threads.
+        """
+        profiler = wunderground_scraper.Profiler()
+        jobs = [('KFTY', datetime.date(2017, 10, day)) for day in range(1, 4)]
+        with FakeWundergroundServer() as server, \
+                tempfile.TemporaryDirectory() as directory:
+            profiler.call(lambda: list(wunderground_scraper.scrape_jobs(
+                jobs, concurrency=2, base_url=server.url, profiler=profiler)))
+            path = os.path.join(directory, 'run.prof')
+            profiler.dump(path)
+            functions = set(name for _, _, name in pstats.Stats(path).stats)
+        self.assertIn('extract_fields', functions)
+
+
+class TestParsePool(unittest.TestCase):
+    """ Tests parsing pages in worker processes.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        # Spawning the workers is slow, so the tests share them
+        cls.parse_pool = wunderground_scraper.ParsePool(2)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.parse_pool.close()
+
+    def test_parse_pool(self):
+        """ Make sure a table parsed in a worker matches one parsed in
+        this process.
+        """
+        fragment = wunderground_scraper.slice_history_table(
+            read_fixture('DailyHistory.html'))
+        self.assertEqual(
+            self.parse_pool.run(wunderground_scraper.parse_history_table, fragment),
+            wunderground_scraper.parse_history_table(fragment))
+
+    def test_parse_pool_errors(self):
+        """ Make sure errors raised in a worker reach the caller.
+        """
+        with self.assertRaises(wunderground_scraper.ParseError):
+            self.parse_pool.run(wunderground_scraper.parse_history_table,
+                                b'<table><tr><td>Actual</td></tr></table>')
+
+    def test_scrape_jobs_parse_pool(self):
+        """ Make sure daily and range pages scraped with parse workers give
+        the same results as parsing them in the fetching threads.
+        """
+        jobs = [('KFTY', datetime.date(2017, 10, day)) for day in range(1, 11)] + \
+               [('KFTY', datetime.date(2017, 11, 1))]
+        with FakeWundergroundServer() as server:
+            expected = sorted(wunderground_scraper.scrape_jobs(
+                jobs, base_url=server.url, range_days=7))
+            answer = sorted(wunderground_scraper.scrape_jobs(
+                jobs, base_url=server.url, range_days=7, parse_workers=2))
+        self.assertEqual(answer, expected)
+        self.assertNotIn('error', answer[0][2])
+
+    def test_scrape_jobs_parse_pool_climatology(self):
+        """ Make sure results finished off with a ClimatologyTable after
+        parsing in the workers match those parsed in the fetching threads.
+        """
+        jobs = [('KFTY', datetime.date(2017, 10, day)) for day in range(1, 9)]
+        with FakeWundergroundServer() as server:
+            expected = sorted(wunderground_scraper.scrape_jobs(
+                jobs, base_url=server.url, range_days=7,
+                climatology=wunderground_scraper.ClimatologyTable(':memory:')))
+            answer = sorted(wunderground_scraper.scrape_jobs(
+                jobs, base_url=server.url, range_days=7, parse_workers=2,
+                climatology=wunderground_scraper.ClimatologyTable(':memory:')))
+        self.assertEqual(answer, expected)
+        self.assertFalse([json_data for _, _, json_data in answer
+                          if 'error' in json_data])
+
+    def test_scrape_jobs_parse_pool_coalesced(self):
+        """ Make sure jobs which share one fetch and parse all get their
+        result when pages are parsed in the workers.
+        """
+        date = datetime.date(2017, 10, 11)
+        jobs = [(location, date) for location in ('Atlanta, GA', 'atlanta, ga',
+                                                  'ATLANTA, GA')]
+        with FakeWundergroundServer(delay=0.2) as server:
+            answer = list(wunderground_scraper.scrape_jobs(
+                jobs, base_url=server.url, parse_workers=1))
+        self.assertEqual(sorted((location, date) for location, date, _ in answer),
+                         sorted(jobs))
+        for _, _, json_data in answer:
+            self.assertEqual(json_data, TestScrapeRange.expected_data)
+
+    def test_parse_pool_frees_fetch_thread(self):
+        """ Make sure fetching a page hands its parse to the workers rather
+        than waiting for it, and the result is cached once it is finished.
+        """
+        date = datetime.date(2017, 10, 11)
+        with tempfile.TemporaryDirectory() as directory, \
+                FakeWundergroundServer() as server, \
+                wunderground_scraper.PageCache(
+                    os.path.join(directory, 'cache.sqlite')) as cache:
+            deferred = wunderground_scraper.scrape_location_date(
+                'KFTY', date, cache=cache, base_url=server.url,
+                parse_pool=self.parse_pool)
+            self.assertIsInstance(deferred, wunderground_scraper.DeferredParse)
+            json_data = deferred.result()
+            self.assertEqual(json_data, wunderground_scraper.scrape_location_date(
+                'KFTY', date, base_url=server.url))
+            self.assertEqual(cache.get('KFTY', date), json_data)
+            # Finished only once however often it is asked for
+            self.assertIs(deferred.result(), json_data)
+
+    def test_parse_arguments_parse_workers(self):
+        """ Make sure --parse-workers without a number means one per core.
+        """
+        arguments = wunderground_scraper.parse_arguments(
+            ['--location', 'KFTY', '--date', '2017-10-11'])
+        self.assertIsNone(arguments.parse_workers)
+        arguments = wunderground_scraper.parse_arguments(
+            ['--location', 'KFTY', '--date', '2017-10-11', '--parse-workers'])
+        self.assertEqual(arguments.parse_workers, 0)
+        arguments = wunderground_scraper.parse_arguments(
+            ['--parse-workers', '3', '--location', 'KFTY', '--date', '2017-10-11'])
+        self.assertEqual(arguments.parse_workers, 3)
+
+
+class TestWorkQueue(unittest.TestCase):
+    """ Tests sharing jobs out between workers through a work queue.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'queue.sqlite')
+        self.queue = wunderground_scraper.open_queue(self.path)
+        self.jobs = [('KFTY', datetime.date(2017, 10, day)) for day in range(1, 6)]
+
+    def tearDown(self):
+        self.queue.close()
+        self.directory.cleanup()
+
+    def test_lease_and_complete(self):
+        """ Make sure jobs are leased in the order they were queued, never
+        to two workers at once, and queueing them again adds nothing.
+        """
+        self.assertEqual(self.queue.put(self.jobs), 5)
+        self.assertEqual(self.queue.put(self.jobs), 0)
+        self.assertEqual(self.queue.lease('a', 2), self.jobs[:2])
+        self.assertEqual(self.queue.lease('b', 2), self.jobs[2:4])
+        self.assertTrue(self.queue.complete('a', *self.jobs[0]))
+        self.assertFalse(self.queue.complete('b', *self.jobs[1]))
+        self.queue.release('b')
+        self.assertEqual(self.queue.counts(), {'pending': 3, 'leased': 1,
+                                               'done': 1, 'failed': 0})
+        self.assertEqual(self.queue.lease('c', 5), self.jobs[2:])
+
+    def test_abandoned_lease(self):
+        """ Make sure a job is leased again once its lease runs out, unless
+        heartbeats keep it alive, and is failed after too many attempts.
+        """
+        self.queue.put(self.jobs[:2])
+        self.queue.lease('a', 2, lease_seconds=0.05)
+        self.queue.heartbeat('a', lease_seconds=60)
+        self.assertEqual(self.queue.lease('b', 2), [])
+        self.queue.heartbeat('a', lease_seconds=0)
+        time.sleep(0.01)
+        self.assertEqual(self.queue.lease('b', 2, lease_seconds=0), self.jobs[:2])
+        # The worker which lost the lease can't complete the job any more
+        self.assertFalse(self.queue.complete('a', *self.jobs[0]))
+        time.sleep(0.01)
+        self.assertEqual(len(self.queue.lease('c', 2, lease_seconds=0)), 2)
+        time.sleep(0.01)
+        self.assertEqual(self.queue.lease('d', 2), [])
+        self.assertEqual(self.queue.counts()['failed'], 2)
+
+    def test_failed_job_retried(self):
+        """ Make sure a failed job is retried until it has been tried
+        max_attempts times, and queueing it again starts it over.
+        """
+        self.queue.put(self.jobs[:1])
+        for attempt in range(wunderground_scraper.QUEUE_MAX_ATTEMPTS):
+            self.assertEqual(self.queue.lease('a', 1), self.jobs[:1])
+            self.queue.complete('a', *self.jobs[0], error='Request timed out')
+        self.assertEqual(self.queue.lease('a', 1), [])
+        self.assertEqual(self.queue.counts()['failed'], 1)
+        self.assertEqual(self.queue.put(self.jobs[:1]), 1)
+        self.assertEqual(self.queue.lease('a', 1), self.jobs[:1])
+
+    def test_work_queue(self):
+        """ Make sure a worker scrapes every job in the queue and completes
+        them.
+        """
+        self.queue.put(self.jobs)
+        with FakeWundergroundServer() as server:
+            results = list(wunderground_scraper.work_queue(
+                self.queue, 'a', base_url=server.url))
+        self.assertEqual(sorted(date for _, date, _ in results),
+                         [date for _, date in self.jobs])
+        self.assertEqual(results[0][2], TestScrapeRange.expected_data)
+        self.assertEqual(self.queue.counts()['done'], 5)
+
+    def test_worker_processes(self):
+        """ Make sure several worker processes share out the queue, writing
+        every day to a shared store exactly once between them.
+        """
+        import multiprocessing
+        store_path = os.path.join(self.directory.name, 'history.sqlite')
+        stations_path = os.path.join(self.directory.name, 'stations.json')
+        jobs = [('KFTY', date) for date in wunderground_scraper.date_range(
+            datetime.date(2017, 9, 1), datetime.date(2017, 10, 31))]
+        self.queue.put(jobs)
+        arguments = wunderground_scraper.parse_arguments(
+            ['--queue', self.path, '--work', '3', '--store', store_path,
+             '--stations', stations_path])
+        context = multiprocessing.get_context('spawn')
+        with FakeWundergroundServer() as server:
+            workers = [context.Process(target=wunderground_scraper.run_worker,
+                                       args=(arguments, server.url))
+                       for _ in range(3)]
+            for process in workers:
+                process.start()
+            for process in workers:
+                process.join(60)
+            # Every day's page is fetched once, plus at most one redirect per
+            # worker thread before the station has been learned
+            self.assertGreater(server.requests, len(jobs))
+            self.assertLessEqual(server.requests, len(jobs) + 3 * arguments.concurrency)
+        self.assertEqual([process.exitcode for process in workers], [0, 0, 0])
+        self.assertEqual(self.queue.counts()['done'], len(jobs))
+        with wunderground_scraper.HistoryStore(store_path) as store:
+            self.assertEqual(len(store.stored_dates('KFTY', jobs[0][1],
+                                                    jobs[-1][1])), len(jobs))
+        stations = wunderground_scraper.StationTable(stations_path)
+        self.assertEqual(stations.get('KFTY'), '/history/airport/KFTY')
+
+    def test_parse_arguments_queue(self):
+        """ Make sure options the workers don't support are a usage error
+        rather than ignored.
+        """
+        for option in (['--archive', 'archive'], ['--parse-workers'],
+                       ['--metrics', 'metrics.prom'], ['--profile', 'profile.out']):
+            with self.assertRaises(SystemExit):
+                wunderground_scraper.parse_arguments(
+                    ['--queue', self.path, '--work'] + option)
+            with self.assertRaises(SystemExit):
+                wunderground_scraper.parse_arguments(
+                    ['--location', 'KFTY', '--date', '2017-10-11',
+                     '--queue', self.path] + option)
+
+
+class TestService(unittest.TestCase):
+    """ Tests the service mode against a local stand-in server.
+    """
+
+    def test_get_history(self):
+        """ Make sure a lookup is answered, and answered again from the LRU
+        without another request upstream.
+        """
+        import requests
+        with FakeWundergroundServer() as server, \
+                RunningService(server.url) as service, requests.Session() as session:
+            for _ in range(2):
+                response = session.get(service.url + '/history', params={
+                    'location': 'Atlanta, GA', 'date': '2017-10-11'})
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response.json()['data'],
+                                 json.loads(TestScrapeRange.expected_data))
+            self.assertEqual(server.requests, 2)
+            stats = session.get(service.url + '/stats').json()
+        self.assertEqual(stats['lru'], {'hits': 1, 'misses': 1, 'size': 1})
+
+    def test_get_history_errors(self):
+        """ Make sure invalid lookups, upstream errors and unknown paths
+        get their own status codes.
+        """
+        import requests
+        with FakeWundergroundServer() as server, \
+                RunningService(server.url) as service, requests.Session() as session:
+            response = session.get(service.url + '/history', params={
+                'location': 'Atlanta', 'date': '2017-10-11'})
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.json()['error'], 'Location invalid')
+            server.page = b'<html></html>'
+            response = session.get(service.url + '/history', params={
+                'location': 'KFTY', 'date': '2017-10-11'})
+            self.assertEqual(response.status_code, 502)
+            self.assertIn('error', response.json()['data'])
+            self.assertEqual(session.get(service.url + '/').status_code, 404)
+            self.assertEqual(session.put(service.url + '/history').status_code, 405)
+
+    def test_post_history(self):
+        """ Make sure a batch of lookups is answered in order.
+        """
+        import requests
+        jobs = [{'location': 'KFTY', 'date': '2017-10-%02d' % day}
+                for day in range(1, 6)] + [{'location': 'KFTY', 'date': 'never'}]
+        with FakeWundergroundServer() as server, RunningService(server.url) as service:
+            response = requests.post(service.url + '/history', json={'jobs': jobs})
+            bad_body = requests.post(service.url + '/history', data=b'[1, 2]')
+        self.assertEqual(response.status_code, 200)
+        answers = response.json()
+        self.assertEqual([answer['date'] for answer in answers[:5]],
+                         [job['date'] for job in jobs[:5]])
+        self.assertEqual(answers[5]['error'], 'Date invalid')
+        self.assertEqual(bad_body.status_code, 400)
+
+    def test_keep_alive(self):
+        """ Make sure clients can send many requests over one connection.
+        """
+        import http.client
+        with FakeWundergroundServer() as server, RunningService(server.url) as service:
+            connection = http.client.HTTPConnection(service.url[len('http://'):])
+            for _ in range(3):
+                connection.request('GET', '/stats')
+                self.assertEqual(connection.getresponse().read()[:1], b'{')
+            connection.close()
+
+    def test_oversized_requests(self):
+        """ Make sure requests with over-long lines or bodies are turned
+        away and hung up on rather than read.
+        """
+        import socket
+
+        def send(service, request):
+            host, _, port = service.url[len('http://'):].partition(':')
+            with socket.create_connection((host, int(port))) as connection:
+                connection.sendall(request)
+                # The service hangs up after answering
+                return connection.makefile('rb').read().split(b'\r\n')[0]
+        with FakeWundergroundServer() as server, RunningService(server.url) as service:
+            self.assertEqual(send(service, b'GET /' + b'a' * 100000 + b' HTTP/1.1\r\n\r\n'),
+                             b'HTTP/1.1 400 Bad Request')
+            self.assertEqual(send(service, b'GET /stats HTTP/1.1\r\nX-Long: '
+                                  + b'a' * 100000 + b'\r\n\r\n'),
+                             b'HTTP/1.1 400 Bad Request')
+            self.assertEqual(send(service, b'POST /history HTTP/1.1\r\nContent-Length: %d'
+                                  b'\r\n\r\n' % (wunderground_scraper.SERVICE_MAX_BODY + 1)),
+                             b'HTTP/1.1 413 Request Entity Too Large')
+            self.assertEqual(send(service, b'POST /history HTTP/1.1\r\nContent-Length: -1'
+                                  b'\r\n\r\n'), b'HTTP/1.1 400 Bad Request')
+            # The service is still up
+            self.assertEqual(send(service, b'GET /stats HTTP/1.0\r\n\r\n'),
+                             b'HTTP/1.1 200 OK')
+
+    def test_parse_arguments_serve(self):
+        """ Make sure the service mode needs no jobs and takes an address.
+        """
+        arguments = wunderground_scraper.parse_arguments(['--serve', '8080'])
+        self.assertEqual(arguments.serve, ('127.0.0.1', 8080))
+        arguments = wunderground_scraper.parse_arguments(['--serve', '0.0.0.0:80'])
+        self.assertEqual(arguments.serve, ('0.0.0.0', 80))
+
+
+class TestStartup(unittest.TestCase):
+    """ Tests that importing the scraper stays cheap, since it is launched
+    from cron many times a day.
+    """
+
+    # Generous limit on the cumulative import time of the module in
+    # microseconds, well above what it costs with lazy imports but well
+    # below what requests and bs4 cost on their own
+    import_threshold = 100000
+
+    def import_times(self):
+        """ Imports the scraper in a fresh interpreter under
+        'python -X importtime'.
+
+        :return: Dictionary of module name -> cumulative import time in us
+        """
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c',
+             'import wunderground_scraper'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            universal_newlines=True, check=True)
+        times = dict()
+        for line in result.stderr.splitlines():
+            match = re.match(r'import time:\s+\d+ \|\s+(\d+) \|\s+(\S+)', line)
+            if match:
+                times[match.group(2)] = int(match.group(1))
+        return times
+
+    def test_heavy_imports_are_lazy(self):
+        """ Tests that importing the scraper doesn't import requests or bs4.
+        """
+        times = self.import_times()
+        self.assertIn('wunderground_scraper', times)
+        for module in ('requests', 'bs4', 'sqlite3', 'argparse', 'calendar'):
+            self.assertNotIn(module, times)
+
+    def test_import_time(self):
+        """ Tests that importing the scraper stays under the threshold.
+        """
+        times = self.import_times()
+        self.assertLess(times['wunderground_scraper'], self.import_threshold)
+
+
 if __name__ == '__main__':
     unittest.main()